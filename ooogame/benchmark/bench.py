@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Benchmark the database-api endpoints against a synthesized game.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from .synthesize import GAME_RATES, GAME_SIZE, TICK_SECONDS, random_flag, synthesize_game
+
+l = logging.getLogger("bench")
+
+REQUESTS_PER_ENDPOINT = 20
+SUBMIT_HIT_RATE = 0.5
+
+# name: (method, flask rule, what the benchmark requests)
+ENDPOINTS = {
+    'visualization': ("GET", "/api/v1/visualization"),
+    'scores': ("GET", "/api/v1/scores"),
+    'services': ("GET", "/api/v1/services"),
+    'events': ("GET", "/api/v1/events"),
+    'flag_submit': ("POST", "/api/v1/flag/submit/<int:team_id>"),
+}
+
+
+class FlaskClientTransport:
+    """
+    Requests to the database-api in this process, through the Flask test client.
+    """
+
+    def __init__(self):
+        from ..database import api
+        self.client = api.app.test_client()
+
+    def send(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpTransport:
+    """
+    Requests to a running database-api.
+    """
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def send(self, method, path, data=None):
+        response = self.session.request(method, self.base_url + path, data=data)
+        return response.status_code, response.text
+
+
+def sql_queries(transport):
+    """
+    The (sum, count) of the SQL queries per request of every (rule, method) from /metrics, None without it.
+    """
+    status, text = transport.send("GET", "/metrics")
+    if status != 200:
+        return None
+    prefix = "ooogame_sql_queries_per_request_"
+    queries = {}
+    for line in text.splitlines():
+        if not line.startswith(prefix) or "le=" in line:
+            continue
+        name, _, value = line.rpartition(" ")
+        kind, labels = name[len(prefix):].split("{", 1)
+        labels = dict(label.split("=", 1) for label in labels.rstrip("}").split('",'))
+        key = (labels['endpoint'].strip('"'), labels['method'].strip('"'))
+        queries.setdefault(key, [0, 0])[kind == "count"] = float(value)
+    return queries
+
+
+def _submissions(api, rng, hit_rate):
+    """
+    Endless (team_id, flag) submissions: a not yet stolen flag of the current tick hit_rate of the time,
+    a wrong flag otherwise.
+    """
+    tick_id = api.db.session.query(api.func.max(api.Tick.id)).scalar()
+    team_ids = [team_id for (team_id,) in api.db.session.query(api.Team.id).filter(api.Team.is_test_team.is_(False))]
+    flags = api.db.session.query(api.Flag.flag, api.Flag.team_id).filter(api.Flag.tick_id == tick_id).all()
+    submitted = set(api.db.session.query(api.FlagSubmission.team_id, api.FlagSubmission.submission)
+                    .filter(api.FlagSubmission.tick_id == tick_id))
+    api.db.session.remove()
+
+    steals = [(team_id, flag) for (flag, victim_id) in flags for team_id in team_ids
+              if team_id != victim_id and (team_id, flag) not in submitted]
+    rng.shuffle(steals)
+    while True:
+        if steals and rng.random() < hit_rate:
+            yield steals.pop()
+        else:
+            yield rng.choice(team_ids), random_flag(rng, api.app.config)
+
+
+def run_benchmark(transport, requests=REQUESTS_PER_ENDPOINT, hit_rate=SUBMIT_HIT_RATE, endpoints=tuple(ENDPOINTS),
+                  seed=0):
+    """
+    Send requests requests to each endpoint, one endpoint after the other, and time them.
+    The events are read a page at a time from the end, the flags submitted hit_rate correct.
+
+    :return: dict with, for each endpoint, the latency percentiles (ms), the response statuses and the SQL queries
+             per request (from /metrics, when it is there).
+    """
+    from ..database import api
+
+    rng = random.Random(seed)
+    submissions = _submissions(api, rng, hit_rate)
+    last_event_id = api.db.session.query(api.func.max(api.Event.id)).scalar() or 0
+    api.db.session.remove()
+    events_path = f"/api/v1/events?after_id={max(last_event_id - api.MAX_EVENTS_PER_PAGE, 0)}" \
+                  f"&limit={api.MAX_EVENTS_PER_PAGE}"
+
+    before = sql_queries(transport)
+    report = {}
+    for name in endpoints:
+        method, rule = ENDPOINTS[name]
+        timings = []
+        statuses = {}
+        for _ in range(requests):
+            data = None
+            if name == 'flag_submit':
+                team_id, flag = next(submissions)
+                path = f"/api/v1/flag/submit/{team_id}"
+                data = dict(flag=flag)
+            elif name == 'events':
+                path = events_path
+            else:
+                path = rule
+            started = time.perf_counter()
+            status, _ = transport.send(method, path, data)
+            timings.append((time.perf_counter() - started) * 1000)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        report[name] = dict(requests=requests,
+                            first_ms=timings[0],
+                            p50_ms=float(np.percentile(timings, 50)),
+                            p99_ms=float(np.percentile(timings, 99)),
+                            mean_ms=float(np.mean(timings)),
+                            max_ms=max(timings),
+                            statuses=statuses,
+                            queries_per_request=None)
+        l.info(f"Benchmarked endpoint={name} p50_ms={report[name]['p50_ms']:.2f} p99_ms={report[name]['p99_ms']:.2f}")
+
+    after = sql_queries(transport)
+    if before is not None and after is not None:
+        for name in endpoints:
+            method, rule = ENDPOINTS[name]
+            queries, count = after.get((rule, method), (0, 0))
+            queries_before, count_before = before.get((rule, method), (0, 0))
+            if count > count_before:
+                report[name]['queries_per_request'] = (queries - queries_before) / (count - count_before)
+    return report
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench")
+    parser.add_argument("--database", default="sqlite:///:memory:",
+                        help="The SQLAlchemy URI of the database to synthesize the game into, the one of the "
+                             "database-api with --server [default: sqlite:///:memory:]")
+    parser.add_argument("--server", help="The URL of a running database-api, rather than the Flask test client")
+    parser.add_argument("--no-synthesize", action="store_true", help="Benchmark the game already in the database")
+    for (name, value) in list(GAME_SIZE.items()) + list(GAME_RATES.items()):
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value,
+                            help=f"[default: {value}]")
+    parser.add_argument("--seed", type=int, default=0, help="[default: 0]")
+    parser.add_argument("--requests", type=int, default=REQUESTS_PER_ENDPOINT,
+                        help=f"Requests to each endpoint [default: {REQUESTS_PER_ENDPOINT}]")
+    parser.add_argument("--submit-hit-rate", type=float, default=SUBMIT_HIT_RATE,
+                        help=f"How many of the submitted flags are correct [default: {SUBMIT_HIT_RATE}]")
+    parser.add_argument("--endpoint", action="append", choices=list(ENDPOINTS),
+                        help="Only benchmark this endpoint (repeatable) [default: all of them]")
+    parser.add_argument("--output", help="Write the JSON report here rather than to stdout")
+    parser.add_argument("--version", action="version", version="%(prog)s v0.1.0")
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    if args.server and args.database.startswith("sqlite:///:memory:"):
+        l.error("Error, the database-api at --server cannot see an in-memory database, give its --database")
+        parser.print_help()
+        sys.exit(1)
+
+    os.environ["SQLALCHEMY_DATABASE_URI"] = args.database
+    from ..database import api
+
+    game = dict(GAME_SIZE, **GAME_RATES)
+    game = {name: getattr(args, name) for name in game}
+    report = dict(commit=_commit(), database=api.db.engine.dialect.name, server=args.server, game=game,
+                  requests_per_endpoint=args.requests, submit_hit_rate=args.submit_hit_rate)
+    if not args.no_synthesize:
+        api.db.create_all()
+        started = time.perf_counter()
+        report['rows'] = synthesize_game(tick_seconds=TICK_SECONDS, seed=args.seed, **game)
+        report['synthesize_seconds'] = time.perf_counter() - started
+
+    transport = HttpTransport(args.server) if args.server else FlaskClientTransport()
+    report['endpoints'] = run_benchmark(transport, requests=args.requests, hit_rate=args.submit_hit_rate,
+                                        endpoints=args.endpoint or tuple(ENDPOINTS), seed=args.seed)
+    # ru_maxrss is in KiB on Linux, of this process: the database-api too unless it is a --server
+    report['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
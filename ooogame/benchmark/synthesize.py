@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Synthesize a whole game into the database-api's database, for benchmarking.
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+
+l = logging.getLogger("synthesize")
+
+# something like the last day of a DEF CON final
+GAME_SIZE = dict(
+    teams=16,
+    normal_services=6,
+    koh_services=2,
+    ticks=300,
+)
+
+GAME_RATES = dict(
+    # chance that a team steals the flag of another team for a service in a tick
+    hit_rate=0.1,
+    # chance that a steal also comes with a stealth event
+    stealth_rate=0.3,
+    # wrong flags submitted by a team in a tick
+    incorrect_per_tick=5,
+    # chance that the SLA check of a team's service fails in a tick
+    sla_failure_rate=0.05,
+    # chance that a team uploads a patch for a service in a tick
+    patch_rate=0.01,
+)
+
+TICK_SECONDS = 300
+SCRIPT_DOCKER = "bench-interaction:latest"
+
+
+def random_flag(rng, config):
+    return "{0[FLAG_PREFIX]}{1}{0[FLAG_SUFFIX]}".format(
+        config, "".join(rng.choice(config["FLAG_ALPHABET"]) for _ in range(config["FLAG_LENGTH"])))
+
+
+def _create_teams_and_services(api, teams, normal_services, koh_services):
+    team_ids = []
+    for i in range(1, teams + 1):
+        team = api.Team(id=i, name=f"bench-team-{i}", team_network=f"10.{i}.0.0/24", vm_address=f"10.13.37.{i}")
+        api.db.session.add(team)
+        team_ids.append(i)
+
+    normal = []
+    koh = []
+    for i in range(normal_services + koh_services):
+        is_koh = i >= normal_services
+        service = api.Service(name=f"bench-{'koh' if is_koh else 'normal'}-{i + 1}",
+                              description="Synthesized service.",
+                              repo_url="git@example.com:bench.git",
+                              port=10000 + i,
+                              check_timeout=120,
+                              max_bytes=1024)
+        if is_koh:
+            service.type = api.ServiceType.KING_OF_THE_HILL
+            service.score_location = "/score"
+            koh.append(service)
+        else:
+            service.type = api.ServiceType.NORMAL
+            service.isolation = api.IsolationType.SHARED
+            service.flag_location = "/flag"
+            service.central_server = ""
+            service.service_docker = f"{service.name}:latest"
+            service.interaction_docker = SCRIPT_DOCKER
+            normal.append(service)
+        api.db.session.add(service)
+    api.db.session.commit()
+    return team_ids, [s.id for s in normal], [s.id for s in koh]
+
+
+def synthesize_game(teams=GAME_SIZE['teams'], normal_services=GAME_SIZE['normal_services'],
+                    koh_services=GAME_SIZE['koh_services'], ticks=GAME_SIZE['ticks'],
+                    tick_seconds=TICK_SECONDS, seed=0, **rates):
+    """
+    Fill the (empty) database with a running game whose last tick just started: teams, active and visible
+    services, a flag for every team and NORMAL service in every tick, the set flag and SLA events, steals
+    (correct submissions and flag stolen events) with their stealth events, wrong submissions, KoH rankings
+    and patches. It is reproducible for a seed.
+
+    :param rates: GAME_RATES to change.
+    :return: dict with the number of rows of each kind.
+    """
+    from ..database import api
+
+    unknown = set(rates) - set(GAME_RATES)
+    if unknown:
+        raise ValueError(f"unknown rates {', '.join(sorted(unknown))}")
+    rates = dict(GAME_RATES, **rates)
+    rng = random.Random(seed)
+    counts = dict.fromkeys(("flags", "steals", "stealths", "submissions", "events", "koh_rankings", "patches"), 0)
+
+    team_ids, normal_ids, koh_ids = _create_teams_and_services(api, teams, normal_services, koh_services)
+    l.info(f"Synthesizing num_ticks={ticks} for num_teams={teams} num_normal_services={normal_services} "
+           f"num_koh_services={koh_services} rates={rates}")
+
+    start = datetime.datetime.now() - datetime.timedelta(seconds=(ticks - 1) * tick_seconds)
+    api.db.session.add(api.GameState(state=api.State.RUNNING, created_on=start))
+    api.db.session.add(api.TickTime(time_seconds=tick_seconds, created_on=start))
+
+    def add_event(event, created_on):
+        event.created_on = created_on + datetime.timedelta(seconds=rng.uniform(0, tick_seconds))
+        api.db.session.add(event)
+        counts['events'] += 1
+
+    for t in range(ticks):
+        created_on = start + datetime.timedelta(seconds=t * tick_seconds)
+        tick = api.Tick(created_on=created_on)
+        api.db.session.add(tick)
+        api.db.session.flush()
+        if t == 0:
+            for service_id in normal_ids + koh_ids:
+                api.db.session.add(api.IsActive(is_active=True, service_id=service_id, tick_id=tick.id))
+                api.db.session.add(api.IsVisible(is_visible=True, service_id=service_id, tick_id=tick.id))
+                # (this commits the tick so far)
+                api.ServiceState.update(service_id)
+
+        flags = {}
+        for service_id in normal_ids:
+            for team_id in team_ids:
+                flag = api.Flag(flag=random_flag(rng, api.app.config), team_id=team_id, service_id=service_id,
+                                tick_id=tick.id, created_on=created_on)
+                api.db.session.add(flag)
+                flags[service_id, team_id] = flag
+        api.db.session.flush()
+        counts['flags'] += len(flags)
+
+        for (service_id, team_id), flag in flags.items():
+            add_event(api.SetFlagEvent(reason=f"Set flag for team {team_id} service {service_id}", tick_id=tick.id,
+                                       team_id=team_id, service_id=service_id, flag_id=flag.id,
+                                       result=api.SetFlagResult.SUCCESS), created_on)
+            failed = rng.random() < rates['sla_failure_rate']
+            add_event(api.SlaScriptEvent(reason=f"SLA check for team {team_id} service {service_id}",
+                                         tick_id=tick.id, team_id=team_id, service_id=service_id,
+                                         ip=f"10.{team_id}.1.2", port=10000, service_interaction_docker=SCRIPT_DOCKER,
+                                         the_script="/check.sh",
+                                         result=api.ScriptResult.FAIL if failed else api.ScriptResult.SUCCESS),
+                      created_on)
+
+            for attacker_id in team_ids:
+                if attacker_id == team_id or rng.random() >= rates['hit_rate']:
+                    continue
+                api.db.session.add(api.FlagSubmission(submission=flag.flag, result=api.FlagSubmissionResult.CORRECT,
+                                                      team_id=attacker_id, flag_id=flag.id, tick_id=tick.id))
+                add_event(api.FlagStolenEvent(reason=f"Team {attacker_id} stole flag from team {team_id} for "
+                                                     f"service {service_id}",
+                                              tick_id=tick.id, exploit_team_id=attacker_id, victim_team_id=team_id,
+                                              service_id=service_id, flag_id=flag.id), created_on)
+                counts['steals'] += 1
+                counts['submissions'] += 1
+                if rng.random() < rates['stealth_rate']:
+                    add_event(api.StealthEvent(reason=f"Stealth attack from team {attacker_id} on team {team_id}",
+                                               tick_id=tick.id, src_team_id=attacker_id, dst_team_id=team_id,
+                                               service_id=service_id), created_on)
+                    counts['stealths'] += 1
+
+            if rng.random() < rates['patch_rate']:
+                patch = api.UploadedPatch(team_id=team_id, service_id=service_id, tick_id=tick.id,
+                                          uploaded_file=b"\x90" * 64, uploaded_hash=f"{rng.getrandbits(128):032x}",
+                                          created_on=created_on)
+                patch.results.append(api.UploadedPatchResult(status=rng.choice(list(api.PatchStatus)),
+                                                             created_on=created_on))
+                api.db.session.add(patch)
+                counts['patches'] += 1
+
+        for team_id in team_ids:
+            for _ in range(rates['incorrect_per_tick']):
+                api.db.session.add(api.FlagSubmission(submission=random_flag(rng, api.app.config),
+                                                      result=api.FlagSubmissionResult.INCORRECT,
+                                                      team_id=team_id, tick_id=tick.id))
+                counts['submissions'] += 1
+
+        for service_id in koh_ids:
+            ranking = api.KohRankingEvent(reason=f"KoH ranking for service {service_id}", tick_id=tick.id,
+                                          service_id=service_id)
+            scores = sorted(((rng.randint(0, 100), team_id) for team_id in team_ids), reverse=True)
+            for rank, (score, team_id) in enumerate(scores, start=1):
+                ranking.koh_rank_results.append(api.KohRankResult(rank=rank, score=score, team_id=team_id))
+            add_event(ranking, created_on)
+            counts['koh_rankings'] += 1
+
+        api.db.session.commit()
+        if (t + 1) % 50 == 0:
+            l.info(f"Synthesized num_ticks={t + 1} counts={counts}")
+
+    api.clear_in_process_caches()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="synthesize")
+    parser.add_argument("database", help="The SQLAlchemy URI of the (empty) database to fill")
+    for (name, value) in list(GAME_SIZE.items()) + list(GAME_RATES.items()):
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value,
+                            help=f"[default: {value}]")
+    parser.add_argument("--tick-seconds", type=int, default=TICK_SECONDS, help=f"[default: {TICK_SECONDS}]")
+    parser.add_argument("--seed", type=int, default=0, help="[default: 0]")
+    parser.add_argument("--version", action="version", version="%(prog)s v0.1.0")
+
+    logging.basicConfig(level=logging.INFO)
+    args = vars(parser.parse_args())
+
+    os.environ["SQLALCHEMY_DATABASE_URI"] = args.pop("database")
+    from ..database import api
+    api.db.create_all()
+    counts = synthesize_game(**args)
+    l.info(f"Done counts={counts}")
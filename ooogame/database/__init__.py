@@ -1,3 +1,3 @@
 from .config import Config
-from .client import Db
+from .client import AsyncDb, Db
 
@@ -4,6 +4,8 @@
 Database API.
 """
 import argparse
+import bisect
+import collections
 import datetime
 import enum
 import ipaddress
@@ -13,22 +15,31 @@ import random
 import uuid
 import base64
 import hashlib
+import inspect
+import itertools
+import math
+import time
 from functools import wraps
 
+import numpy as np
+import redis
 import yaml
-from flask import Flask, jsonify, request, json
+from flask import Flask, Response, g, has_request_context, jsonify, request, json, \
+    stream_with_context
 from flask_migrate import Migrate
 from flask_restful import Api, Resource, abort, reqparse
 from flask_rq2 import RQ
 from flask_sqlalchemy import SQLAlchemy
 import sqlalchemy
-from sqlalchemy import CHAR, BLOB, TypeDecorator, or_
+from sqlalchemy import CHAR, BLOB, TypeDecorator, and_, func, or_
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import with_polymorphic
+from sqlalchemy.orm import aliased, selectinload, with_polymorphic
 from werkzeug.middleware.profiler import ProfilerMiddleware
 
 from . import Config
+from . import scoring
 from ..common import PatchStatus
+from ..gamestatebot.gamestatebot import REFETCH_TICKS
 from ..patchbot import patchbot
 
 l = logging.getLogger("database-api")
@@ -150,16 +161,73 @@ class TeamMessageAllowed(Resource):
             return jsonify(dict(message="unauthorized attempt to add a message"))
 
 
+MAX_TICKETS_PER_PAGE = 1000
+
+
+def respond_with_tickets(team_id=None):
+    """
+    The tickets (of team_id, if given), newest (created_on, then id) first, from one query that joins in each
+    ticket's latest status and team name, plus one for all their messages.
+
+    ?limit=N&before_id=M pages through them (next_before_id is the before_id of the next page, None on the last
+    one, and an unknown before_id is an empty page) and ?updated_since=ISO-TIMESTAMP keeps only the tickets created,
+    answered or with a status change after it.
+    """
+    limit = request.args.get('limit', type=int)
+    before_id = request.args.get('before_id', type=int)
+    updated_since = request.args.get('updated_since')
+
+    if limit is not None and not 0 < limit <= MAX_TICKETS_PER_PAGE:
+        abort(400, message=f"limit must be between 1 and {MAX_TICKETS_PER_PAGE}")
+
+    latest_status = db.session.query(
+        TicketStatus.ticket_id,
+        TicketStatus.status,
+        func.row_number().over(partition_by=TicketStatus.ticket_id,
+                               order_by=(TicketStatus.created_on.desc(), TicketStatus.id.desc())).label('position'),
+    ).subquery()
+
+    query = db.session.query(Ticket, latest_status.c.status, Team.name) \
+        .join(latest_status, sqlalchemy.and_(latest_status.c.ticket_id == Ticket.id, latest_status.c.position == 1)) \
+        .join(Team, Team.id == Ticket.team_id) \
+        .options(selectinload(Ticket.messages))
+    if team_id is not None:
+        query = query.filter(Ticket.team_id == team_id)
+    if before_id is not None:
+        # the tickets after before_id's in the (created_on, id) order
+        before = aliased(Ticket)
+        before_created_on = db.session.query(before.created_on).filter(before.id == before_id).as_scalar()
+        query = query.filter(or_(Ticket.created_on < before_created_on,
+                                 and_(Ticket.created_on == before_created_on, Ticket.id < before_id)))
+    if updated_since:
+        try:
+            since = datetime.datetime.fromisoformat(updated_since.rstrip("Z"))
+        except ValueError:
+            abort(400, message="updated_since must be an ISO 8601 timestamp")
+        query = query.filter(or_(Ticket.created_on > since,
+                                 Ticket.messages.any(TicketMessage.created_on > since),
+                                 db.session.query(TicketStatus.id).filter(TicketStatus.ticket_id == Ticket.id,
+                                                                          TicketStatus.created_on > since).exists()))
+    # the id breaks the created_on ties, so the pages neither skip nor repeat tickets
+    query = query.order_by(Ticket.created_on.desc(), Ticket.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+
+    rows = query.all()
+    result = dict(tickets=[ticket.to_json(status=TicketStatusTypes.get_text_status(status), team_name=team_name)
+                           for (ticket, status, team_name) in rows])
+    if limit is not None:
+        result['next_before_id'] = rows[-1][0].id if len(rows) == limit else None
+    return jsonify(result)
+
+
 class TicketList(Resource):
     """
     Get all the tickets.
     """
 
     def get(self):
-        tickets = db.session.query(Ticket).order_by(Ticket.created_on.desc()).all()
-        return jsonify(dict(
-            tickets=[ticket.to_json() for ticket in tickets]
-        ))
+        return respond_with_tickets()
 
 
 class TeamTicketList(Resource):
@@ -168,10 +236,7 @@ class TeamTicketList(Resource):
     """
 
     def get(self, team_id):
-        tickets = db.session.query(Ticket).filter_by(team_id=team_id).order_by(Ticket.created_on.desc()).all()
-        return jsonify(dict(
-            tickets=[ticket.to_json() for ticket in tickets]
-        ))
+        return respond_with_tickets(team_id=team_id)
 
 
 class TicketMessagesList(Resource):
@@ -180,10 +245,7 @@ class TicketMessagesList(Resource):
     """
 
     def get(self, team_id):
-        tickets = db.session.query(Ticket).filter_by(team_id=team_id).all()
-        return jsonify(dict(
-            tickets=[ticket.to_json() for ticket in tickets]
-        ))
+        return respond_with_tickets(team_id=team_id)
 
 
 # #######################
@@ -204,13 +266,17 @@ class Ticket(db.Model):
     created_on = db.Column(db.DateTime, default=datetime.datetime.now, nullable=False)
     messages = db.relationship("TicketMessage", back_populates="ticket")
 
-    def to_json(self):
+    def to_json(self, status=None, team_name=None):
         """
         Return a JSON representation.
+        :param status: the current status, if already known.
+        :param team_name: the team's name, if already known.
         :return: JSON.
         """
-        status = TicketStatus.get_current_status(self.id)
-        team_name = Team.get_team_name(self.team_id)
+        if status is None:
+            status = TicketStatus.get_current_status(self.id)
+        if team_name is None:
+            team_name = Team.get_team_name(self.team_id)
 
         return dict(
             id=self.id,
@@ -387,8 +453,7 @@ class Tick(db.Model):
 
     @staticmethod
     def get_current_tick():
-        current_tick = db.session.query(Tick).order_by(Tick.id.desc()).first()
-        return current_tick
+        return tick_clock.current_tick()
 
     @staticmethod
     def get_tick_at(timestamp):
@@ -397,7 +462,7 @@ class Tick(db.Model):
 
     @staticmethod
     def get_current_tick_id():
-        return Tick.get_current_tick().id
+        return tick_clock.current_tick_id()
 
     def to_json(self):
         """
@@ -410,6 +475,49 @@ class Tick(db.Model):
         )
 
 
+class TickClock:
+    """
+    The current tick, looked up at most once per request.
+
+    The id is kept in flask.g, so the tick_id column defaults and the handlers of a request share one
+    lookup, and every worker process sees a new tick on its next request. Ticks inserted or deleted
+    by this process are forgotten right away. Outside of a request (a bare app context lives as long
+    as the script or bot that pushed it) every call asks the database.
+    """
+
+    def clear(self):
+        if has_request_context():
+            g.pop('current_tick_id', None)
+
+    def current_tick(self):
+        tick_id = g.get('current_tick_id') if has_request_context() else None
+        if tick_id is not None:
+            # from the identity map if the session already has it
+            tick = db.session.query(Tick).get(tick_id)
+            if tick is not None:
+                return tick
+
+        tick = db.session.query(Tick).order_by(Tick.id.desc()).first()
+        if tick is not None and has_request_context():
+            g.current_tick_id = tick.id
+        return tick
+
+    def current_tick_id(self):
+        tick_id = g.get('current_tick_id') if has_request_context() else None
+        if tick_id is not None:
+            return tick_id
+        return self.current_tick().id
+
+
+tick_clock = TickClock()
+
+
+@sqlalchemy.event.listens_for(Tick, 'after_insert')
+@sqlalchemy.event.listens_for(Tick, 'after_delete')
+def receive_tick_change(mapper, connection, target):
+    tick_clock.clear()
+
+
 class State(enum.Enum):
     INIT = 0
     RUNNING = 1
@@ -1016,7 +1124,119 @@ class IsActive(db.Model):
     __table_args__ = (db.Index('idx_is_active_service_id_tick_id', 'service_id', 'tick_id'),)
 
 
-# Did not give us a perf improvement
+class ServiceActivityIndex:
+    """
+    In-process index of the ticks in which each service was active.
+
+    The is_active history of every service is folded into sorted [start_tick, end_tick)
+    intervals that are answered with bisect. The table is checked for new rows at most
+    once per request (and right after ServiceIsActive), and only the new rows are read.
+    Outside of a request it is checked on every call.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._rows = collections.defaultdict(list)
+        self._intervals = {}
+        self._count = 0
+        self._max_id = None
+
+    def refresh(self, force=False):
+        if not force and has_request_context():
+            if g.get('service_activity_checked'):
+                return
+            g.service_activity_checked = True
+
+        count, max_id = db.session.query(func.count(IsActive.id), func.max(IsActive.id)).one()
+        if (count, max_id) == (self._count, self._max_id):
+            return
+
+        new_rows = []
+        if self._max_id is not None and max_id is not None and max_id > self._max_id:
+            new_rows = db.session.query(IsActive.id, IsActive.tick_id, IsActive.is_active, IsActive.service_id) \
+                .filter(IsActive.id > self._max_id).all()
+
+        if self._count + len(new_rows) != count:
+            # first time, the table was reset, or an older transaction committed late
+            self.clear()
+            new_rows = db.session.query(IsActive.id, IsActive.tick_id, IsActive.is_active, IsActive.service_id).all()
+
+        for (row_id, tick_id, is_active, service_id) in new_rows:
+            self._rows[service_id].append((row_id, tick_id, is_active))
+        for service_id in set(row[3] for row in new_rows):
+            self._intervals[service_id] = self._fold(self._rows[service_id])
+
+        self._count = count
+        self._max_id = max_id
+
+    @staticmethod
+    def _fold(rows):
+        """
+        Same answer as the original per-tick query: if there are rows in the tick, the service was
+        active only if all of them say so, otherwise the latest row from before the tick decides.
+        """
+        by_tick = collections.defaultdict(list)
+        for (row_id, tick_id, is_active) in rows:
+            by_tick[tick_id].append((row_id, is_active))
+
+        starts, ends = [], []
+
+        def add(start, end):
+            if start >= end:
+                return
+            if ends and ends[-1] == start:
+                ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+
+        ticks = sorted(by_tick)
+        latest = (0, False)
+        for i, tick_id in enumerate(ticks):
+            in_tick = by_tick[tick_id]
+            latest = max(latest, max(in_tick))
+            next_tick = ticks[i + 1] if i + 1 < len(ticks) else math.inf
+            if all(is_active for (_, is_active) in in_tick):
+                add(tick_id, tick_id + 1)
+            if latest[1]:
+                add(tick_id + 1, next_tick)
+
+        return starts, ends
+
+    def was_active(self, service_id, tick_id):
+        self.refresh()
+        starts, ends = self._intervals.get(service_id, ([], []))
+        i = bisect.bisect_right(starts, tick_id) - 1
+        return i >= 0 and tick_id < ends[i]
+
+    def active_ticks(self, service_id, tick_ids):
+        return [tick_id for tick_id in tick_ids if self.was_active(service_id, tick_id)]
+
+    def intervals(self, service_id):
+        """
+        :return: (starts, ends) of the [start_tick, end_tick) intervals in which the service was active.
+        """
+        self.refresh()
+        return self._intervals.get(service_id, ([], []))
+
+
+service_activity = ServiceActivityIndex()
+
+# Every in-process cache of table contents, cleared when the tables are reset
+in_process_caches = [service_activity, tick_clock]
+
+
+def clear_in_process_caches(*args, **kwargs):
+    for cache in in_process_caches:
+        cache.clear()
+
+
+sqlalchemy.event.listen(db.Model.metadata, 'after_drop', clear_in_process_caches)
+
+
+# XXX: NOT IN USE ANYMORE, replaced by ServiceActivityIndex
 class CacheWasServiceActive(db.Model):
     """
     This tables caches the calculation of the "was_service_active" calculation
@@ -1035,7 +1255,8 @@ class CacheWasServiceActive(db.Model):
 
 class CacheTickScores(db.Model):
     """
-    This tables caches the calculation of the "calculate_scores"
+    XXX: NOT IN USE ANYMORE, replaced by the FinalizedTick/TickScore ledger
+    (score_json overflowed 4096 bytes with 16 teams).
     """
 
     __tablename__ = "cache_calculate_scores"
@@ -1045,6 +1266,44 @@ class CacheTickScores(db.Model):
     created_on = db.Column(db.DateTime, default=datetime.datetime.now)
 
 
+class ScoreType(enum.Enum):
+    ATTACK = 0
+    DEFENSE = 1
+    KING_OF_THE_HILL = 2
+
+
+class FinalizedTick(db.Model):
+    """
+    A tick whose scores have been written to the tick_scores ledger.
+
+    Once a tick is more than NUM_TICKS_FLAG_VALID_FOR old nobody can steal its
+    flags anymore, so the scores are calculated once and then read from the ledger.
+    """
+
+    __tablename__ = "finalized_ticks"
+    tick_id = db.Column(db.Integer, db.ForeignKey('ticks.id'), primary_key=True, autoincrement=False)
+    created_on = db.Column(db.DateTime, default=datetime.datetime.now, nullable=False)
+
+
+class TickScore(db.Model):
+    """
+    One award of points to a team on a service in a finalized tick.
+
+    ATTACK has a row per stolen flag, DEFENSE a row per service defended, and
+    KING_OF_THE_HILL a row per ranked KoH service.
+    """
+
+    __tablename__ = "tick_scores"
+    id = db.Column(db.Integer, primary_key=True)
+    tick_id = db.Column(db.Integer, db.ForeignKey('ticks.id'), nullable=False)
+    team_id = db.Column(db.Integer, db.ForeignKey('teams.id'), nullable=False)
+    service_id = db.Column(db.Integer, db.ForeignKey('services.id'), nullable=False)
+    score_type = db.Column("score_type", db.Enum(ScoreType), nullable=False)
+    points = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (db.Index('idx_tick_scores_tick_id_team_id', 'tick_id', 'team_id'),)
+
+
 class ServiceStatus(enum.Enum):
     GOOD = 0
     OK = 1
@@ -1076,6 +1335,88 @@ class StatusIndicator(db.Model):
     created_on = db.Column(db.DateTime, default=datetime.datetime.now)
 
 
+class ServiceState(db.Model):
+    """
+    The current is_active, is_visible, release_pcaps and service_indicator of a service.
+
+    This is a projection of the latest row of the append-only history tables (which stay
+    the source of truth), recalculated from them whenever one of them is written, so that
+    reading a service's state is part of the query that loads the service.
+    """
+
+    __tablename__ = "service_states"
+    service_id = db.Column(db.Integer, db.ForeignKey("services.id"), primary_key=True, autoincrement=False)
+    is_active = db.Column(db.Boolean, nullable=False, default=False)
+    is_visible = db.Column(db.Boolean, nullable=False, default=False)
+    release_pcaps = db.Column(db.Boolean, nullable=False, default=False)
+    service_indicator = db.Column(db.Enum(ServiceStatus), nullable=False, default=ServiceStatus.GOOD)
+    is_active_tick_id = db.Column(db.Integer, db.ForeignKey('ticks.id'), nullable=True)
+    is_active_created_on = db.Column(db.DateTime, nullable=True)
+
+    updated_on = db.Column(db.DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+    @staticmethod
+    def update(service_id):
+        """
+        Recalculate the state of the service from the history tables.
+        """
+        return ServiceState._update(service_id)[0]
+
+    @staticmethod
+    def record(history_model, service_id, **values):
+        """
+        Add a history row (history_model(service_id=service_id, **values)) and recalculate the state of the service,
+        in the same transaction.
+        :return: the history row.
+        """
+        return ServiceState._update(service_id, history_model, values)[1]
+
+    @staticmethod
+    def _update(service_id, history_model=None, values=None):
+        """
+        The state row is locked (SELECT ... FOR UPDATE) before the history row is added and the latest rows are read,
+        so concurrent writers of a service take turns and the last one to commit has seen every history row.
+        """
+        for _ in range(2):
+            state = db.session.query(ServiceState).filter_by(service_id=service_id).with_for_update().first()
+            if state is None:
+                state = ServiceState(service_id=service_id)
+                db.session.add(state)
+
+            history = None
+            if history_model is not None:
+                history = history_model(service_id=service_id, **values)
+                db.session.add(history)
+
+            try:
+                db.session.flush()
+
+                release_pcaps = db.session.query(ReleasePcaps).filter_by(service_id=service_id) \
+                    .order_by(ReleasePcaps.id.desc()).first()
+                state.release_pcaps = release_pcaps.release_pcaps if release_pcaps else False
+
+                is_visible = db.session.query(IsVisible).filter_by(service_id=service_id) \
+                    .order_by(IsVisible.id.desc()).first()
+                state.is_visible = is_visible.is_visible if is_visible else False
+
+                is_active = db.session.query(IsActive).filter_by(service_id=service_id) \
+                    .order_by(IsActive.id.desc()).first()
+                state.is_active = is_active.is_active if is_active else False
+                state.is_active_tick_id = is_active.tick_id if is_active else None
+                state.is_active_created_on = is_active.created_on if is_active else None
+
+                service_indicator = db.session.query(StatusIndicator).filter_by(service_id=service_id) \
+                    .order_by(StatusIndicator.id.desc()).first()
+                state.service_indicator = service_indicator.service_status if service_indicator else ServiceStatus.GOOD
+
+                db.session.commit()
+                return state, history
+            except sqlalchemy.exc.IntegrityError:
+                # Another worker created the state row first, lock it and start over
+                db.session.rollback()
+        raise Exception(f"Could not update the state of service {service_id}")
+
+
 class Service(db.Model):
     """
     Service.
@@ -1118,95 +1459,76 @@ class Service(db.Model):
     pcap_released_events = db.relationship("PcapReleasedEvent", back_populates="service")
     stealth_events = db.relationship("StealthEvent", back_populates="service")
 
+    current_state = db.relationship("ServiceState", uselist=False, lazy="joined")
+
     created_on = db.Column(db.DateTime, default=datetime.datetime.now)
 
     limit_memory = db.Column(db.String(6), default="512m")
     request_memory = db.Column(db.String(6), default="512m")
 
+    @property
+    def state(self):
+        # Services from before service_states existed get their row on first use
+        if self.current_state is None:
+            self.current_state = ServiceState.update(self.id)
+        return self.current_state
+
     @property
     def release_pcaps(self):
-        release_pcaps = db.session.query(ReleasePcaps).filter_by(service_id=self.id).order_by(
-            ReleasePcaps.id.desc()).first()
-        if release_pcaps:
-            return release_pcaps.release_pcaps
-        else:
-            return False
+        return self.state.release_pcaps
 
     @property
     def is_visible(self):
-        is_visible = db.session.query(IsVisible).filter_by(service_id=self.id).order_by(IsVisible.id.desc()).first()
-        if is_visible:
-            return is_visible.is_visible
-        else:
-            return False
+        return self.state.is_visible
 
     @property
     def is_active(self):
-        is_active = db.session.query(IsActive).filter_by(service_id=self.id).order_by(IsActive.id.desc()).first()
-        if is_active:
-            return is_active.is_active
-        else:
-            return False
+        return self.state.is_active
 
     @property
     def service_indicator(self):
-        service_indicator = db.session.query(StatusIndicator).filter_by(service_id=self.id).order_by(
-            StatusIndicator.id.desc()).first()
-        if service_indicator:
-            return service_indicator.service_status
-        else:
-            return ServiceStatus.GOOD
+        return self.state.service_indicator
 
     @staticmethod
     def get_num_submitted_patches_for_id(service_id):
-        service_patches = db.session.query(UploadedPatch).filter_by(service_id=service_id).all()
-        return len(service_patches)
+        return Service.get_patch_counts([service_id]).get(service_id, (0, 0))[0]
 
     @staticmethod
     def get_num_accepted_patches_for_id(service_id):
-        service_patches = db.session.query(UploadedPatch).filter_by(service_id=service_id).all()
-        accepted_patches = 0
-        if service_patches:
-            accepted_patches = sum(map(lambda a: a.results.first().status == PatchStatus.ACCEPTED, service_patches))
-        return accepted_patches
+        return Service.get_patch_counts([service_id]).get(service_id, (0, 0))[1]
+
+    @staticmethod
+    def get_patch_counts(service_ids=None):
+        """
+        Number of submitted patches and of patches whose latest result is ACCEPTED, in one grouped query.
+        :return: dict service_id -> (num_submitted, num_accepted), services without patches are left out.
+        """
+        latest_result = db.session.query(
+            UploadedPatchResult.patch_id,
+            UploadedPatchResult.status,
+            func.row_number().over(partition_by=UploadedPatchResult.patch_id,
+                                   order_by=(UploadedPatchResult.created_on.desc(),
+                                             UploadedPatchResult.id.desc())).label('position'),
+        ).subquery()
+
+        query = db.session.query(
+            UploadedPatch.service_id,
+            func.count(UploadedPatch.id),
+            func.count(latest_result.c.patch_id),
+        ).outerjoin(latest_result, sqlalchemy.and_(latest_result.c.patch_id == UploadedPatch.id,
+                                                   latest_result.c.position == 1,
+                                                   latest_result.c.status == PatchStatus.ACCEPTED))
+        if service_ids is not None:
+            query = query.filter(UploadedPatch.service_id.in_(service_ids))
+        query = query.group_by(UploadedPatch.service_id)
+
+        return {service_id: (num_submitted, num_accepted) for (service_id, num_submitted, num_accepted) in query}
 
     def was_active(self, tick_id):
         """
         Answers the question: was the service active during the given tick?
         """
-
-        # Check the cache first
-        cache = db.session.query(CacheWasServiceActive).filter_by(service_id=self.id,
-                                                                  tick_id=tick_id).first()
-        if cache:
-            return cache.was_active
-
-        result = None
-        active_in_tick = db.session.query(IsActive).filter_by(service_id=self.id, tick_id=tick_id).all()
-        # Handle the case that there were multiple events
-        if active_in_tick:
-            result = all(map(lambda a: a.is_active, active_in_tick))
-        else:
-            # Get the last value
-            last_active = db.session.query(IsActive).filter(IsActive.service_id == self.id,
-                                                            IsActive.tick_id < tick_id).order_by(
-                IsActive.id.desc()).first()
-
-            if last_active:
-                result = last_active.is_active
-            else:
-                # Default is inactive
-                result = False
-
-        if is_tick_old_enough_to_cache(tick_id):
-            cached = CacheWasServiceActive(was_active=result,
-                                           service_id=self.id,
-                                           tick_id=tick_id
-                                           )
-            db.session.add(cached)
-            db.session.commit()
-
-        return result
+        return service_activity.was_active(self.id, tick_id)
 
     @db.validates('flag_location')
     def validate_type_interaction_docker(self, key, flag_location):
@@ -1304,6 +1626,8 @@ class UploadedPatchResult(db.Model):
     private_metadata = db.Column(db.String(256), nullable=True)
     created_on = db.Column(db.DateTime, default=datetime.datetime.now)
 
+    __table_args__ = (db.Index('idx_patch_result_patch_id_created_on', 'patch_id', 'created_on'),)
+
     def to_json(self):
         """
         Return a JSON representation.
@@ -1399,6 +1723,79 @@ class Flag(db.Model):
         )
 
 
+class FlagIndex:
+    """
+    Per-worker index of the flags, used by SubmitFlag.
+
+    Maps flag -> (flag_id, team_id, service_id, tick_id, is_test_team) for all of the flags, the
+    expired ones too, so that telling a TOO_OLD flag from an INCORRECT one does not read the table.
+    GenerateFlag adds to it, and on a miss only the flags that other workers created since the
+    last look (a primary key range) are read before giving up. When the tick rolls over it is
+    emptied if the flags table went back (a reset of the game by another process).
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._flags = {}
+        self._tick_id = None
+        self._max_id = 0
+        self._exploited_service_ids = set()
+
+    def _load(self, query):
+        for (flag_id, flag, team_id, service_id, tick_id, is_test_team) in query:
+            self._flags[flag] = (flag_id, team_id, service_id, tick_id, is_test_team)
+            self._max_id = max(self._max_id, flag_id)
+
+    @staticmethod
+    def _query():
+        return db.session.query(Flag.id, Flag.flag, Flag.team_id, Flag.service_id, Flag.tick_id,
+                                Team.is_test_team).join(Team, Flag.team_id == Team.id)
+
+    def lookup(self, flag, current_tick_id):
+        """
+        :return: the flag's (flag_id, team_id, service_id, tick_id, is_test_team), or None if there is no such flag.
+        """
+        if current_tick_id != self._tick_id:
+            if self._max_id and (db.session.query(func.max(Flag.id)).scalar() or 0) < self._max_id:
+                self.clear()
+            self._tick_id = current_tick_id
+
+        result = self._flags.get(flag)
+        if result is None:
+            self._load(self._query().filter(Flag.id > self._max_id))
+            result = self._flags.get(flag)
+        return result
+
+    def add(self, flag, is_test_team):
+        if self._tick_id is not None:
+            self._flags[flag.flag] = (flag.id, flag.team_id, flag.service_id, flag.tick_id, is_test_team)
+
+    def discard(self, flag):
+        self._flags.pop(flag, None)
+
+    def was_service_exploited(self, service_id):
+        """
+        Has anyone stolen a flag of this service yet? (for the FIRST BLOOD log)
+        """
+        if service_id in self._exploited_service_ids:
+            return True
+        if db.session.query(FlagStolenEvent.id).filter_by(service_id=service_id).first():
+            self._exploited_service_ids.add(service_id)
+            return True
+        return False
+
+
+flag_index = FlagIndex()
+in_process_caches.append(flag_index)
+
+
+@sqlalchemy.event.listens_for(Flag, 'after_delete')
+def receive_flag_after_delete(mapper, connection, target):
+    flag_index.discard(target.flag)
+
+
 class FlagSubmissionResult(enum.Enum):
     CORRECT = 0
     INCORRECT = 1
@@ -1496,11 +1893,239 @@ for klass in db.Model.__subclasses__():
     receive_before_delete = decorator(receive_before_delete)
 
 
+RESPONSE_CACHE_SECONDS = 10
+RESPONSE_CACHE_LOCK_SECONDS = 60
+# how long the responses prepared by precompute_tick are kept, for the bots that ask right after a new tick
+PREPARED_RESPONSE_SECONDS = 60
+RESPONSE_CACHE_POLL_SECONDS = 0.05
+
+
+class ResponseCache:
+    """
+    Responses of the read endpoints, shared by all the worker processes through the RQ Redis.
+
+    An entry is keyed by the path, the query string and the game generation, a counter in Redis that
+    is bumped by every commit writing one of the GENERATION_MODELS, so every worker sees a write on
+    its next request. Entries also expire after RESPONSE_CACHE_SECONDS, for the fields that depend on
+    the time. Only one worker (holding a lock in Redis) computes a missing entry, the others serve
+    the latest entry of an older generation meanwhile (as no-cache, see conditional_response), or wait
+    for it if there is none. If Redis is down every request computes its response.
+
+    The responses prepared by precompute_tick are keyed by the tick instead, so that the writes of the
+    new tick do not throw them away before the bots get to them. They are served (as no-cache) to the
+    requests that ask for that tick with ?tick=N, when there is no entry for the generation.
+
+    Each table of the GENERATION_MODELS also has its own version, bumped with the generation, that
+    the ETags of the endpoints reading only a few tables are made of. The versions start over if Redis
+    is restarted or flushed, so they come with an epoch, a random id stored next to them.
+    """
+
+    PREFIX = "response_cache"
+
+    def _key(self, *parts):
+        return ":".join((self.PREFIX,) + tuple(str(part) for part in parts))
+
+    def clear(self):
+        self.bump_generation(set(model.__tablename__ for model in GENERATION_MODELS))
+
+    def bump_generation(self, tables=()):
+        try:
+            pipeline = rq.connection.pipeline()
+            pipeline.incr(self._key("generation"))
+            for table in tables:
+                pipeline.hincrby(self._key("table_versions"), table, 1)
+            pipeline.execute()
+        except redis.exceptions.RedisError as e:
+            l.warning(f"could not bump the response cache generation exception={e}")
+
+    def table_versions(self, tables):
+        """
+        :return: the epoch followed by the versions of the tables, None if Redis is down.
+        """
+        try:
+            connection = rq.connection
+            pipeline = connection.pipeline()
+            pipeline.get(self._key("epoch"))
+            pipeline.hmget(self._key("table_versions"), tables)
+            epoch, versions = pipeline.execute()
+            if epoch is None:
+                # first use since Redis started empty
+                connection.set(self._key("epoch"), uuid.uuid4().hex, nx=True)
+                epoch = connection.get(self._key("epoch"))
+            return (epoch,) + tuple(int(version or 0) for version in versions)
+        except redis.exceptions.RedisError as e:
+            l.warning(f"could not get the table versions exception={e}")
+            return None
+
+    def prepare(self, tick_id, name, body):
+        """
+        Store the body of the response for name, as of tick_id.
+        """
+        try:
+            rq.connection.set(self._key("tick", tick_id, name), body, ex=PREPARED_RESPONSE_SECONDS)
+        except redis.exceptions.RedisError as e:
+            l.warning(f"could not store the prepared response for name={name} exception={e}")
+
+    def get_or_compute(self, name, compute, tick_id=None):
+        """
+        :param name: what identifies the response besides the generation.
+        :param compute: returns the response (only a 200 is cached).
+        :param tick_id: the tick of the prepared response that may be served.
+        """
+        try:
+            connection = rq.connection
+            generation = int(connection.get(self._key("generation")) or 0)
+            key = self._key(generation, name)
+            body = connection.get(key)
+            if body is not None:
+                return Response(body, mimetype="application/json")
+
+            if tick_id is not None:
+                prepared = connection.get(self._key("tick", tick_id, name))
+                if prepared is not None:
+                    # from before the writes of this tick
+                    return Response(prepared, mimetype="application/json", headers={'Cache-Control': 'no-cache'})
+
+            lock_key = self._key("lock", name)
+            if not connection.set(lock_key, generation, nx=True, ex=RESPONSE_CACHE_LOCK_SECONDS):
+                # another worker is on it
+                stale = connection.get(self._key("latest", name))
+                if stale is not None:
+                    # not what the ETag of this request stands for
+                    return Response(stale, mimetype="application/json", headers={'Cache-Control': 'no-cache'})
+                deadline = time.monotonic() + RESPONSE_CACHE_LOCK_SECONDS
+                while time.monotonic() < deadline:
+                    time.sleep(RESPONSE_CACHE_POLL_SECONDS)
+                    body = connection.get(key)
+                    if body is not None:
+                        return Response(body, mimetype="application/json")
+                    if not connection.exists(lock_key):
+                        break
+                lock_key = None
+        except redis.exceptions.RedisError as e:
+            l.warning(f"response cache unavailable for name={name} exception={e}")
+            return compute()
+
+        try:
+            response = compute()
+            if response.status_code == 200:
+                body = response.get_data()
+                pipeline = connection.pipeline()
+                pipeline.set(key, body, ex=RESPONSE_CACHE_SECONDS)
+                pipeline.set(self._key("latest", name), body, ex=RESPONSE_CACHE_LOCK_SECONDS)
+                pipeline.execute()
+            return response
+        except redis.exceptions.RedisError as e:
+            l.warning(f"could not store the response for name={name} exception={e}")
+            return response
+        finally:
+            if lock_key is not None:
+                try:
+                    connection.delete(lock_key)
+                except redis.exceptions.RedisError:
+                    pass
+
+
+response_cache = ResponseCache()
+in_process_caches.append(response_cache)
+
+# The tables that the cached responses are made of
+GENERATION_MODELS = (Tick, TickTime, Team, FlagStolenEvent, StealthEvent, KohRankingEvent, KohRankResult,
+                     Service, ServiceState, IsActive, IsVisible, ReleasePcaps, StatusIndicator, ExploitScriptPath,
+                     SlaScriptPath, LocalInteractionScriptPath, TestScriptPath, UploadedPatch, UploadedPatchResult)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_flush')
+def receive_generation_flush(session, flush_context):
+    tables = set(type(instance).__tablename__
+                 for instance in itertools.chain(session.new, session.dirty, session.deleted)
+                 if isinstance(instance, GENERATION_MODELS))
+    if tables:
+        session.info.setdefault('bump_tables', set()).update(tables)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_commit')
+def receive_generation_commit(session):
+    tables = session.info.pop('bump_tables', None)
+    if tables:
+        response_cache.bump_generation(tables)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_soft_rollback')
+def receive_generation_rollback(session, previous_transaction):
+    session.info.pop('bump_tables', None)
+
+
+def conditional_response(validator, weak=False):
+    """
+    ETag for the endpoint, from what validator(**url_arguments) returns (the latest row ids or table
+    versions the response is made of, None for no ETag): a matching If-None-Match is answered with a 304
+    before the endpoint runs.
+    :param weak: the response also has fields that change with the time (estimated time remaining), so
+                 the ETag is weak: a 304 only says the data is the same.
+    A no-cache response (an older body from the response cache) gets no ETag.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            values = validator(**kwargs)
+            if values is None:
+                return f(*args, **kwargs)
+
+            etag = hashlib.sha1(repr((request.full_path, values)).encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag, weak=weak)
+                return response
+
+            response = f(*args, **kwargs)
+            if response.status_code == 200 and not response.cache_control.no_cache:
+                response.set_etag(etag, weak=weak)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def table_versions_of(*models):
+    """
+    An ETag validator (see conditional_response) from the versions of the tables of the models.
+    """
+    tables = [model.__tablename__ for model in models]
+    return lambda **kwargs: response_cache.table_versions(tables)
+
+
+def response_cache_name():
+    """
+    The name of the response to the current request in the response cache: the path and the sorted query string,
+    without ?tick=N.
+    """
+    return request.path + "?" + "&".join(sorted(argument for argument in request.query_string.decode().split("&")
+                                                if not argument.startswith("tick=")))
+
+
+def cached_response(f):
+    """
+    Serve the (JSON) response of the endpoint from the response cache. With ?tick=N the response prepared by
+    precompute_tick for tick N may be served (the endpoint itself ignores it).
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return response_cache.get_or_compute(response_cache_name(), lambda: f(*args, **kwargs),
+                                             tick_id=request.args.get('tick', type=int))
+
+    return wrapper
+
+
 class TeamList(Resource):
     """
     Team list.
     """
 
+    @conditional_response(table_versions_of(Team))
     def get(self):
         """
         GET callback.
@@ -1527,11 +2152,87 @@ class TeamInfo(Resource):
     Info on one team.
     """
 
+    @conditional_response(table_versions_of(Team))
     def get(self, team_id):
         team = db.session.query(Team).get(team_id)
         return jsonify(team.to_json())
 
 
+class TeamNetworkIndex:
+    """
+    In-process longest-prefix-match index of the teams' addresses: team_network, and vm_address as a host route.
+
+    For every (IP version, prefix length) a dict maps the network address to the team id, so a lookup is one
+    dict probe per distinct prefix length, longest first. It is rebuilt when this process writes a Team, and
+    when the number of teams, the highest team id or the version of the teams table in the response cache
+    (bumped by every commit writing a Team, in any worker) changes. That is checked at most once per request,
+    and on every call outside of a request.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._prefixes = None
+        self._fingerprint = None
+
+    def refresh(self):
+        if self._prefixes is not None and has_request_context():
+            if g.get('team_networks_checked'):
+                return
+            g.team_networks_checked = True
+
+        fingerprint = (tuple(db.session.query(func.count(Team.id), func.max(Team.id)).one()),
+                       response_cache.table_versions([Team.__tablename__]))
+        if self._prefixes is not None and fingerprint == self._fingerprint:
+            return
+
+        prefixes = collections.defaultdict(dict)
+        for (team_id, team_network, vm_address) in \
+                db.session.query(Team.id, Team.team_network, Team.vm_address).order_by(Team.id):
+            for network in (team_network, vm_address):
+                try:
+                    network = ipaddress.ip_network(network, strict=False)
+                except ValueError:
+                    l.warning(f"team_id={team_id} has an invalid network {network}, ignoring it")
+                    continue
+                prefixes[(network.version, network.prefixlen)].setdefault(int(network.network_address), team_id)
+
+        self._prefixes = []
+        for ((version, prefixlen), networks) in sorted(prefixes.items(), key=lambda item: item[0][1], reverse=True):
+            bits = 32 if version == 4 else 128
+            mask = ((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1)
+            self._prefixes.append((version, mask, networks))
+        self._fingerprint = fingerprint
+
+    def team_id(self, address):
+        """
+        :return: the id of the team with the most specific network containing the address, or None.
+        """
+        self.refresh()
+        address_int = int(address)
+        for (version, mask, networks) in self._prefixes:
+            if version == address.version:
+                team_id = networks.get(address_int & mask)
+                if team_id is not None:
+                    return team_id
+        return None
+
+
+team_networks = TeamNetworkIndex()
+in_process_caches.append(team_networks)
+
+
+@sqlalchemy.event.listens_for(Team, 'after_insert')
+@sqlalchemy.event.listens_for(Team, 'after_update')
+@sqlalchemy.event.listens_for(Team, 'after_delete')
+def receive_team_change(mapper, connection, target):
+    team_networks.clear()
+
+
+MAX_IPS_PER_BATCH = 1000
+
+
 class TeamFromIP(Resource):
     """
     Return the team that corresponds to a specific IP address or None.
@@ -1539,14 +2240,27 @@ class TeamFromIP(Resource):
 
     def get(self, ip):
         address = ipaddress.ip_address(ip)
-        team_id = None
-        for team in db.session.query(Team):
-            team_network = ipaddress.ip_network(team.team_network)
-            if address in team_network:
-                team_id = team.id
-                break
+        return jsonify(dict(team_id=team_networks.team_id(address)))
+
+
+class TeamFromIPBatch(Resource):
+    """
+    Return the team of each IP address (repeated ip form fields) in order, None for unknown or invalid addresses.
+    """
 
-        return jsonify(dict(team_id=team_id))
+    def post(self):
+        ips = request.form.getlist("ip")
+        if len(ips) > MAX_IPS_PER_BATCH:
+            abort(400, message=f"cannot look up more than {MAX_IPS_PER_BATCH} addresses at once")
+
+        results = []
+        for ip in ips:
+            try:
+                team_id = team_networks.team_id(ipaddress.ip_address(ip))
+            except ValueError:
+                team_id = None
+            results.append(dict(ip=ip, team_id=team_id))
+        return jsonify(dict(teams=results))
 
 
 class PatchInfo(Resource):
@@ -1567,6 +2281,7 @@ class TeamUploadedPatchInfo(Resource):
     Team Uploaded Patch Info.
     """
 
+    @conditional_response(table_versions_of(UploadedPatch, UploadedPatchResult))
     def get(self, team_id):
         team_patches = db.session.query(UploadedPatch).filter_by(team_id=team_id)
         return jsonify(patches=[tp.to_json() for tp in team_patches])
@@ -1646,6 +2361,19 @@ class NewPatchStatus(Resource):
         return jsonify(result.to_json())
 
 
+def is_well_formed_flag(flag):
+    """
+    Could this be a flag generated by GenerateFlag with the current settings?
+    """
+    prefix = app.config["FLAG_PREFIX"]
+    suffix = app.config["FLAG_SUFFIX"]
+    if len(flag) != len(prefix) + app.config["FLAG_LENGTH"] + len(suffix):
+        return False
+    if not (flag.startswith(prefix) and flag.endswith(suffix)):
+        return False
+    return all(c in app.config["FLAG_ALPHABET"] for c in flag[len(prefix):len(flag) - len(suffix)])
+
+
 class GenerateFlag(Resource):
     """
     Generate a flag for the given service and team
@@ -1687,10 +2415,54 @@ class GenerateFlag(Resource):
                     )
         db.session.add(flag)
         db.session.commit()
+        flag_index.add(flag, team.is_test_team)
 
         return jsonify(flag.to_json())
 
 
+class GenerateTickFlags(Resource):
+    """
+    Generate the flags of the current tick for every active NORMAL service and every team (not test teams)
+    """
+
+    def post(self):
+        tick = Tick.get_current_tick()
+        if not tick:
+            abort(400, message="there is no tick, can't generate a flag")
+
+        team_ids = [team_id for (team_id,) in
+                    db.session.query(Team.id).filter(Team.is_test_team == False).order_by(Team.id)]
+        service_ids = [service.id for service in
+                       db.session.query(Service).filter(Service.type == ServiceType.NORMAL).order_by(Service.id)
+                       if service.is_active]
+
+        flags = []
+        if team_ids and service_ids:
+            # If there's already a flag for this team, service, tick, then keep that one
+            existing = {(flag.team_id, flag.service_id) for flag in
+                        db.session.query(Flag.team_id, Flag.service_id).filter(Flag.tick_id == tick.id,
+                                                                              Flag.service_id.in_(service_ids))}
+            generate = GenerateFlag()
+            new_flags = [dict(team_id=team_id, service_id=service_id, tick_id=tick.id,
+                              flag=generate._generate_new_flag())
+                         for team_id in team_ids
+                         for service_id in service_ids
+                         if (team_id, service_id) not in existing]
+            if new_flags:
+                db.session.bulk_insert_mappings(Flag, new_flags)
+                db.session.commit()
+
+            flags = db.session.query(Flag).filter(Flag.tick_id == tick.id,
+                                                  Flag.service_id.in_(service_ids),
+                                                  Flag.team_id.in_(team_ids)).order_by(Flag.team_id,
+                                                                                       Flag.service_id).all()
+            if new_flags:
+                for flag in flags:
+                    flag_index.add(flag, False)
+
+        return jsonify(dict(tick=tick.id, flags=[flag.to_json() for flag in flags]))
+
+
 class GetLatestFlag(Resource):
     """
     Get the last valid flag for the service
@@ -1714,6 +2486,55 @@ class FlagsForTick(Resource):
         return jsonify([f.to_json() for f in flags])
 
 
+MAX_FLAGS_PER_BATCH = 1000
+
+
+def judge_flag_submission(flag_submission, flag, service, tick_id):
+    """
+    Set the result of a submission of the known flag (flag_id, team_id, service_id, tick_id, is_test_team).
+
+    :return: the FlagStolenEvent to record if the flag was stolen, else None.
+    """
+    flag_id, victim_team_id, service_id, flag_tick_id, is_victim_test_team = flag
+    team_id = flag_submission.team_id
+
+    # is it their own flag?
+    if victim_team_id == team_id:
+        flag_submission.result = FlagSubmissionResult.OWN_FLAG
+        return None
+    # is it the test team's flag
+    if is_victim_test_team:
+        flag_submission.result = FlagSubmissionResult.TEST_TEAM_FLAG
+        return None
+    if (flag_tick_id + NUM_TICKS_FLAG_VALID_FOR) < tick_id:
+        flag_submission.result = FlagSubmissionResult.TOO_OLD
+        return None
+
+    # Correct!
+    flag_submission.result = FlagSubmissionResult.CORRECT
+    flag_submission.flag_id = flag_id
+    # Was this the first team to exploit this service?
+    if not flag_index.was_service_exploited(service_id):
+        exploit_team_name = json.dumps(Team.get_team_name(team_id))
+        victim_team_name = json.dumps(Team.get_team_name(victim_team_id))
+        l.info(
+            f"FIRST BLOOD: service_id={service_id} service_name={service.name} exploit_team_id={team_id} exploit_team_name={exploit_team_name} victim_team_name={victim_team_name} victim_team_id={victim_team_id}")
+
+    # Create the event
+    # Important: the flagstolenevent's tick_id is when the flag was created. Hopefully this won't cause
+    #            problems in the future
+    return FlagStolenEvent(event_type=EventType.FLAG_STOLEN.value,
+                           reason="Team {} stole flag from team {} for service {}".format(team_id,
+                                                                                          victim_team_id,
+                                                                                          service_id),
+                           tick_id=flag_tick_id,
+                           exploit_team_id=team_id,
+                           victim_team_id=victim_team_id,
+                           service_id=service_id,
+                           flag_id=flag_id,
+                           )
+
+
 class SubmitFlag(Resource):
     """
     Submit a flag
@@ -1739,56 +2560,26 @@ class SubmitFlag(Resource):
             # since this was already submitted we don't store it
             return jsonify(dict(result=FlagSubmissionResult.ALREADY_SUBMITTED.name))
 
-        flag_submission = FlagSubmission(submission=the_flag, team_id=team_id)
+        flag_submission = FlagSubmission(submission=the_flag, team_id=team_id, tick_id=tick.id)
 
-        # is the flag valid?
-        flags = db.session.query(Flag).filter(Flag.flag == the_flag).all()
+        # is the flag valid? Malformed guesses never get to the database, and the flags (old ones too)
+        # are in the index.
+        flag = None
+        if is_well_formed_flag(the_flag):
+            flag = flag_index.lookup(the_flag, tick.id)
 
-        if len(flags) == 0:
+        if flag is None:
             flag_submission.result = FlagSubmissionResult.INCORRECT
-        elif len(flags) > 1:
-            abort(500, message="error with flag submissions, got too many")
         else:
-            flag = flags[0]
+            service = db.session.query(Service).get(flag[2])
 
             # is the service active?
-            if not flag.service.is_active:
+            if not service.is_active:
                 db.session.rollback()
                 return jsonify(dict(result=FlagSubmissionResult.SERVICE_INACTIVE.name))
 
-            # is it their own flag?
-            if flag.team.id == team.id:
-                flag_submission.result = FlagSubmissionResult.OWN_FLAG
-            # is it the test team's flag
-            elif flag.team.is_test_team == True:
-                flag_submission.result = FlagSubmissionResult.TEST_TEAM_FLAG
-            elif (flag.tick_id + NUM_TICKS_FLAG_VALID_FOR) < Tick.get_current_tick_id():
-                flag_submission.result = FlagSubmissionResult.TOO_OLD
-            else:
-                # Correct!
-                flag_submission.result = FlagSubmissionResult.CORRECT
-                flag_submission.flag_id = flag.id
-                # Was this the first team to exploit this service?
-                prior_exploitation = db.session.query(FlagStolenEvent).filter_by(service_id=flag.service.id).first()
-                if not prior_exploitation:
-                    exploit_team_name = json.dumps(Team.get_team_name(team_id))
-                    victim_team_name = json.dumps(Team.get_team_name(flag.team.id))
-                    l.info(
-                        f"FIRST BLOOD: service_id={flag.service.id} service_name={flag.service.name} exploit_team_id={team_id} exploit_team_name={exploit_team_name} victim_team_name={victim_team_name} victim_team_id={flag.team.id}")
-
-                # Create the event
-                # Important: the flagstolenevent's tick_id is when the flag was created. Hopefully this won't cause
-                #            problems in the future
-                event = FlagStolenEvent(event_type=EventType.FLAG_STOLEN.value,
-                                        reason="Team {} stole flag from team {} for service {}".format(team_id,
-                                                                                                       flag.team.id,
-                                                                                                       flag.service.id),
-                                        tick_id=flag.tick.id,
-                                        exploit_team_id=team_id,
-                                        victim_team_id=flag.team.id,
-                                        service_id=flag.service.id,
-                                        flag_id=flag.id,
-                                        )
+            event = judge_flag_submission(flag_submission, flag, service, tick.id)
+            if event:
                 db.session.add(event)
 
         db.session.add(flag_submission)
@@ -1796,11 +2587,90 @@ class SubmitFlag(Resource):
         return jsonify(flag_submission.to_json())
 
 
+class SubmitFlagBatch(Resource):
+    """
+    Submit many flags (repeated flag form fields) at once, with a result for each of them in order
+    """
+
+    def post(self, team_id: int):
+        team = db.session.query(Team).get(team_id)
+        if not team:
+            abort(400, message="invalid team id")
+
+        the_flags = [f for f in request.form.getlist("flag") if f]
+        if not the_flags:
+            abort(400, message="must submit a flag")
+        if len(the_flags) > MAX_FLAGS_PER_BATCH:
+            abort(400, message=f"cannot submit more than {MAX_FLAGS_PER_BATCH} flags at once")
+
+        tick = Tick.get_current_tick()
+        if not tick:
+            abort(400, message="Cannot submit flag without a tick")
+
+        submitted = set(the_flags)
+        already_submitted = {submission for (submission,) in
+                             db.session.query(FlagSubmission.submission).filter(
+                                 FlagSubmission.team_id == team_id,
+                                 FlagSubmission.submission.in_(submitted))}
+
+        candidates = {f for f in submitted if f not in already_submitted and is_well_formed_flag(f)}
+        flags = {}
+        if candidates:
+            for (flag_id, the_flag, victim_team_id, service_id, flag_tick_id, is_test_team) in \
+                    db.session.query(Flag.id, Flag.flag, Flag.team_id, Flag.service_id, Flag.tick_id,
+                                     Team.is_test_team).join(Team, Flag.team_id == Team.id).filter(
+                        Flag.flag.in_(candidates)):
+                flags[the_flag] = (flag_id, victim_team_id, service_id, flag_tick_id, is_test_team)
+
+        services = {}
+        service_ids = {flag[2] for flag in flags.values()}
+        if service_ids:
+            services = {service.id: service for service in
+                        db.session.query(Service).filter(Service.id.in_(service_ids))}
+
+        results = []
+        for the_flag in the_flags:
+            if the_flag in already_submitted:
+                # since this was already submitted we don't store it
+                results.append(dict(flag=the_flag, result=FlagSubmissionResult.ALREADY_SUBMITTED.name))
+                continue
+
+            flag = flags.get(the_flag)
+            if flag is not None and not services[flag[2]].is_active:
+                results.append(dict(flag=the_flag, result=FlagSubmissionResult.SERVICE_INACTIVE.name))
+                continue
+
+            flag_submission = FlagSubmission(submission=the_flag, team_id=team_id, tick_id=tick.id)
+            if flag is None:
+                flag_submission.result = FlagSubmissionResult.INCORRECT
+            else:
+                event = judge_flag_submission(flag_submission, flag, services[flag[2]], tick.id)
+                if event:
+                    db.session.add(event)
+            db.session.add(flag_submission)
+            already_submitted.add(the_flag)
+            results.append(dict(flag=the_flag, result=flag_submission.result.name))
+
+        db.session.commit()
+        return jsonify(dict(results=results))
+
+
+def current_game_state_ids(**kwargs):
+    """
+    The ids of the latest game state, tick, tick time, is_game_state_public and game_state_delay rows
+    (and when the tick was created, as the ids start over when the tables are reset).
+    """
+    latest = [db.session.query(func.max(model.id)).as_scalar()
+              for model in (GameState, Tick, TickTime, IsGameStatePublic, GameStateDelay)]
+    return db.session.query(*latest, db.session.query(func.max(Tick.created_on)).as_scalar()).one()
+
+
 class StateOfTheGame(Resource):
     """
     functions to get the current game state
     """
 
+    @conditional_response(current_game_state_ids, weak=True)
     def get(self):
         current_state = GameState.get_current_state()
 
@@ -1839,6 +2709,7 @@ class StateOfTheGame(Resource):
             gs = GameState(state=state)
             db.session.add(gs)
             db.session.commit()
+            publish_game_change()
         except KeyError as e:
             abort(400, message="invalid state type, must be one of {}".format(" ".join(State.__members__.keys())))
 
@@ -1858,12 +2729,167 @@ class StartGame(Resource):
         db.session.add(gs)
         db.session.add(tick)
         db.session.commit()
+        publish_game_change()
 
         return jsonify(dict(
             tick=tick.id,
         ))
 
 
+GAME_CHANNEL = "game"
+MAX_WAIT_TICK_SECONDS = 60
+# under the nginx uwsgi_read_timeout
+MAX_GAME_EVENTS_SECONDS = 280
+GAME_EVENTS_KEEPALIVE_SECONDS = 15
+# how often the tick is checked when Redis is down
+WAIT_TICK_POLL_SECONDS = 1
+
+
+def publish_game_change():
+    """
+    Wake up the wait_tick and game events requests of every worker, after a new tick or game state is committed.
+    """
+    try:
+        rq.connection.publish(GAME_CHANNEL, "changed")
+    except redis.exceptions.RedisError as e:
+        l.warning(f"could not publish the game change exception={e}")
+
+
+def latest_game_change():
+    """
+    The current tick and game state, as committed by any worker.
+    """
+    # end the transaction, a long request would keep seeing its snapshot
+    db.session.rollback()
+    try:
+        tick_id = db.session.query(func.max(Tick.id)).scalar()
+        return dict(tick=tick_id, state=GameState.get_current_state().state.name)
+    finally:
+        # the connection goes back to the pool while the request waits
+        db.session.close()
+
+
+class GameChangeListener:
+    """
+    Waits for publish_game_change on the Redis channel, or sleeps WAIT_TICK_POLL_SECONDS without Redis.
+    """
+
+    def __init__(self):
+        try:
+            self._pubsub = rq.connection.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(GAME_CHANNEL)
+        except redis.exceptions.RedisError as e:
+            l.warning(f"could not subscribe to the game changes, polling exception={e}")
+            self._pubsub = None
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self._pubsub is not None and time.monotonic() < deadline:
+            try:
+                # None is the timeout, or the (ignored) subscribe confirmation
+                if self._pubsub.get_message(timeout=deadline - time.monotonic()) is not None:
+                    return
+            except redis.exceptions.RedisError as e:
+                l.warning(f"lost the game changes subscription, polling exception={e}")
+                self._pubsub = None
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(min(remaining, WAIT_TICK_POLL_SECONDS))
+
+    def close(self):
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except redis.exceptions.RedisError:
+                pass
+
+
+class WaitTick(Resource):
+    """
+    Block until there is a tick after ?after=N (or ?timeout=S seconds pass), then return the current tick and state.
+    """
+
+    def get(self):
+        after = request.args.get('after', type=int)
+        if after is None:
+            abort(400, message="must give the tick to wait after")
+        timeout = min(request.args.get('timeout', default=MAX_WAIT_TICK_SECONDS, type=float), MAX_WAIT_TICK_SECONDS)
+        deadline = time.monotonic() + timeout
+
+        # subscribe before looking at the tick, so that none is missed in between
+        listener = GameChangeListener()
+        try:
+            while True:
+                change = latest_game_change()
+                if (change['tick'] or 0) > after or time.monotonic() >= deadline:
+                    return jsonify(change)
+                listener.wait(deadline - time.monotonic())
+        finally:
+            listener.close()
+
+
+class GameEvents(Resource):
+    """
+    Server-sent events of the game changes: a game_state event with the current tick and state at first and after
+    every change, for ?timeout=S seconds (at most MAX_GAME_EVENTS_SECONDS, EventSource reconnects on its own).
+    """
+
+    def get(self):
+        timeout = min(request.args.get('timeout', default=MAX_GAME_EVENTS_SECONDS, type=float),
+                      MAX_GAME_EVENTS_SECONDS)
+        deadline = time.monotonic() + timeout
+
+        def generate():
+            listener = GameChangeListener()
+            try:
+                last_change = None
+                while True:
+                    change = latest_game_change()
+                    if change != last_change:
+                        yield f"event: game_state\ndata: {json.dumps(change)}\n\n"
+                        last_change = change
+                    else:
+                        yield ": keepalive\n\n"
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    listener.wait(min(remaining, GAME_EVENTS_KEEPALIVE_SECONDS))
+            finally:
+                listener.close()
+
+        return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+TICK_QUEUE = 'tick'
+
+
+def precompute_tick(tick_id):
+    """
+    RQ job enqueued by NewTick: finalize the ticks that left the flag validity window with tick_id, and
+    prepare the scores and the public game state of tick_id in the response cache, before the bots ask for them:
+    the full game state, and the one since the tick that gamestatebot asks for when it kept up (it refetches the
+    REFETCH_TICKS ticks before the current tick of its previous game state).
+    """
+    with app.app_context():
+        finalized = db.session.query(FinalizedTick.tick_id)
+        tick_ids = [old_tick_id for (old_tick_id,) in
+                    db.session.query(Tick.id).filter(Tick.id + NUM_TICKS_FLAG_VALID_FOR < tick_id,
+                                                     ~Tick.id.in_(finalized))]
+        for old_tick_id, result in calculate_live_scores_for_ticks(db, tick_ids).items():
+            finalize_tick(db, old_tick_id, result['teams'])
+        l.info(f"PRECOMPUTE TICK: tick_id={tick_id} num_finalized={len(tick_ids)}")
+
+        since_tick = max(0, tick_id - 1 - REFETCH_TICKS)
+        for (path, resource) in (("/api/v1/scores", ScoreList), ("/api/v1/visualization", Visualization),
+                                 (f"/api/v1/visualization?since_tick={since_tick}", Visualization)):
+            with app.test_request_context(path):
+                # the endpoint itself, without the response cache
+                response = inspect.unwrap(resource.get)(resource())
+                if response.status_code == 200:
+                    response_cache.prepare(tick_id, response_cache_name(), response.get_data())
+
+
 class NewTick(Resource):
     """
     advance the game state to a new tick!
@@ -1874,6 +2900,11 @@ class NewTick(Resource):
         db.session.add(tick)
         db.session.commit()
         l.info(f"NEW TICK: new_tick={tick.id}")
+        publish_game_change()
+        try:
+            rq.get_queue(TICK_QUEUE).enqueue(precompute_tick, tick.id)
+        except redis.exceptions.RedisError as e:
+            l.warning(f"could not enqueue the precompute of tick_id={tick.id} exception={e}")
         return jsonify(dict(
             tick=tick.id,
         ))
@@ -1925,13 +2956,23 @@ class ChangeGameStateDelay(Resource):
         return jsonify(id=game_state_delay.id)
 
 
+# what the JSON of a service is made of
+SERVICE_MODELS = (Service, ServiceState, IsActive, IsVisible, ReleasePcaps, StatusIndicator, ExploitScriptPath,
+                  SlaScriptPath, LocalInteractionScriptPath, TestScriptPath)
+
+
 class ServiceList(Resource):
     """
     Get the list of services.
     """
 
+    @conditional_response(table_versions_of(*SERVICE_MODELS))
+    @cached_response
     def get(self):
-        services = db.session.query(Service).all()
+        services = db.session.query(Service).options(selectinload(Service.exploit_scripts),
+                                                     selectinload(Service.sla_scripts),
+                                                     selectinload(Service.local_interaction_scripts),
+                                                     selectinload(Service.test_scripts)).all()
         return jsonify(dict(
             services=[service.to_json() for service in services]
         ))
@@ -1942,6 +2983,7 @@ class ServiceInfo(Resource):
     Get the info for a specific service.
     """
 
+    @conditional_response(table_versions_of(*SERVICE_MODELS))
     def get(self, service_id):
         service = db.session.query(Service).get(service_id)
         return jsonify(service.to_json())
@@ -1955,9 +2997,7 @@ class ReleaseServicePcaps(Resource):
     def post(self, service_id, value):
         if not (1 == value or 0 == value):
             abort(400, message="error, value must be either 0 or 1")
-        release_pcaps = ReleasePcaps(service_id=service_id, release_pcaps=value == 1)
-        db.session.add(release_pcaps)
-        db.session.commit()
+        release_pcaps = ServiceState.record(ReleasePcaps, service_id, release_pcaps=value == 1)
 
         return jsonify(id=release_pcaps.id)
 
@@ -1970,9 +3010,8 @@ class ServiceIsActive(Resource):
     def post(self, service_id, value):
         if not (1 == value or 0 == value):
             abort(400, message="error, value must be either 0 or 1")
-        is_active = IsActive(service_id=service_id, is_active=value == 1)
-        db.session.add(is_active)
-        db.session.commit()
+        is_active = ServiceState.record(IsActive, service_id, is_active=value == 1)
+        service_activity.refresh(force=True)
 
         return jsonify(id=is_active.id)
 
@@ -1985,9 +3024,7 @@ class ServiceIsVisible(Resource):
     def post(self, service_id, value):
         if not (1 == value or 0 == value):
             abort(400, message="error, value must be either 0 or 1")
-        is_visible = IsVisible(service_id=service_id, is_visible=value == 1)
-        db.session.add(is_visible)
-        db.session.commit()
+        is_visible = ServiceState.record(IsVisible, service_id, is_visible=value == 1)
 
         return jsonify(id=is_visible.id)
 
@@ -2004,9 +3041,7 @@ class SetServiceIndicator(Resource):
             abort(400, message="invalid service indicator, must be one of {}".format(
                 " ".join(ServiceStatus.__members__.keys())))
 
-        indicator = StatusIndicator(service_status=new_state, service_id=service_id)
-        db.session.add(indicator)
-        db.session.commit()
+        indicator = ServiceState.record(StatusIndicator, service_id, service_status=new_state)
 
         service = db.session.query(Service).get(service_id)
         service_name = json.dumps(service.name)
@@ -2029,22 +3064,121 @@ class SetServiceProfile(Resource):
         db.session.commit()
 
 
-class ScoreType(enum.Enum):
-    ATTACK = 0
-    DEFENSE = 1
-    KING_OF_THE_HILL = 2
+def _empty_team_score(team_id):
+    return {"id": team_id,
+            ScoreType.ATTACK.name: 0,
+            ScoreType.DEFENSE.name: 0,
+            ScoreType.KING_OF_THE_HILL.name: 0,
+            "service_attack": {},
+            "koh_points_by_service": {}
+            }
+
+
+def _ledger_points(points):
+    # Keep the JSON identical to the live calculation (1 rather than 1.0)
+    return int(points) if points.is_integer() else points
+
+
+def scores_from_ledger(db, tick_ids, teams=None):
+    """
+    Read the scores of finalized ticks from the tick_scores ledger.
+    :return: dict of tick_id -> the same dict that calculate_scores returns.
+    """
+    if teams is None:
+        teams = db.session.query(Team).all()
+    team_ids = [t.id for t in teams if not t.is_test_team]
+
+    to_return = {}
+    for tick_id in tick_ids:
+        to_return[tick_id] = dict(tick_id=tick_id,
+                                  teams={team_id: _empty_team_score(team_id) for team_id in team_ids})
+    if not tick_ids:
+        return to_return
+
+    rows = db.session.query(TickScore).filter(TickScore.tick_id.in_(tick_ids)).order_by(TickScore.id)
+    for row in rows:
+        team_score = to_return[row.tick_id]['teams'].get(row.team_id)
+        if team_score is None:
+            continue
+        points = _ledger_points(row.points)
+        team_score[row.score_type.name] += points
+        if row.score_type == ScoreType.ATTACK:
+            team_score["service_attack"].setdefault(row.service_id, []).append(points)
+        elif row.score_type == ScoreType.DEFENSE:
+            team_score.setdefault("service_defense", []).append(row.service_id)
+        else:
+            team_score["koh_points_by_service"][row.service_id] = points
+
+    return to_return
+
+
+def finalize_tick(db, tick_id, team_scores):
+    """
+    Write the scores of a tick that is old enough to the ledger, once.
+    Another worker may beat us to it, in which case the ledger already has the rows.
+    """
+    rows = []
+    for team_id, team_score in team_scores.items():
+        for service_id, attack_scores in team_score["service_attack"].items():
+            for points in attack_scores:
+                rows.append(dict(tick_id=tick_id, team_id=team_id, service_id=service_id,
+                                 score_type=ScoreType.ATTACK, points=points))
+        for service_id in team_score.get("service_defense", []):
+            rows.append(dict(tick_id=tick_id, team_id=team_id, service_id=service_id,
+                             score_type=ScoreType.DEFENSE, points=1))
+        for service_id, points in team_score["koh_points_by_service"].items():
+            rows.append(dict(tick_id=tick_id, team_id=team_id, service_id=service_id,
+                             score_type=ScoreType.KING_OF_THE_HILL, points=points))
+
+    try:
+        db.session.add(FinalizedTick(tick_id=tick_id))
+        db.session.flush()
+        db.session.bulk_insert_mappings(TickScore, rows)
+        db.session.commit()
+        l.info(f"FINALIZED TICK: tick_id={tick_id} num_scores={len(rows)}")
+    except sqlalchemy.exc.IntegrityError:
+        db.session.rollback()
 
 
 def calculate_scores(db, tick_id):
     """
     For a given tick, calculate the scores of all the teams, based on the scoring algorithm.
-    TODO: move this into a separate module.
+    Finalized ticks are read from the ledger, and ticks that just became old enough are finalized.
+    """
+
+    if db.session.query(FinalizedTick).get(tick_id):
+        return scores_from_ledger(db, [tick_id])[tick_id]
+
+    result = calculate_live_scores(db, tick_id)
+    if is_tick_old_enough_to_cache(tick_id):
+        finalize_tick(db, tick_id, result['teams'])
+    return result
+
+
+def calculate_all_scores(db, since_tick=None):
     """
+    Scores for every tick (after since_tick, if given): finalized ticks come from the
+    ledger (one query), only the ticks still inside the flag validity window are calculated
+    (all together, by calculate_live_scores_for_ticks).
+    """
+    tick_query = db.session.query(Tick.id).order_by(Tick.id)
+    if since_tick is not None:
+        tick_query = tick_query.filter(Tick.id > since_tick)
+    tick_ids = [tick_id for (tick_id,) in tick_query]
+    finalized = set(tick_id for (tick_id,) in db.session.query(FinalizedTick.tick_id))
+    from_ledger = scores_from_ledger(db, [tick_id for tick_id in tick_ids if tick_id in finalized])
+    live = calculate_live_scores_for_ticks(db, [tick_id for tick_id in tick_ids if tick_id not in finalized])
+    for tick_id, result in live.items():
+        if is_tick_old_enough_to_cache(tick_id):
+            finalize_tick(db, tick_id, result['teams'])
+    return [from_ledger[tick_id] if tick_id in from_ledger else live[tick_id] for tick_id in tick_ids]
 
-    # cache = db.session.query(CacheTickScores).filter_by(tick_id=tick_id).first()
-    # if cache:
-    #     return dict(tick_id=tick_id,
-    #                 teams=json.loads(cache.score_json))
+
+def calculate_live_scores(db, tick_id):
+    """
+    For a given tick, calculate the scores of all the teams from the raw events.
+    TODO: move this into a separate module.
+    """
 
     teams = db.session.query(Team).all()
     services = db.session.query(Service).all()
@@ -2075,13 +3209,7 @@ def calculate_scores(db, tick_id):
             test_teams.add(team.id)
             continue  # skip over the test teams when displaying score
 
-        to_return[team.id] = {"id": team.id,
-                              ScoreType.ATTACK.name: 0,
-                              ScoreType.DEFENSE.name: 0,
-                              ScoreType.KING_OF_THE_HILL.name: 0,
-                              "service_attack": {},
-                              "koh_points_by_service": {}
-                              }
+        to_return[team.id] = _empty_team_score(team.id)
         was_team_exploited[team.id] = initial_service_mapping.copy()
 
     stealthy_tuples = set((e.src_team_id, e.dst_team_id, e.service_id) for e in stealth_events)
@@ -2173,25 +3301,124 @@ def calculate_scores(db, tick_id):
     # pytype: enable=attribute-error
     # pytype: enable=unsupported-operands
 
-    # do we want to cache that result?
-    if is_tick_old_enough_to_cache(tick_id):
-        cached = CacheTickScores(score_json=json.dumps(to_return),
-                                 tick_id=tick_id)
-        db.session.add(cached)
-        db.session.commit()
-
     return dict(tick_id=tick_id,
                 teams=to_return,
                 )
 
 
+def calculate_live_scores_for_ticks(db, tick_ids, stealth_attack_points=scoring.STEALTH_ATTACK_POINTS,
+                                    koh_rank_points=scoring.KOH_RANK_POINTS, flag_valid_for=None):
+    """
+    calculate_live_scores for many ticks at once: the events of all of them are loaded as columns
+    with one query per table and scored by the vectorized engine in scoring.py.
+    The keyword arguments change the rules (for rescoring a game), by default they are the game's.
+    flag_valid_for replays the CORRECT and TOO_OLD flag submissions against that validity window
+    instead of counting the flag stolen events.
+    :return: dict of tick_id -> the same dict that calculate_live_scores returns.
+    """
+    tick_ids = sorted(tick_ids)
+    teams = db.session.query(Team).order_by(Team.id).all()
+    services = db.session.query(Service).order_by(Service.id).all()
+
+    team_ids = [t.id for t in teams if not t.is_test_team]
+    test_team_ids = set(t.id for t in teams if t.is_test_team)
+    service_ids = [s.id for s in services]
+
+    to_return = {tick_id: dict(tick_id=tick_id, teams={team_id: _empty_team_score(team_id) for team_id in team_ids})
+                 for tick_id in tick_ids}
+    if not tick_ids:
+        return to_return
+
+    tick_position = {tick_id: i for i, tick_id in enumerate(tick_ids)}
+    team_position = {team_id: i for i, team_id in enumerate(team_ids)}
+    service_position = {service_id: i for i, service_id in enumerate(service_ids)}
+
+    active = scoring.service_activity([service_activity.intervals(service_id) for service_id in service_ids],
+                                      tick_ids)
+    active_normal = active & np.array([s.type == ServiceType.NORMAL for s in services], dtype=bool)
+    active_koh = active & np.array([s.type == ServiceType.KING_OF_THE_HILL for s in services], dtype=bool)
+
+    def in_ticks(event_class):
+        return event_class.tick_id.between(tick_ids[0], tick_ids[-1])
+
+    def columns(rows):
+        # events involving test teams (or anything unknown) are skipped
+        positions = [(tick_position[tick_id], team_position[src], team_position[dst], service_position[service_id])
+                     for (tick_id, src, dst, service_id) in rows
+                     if tick_id in tick_position and src in team_position and dst in team_position
+                     and service_id in service_position]
+        return tuple(np.array(column, dtype=int) for column in zip(*positions)) if positions \
+            else tuple(np.zeros(0, dtype=int) for _ in range(4))
+
+    if flag_valid_for is None:
+        steals = columns(db.session.query(FlagStolenEvent.tick_id, FlagStolenEvent.exploit_team_id,
+                                          FlagStolenEvent.victim_team_id, FlagStolenEvent.service_id)
+                         .filter(in_ticks(FlagStolenEvent)).order_by(FlagStolenEvent.id))
+    else:
+        # TOO_OLD submissions never got a flag_id, they are matched by the flag itself
+        steals = columns(db.session.query(Flag.tick_id, FlagSubmission.team_id, Flag.team_id, Flag.service_id)
+                         .join(Flag, Flag.flag == FlagSubmission.submission)
+                         .filter(FlagSubmission.result.in_([FlagSubmissionResult.CORRECT,
+                                                            FlagSubmissionResult.TOO_OLD]),
+                                 FlagSubmission.tick_id <= Flag.tick_id + flag_valid_for,
+                                 in_ticks(Flag))
+                         .order_by(FlagSubmission.id))
+    stealths = columns(db.session.query(StealthEvent.tick_id, StealthEvent.src_team_id,
+                                        StealthEvent.dst_team_id, StealthEvent.service_id)
+                       .filter(in_ticks(StealthEvent)))
+
+    counted, points, defended = scoring.attack_and_defense(active_normal, len(team_ids), steals, stealths,
+                                                           stealth_attack_points)
+
+    steal_tick, steal_exploit, _, steal_service = steals
+    for i in np.flatnonzero(counted):
+        team_score = to_return[tick_ids[steal_tick[i]]]['teams'][team_ids[steal_exploit[i]]]
+        score = _ledger_points(float(points[i]))
+        team_score["service_attack"].setdefault(service_ids[steal_service[i]], []).append(score)
+        team_score[ScoreType.ATTACK.name] += score
+
+    for (k, t, s) in np.argwhere(defended):
+        team_score = to_return[tick_ids[k]]['teams'][team_ids[t]]
+        team_score[ScoreType.DEFENSE.name] += 1
+        team_score.setdefault("service_defense", []).append(service_ids[s])
+
+    ranks = [(ranking_id, tick_id, service_id, team_id, score)
+             for (ranking_id, tick_id, service_id, team_id, score) in
+             db.session.query(KohRankingEvent.id, KohRankingEvent.tick_id, KohRankingEvent.service_id,
+                              KohRankResult.team_id, KohRankResult.score)
+                 .join(KohRankResult, KohRankResult.koh_ranking_event_id == KohRankingEvent.id)
+                 .filter(in_ticks(KohRankingEvent))
+                 .order_by(KohRankingEvent.id, KohRankResult.rank, KohRankResult.id)
+             # Check if the service was active during the tick
+             if tick_id in tick_position and service_id in service_position
+             and active_koh[tick_position[tick_id], service_position[service_id]]]
+    if ranks:
+        ranking_ids, _, _, rank_team_ids, rank_scores = zip(*ranks)
+        koh_points = scoring.koh_points(np.array(ranking_ids, dtype=int), np.array(rank_scores),
+                                        np.array([team_id in test_team_ids for team_id in rank_team_ids], dtype=bool),
+                                        koh_rank_points)
+        for ((_, tick_id, service_id, team_id, _), score) in zip(ranks, koh_points):
+            if score and team_id in team_position:
+                team_score = to_return[tick_id]['teams'][team_id]
+                # like calculate_live_scores, two rankings of a service in one tick cannot both score a team
+                assert (service_id not in team_score["koh_points_by_service"]), \
+                    f"team_id={team_id} scored twice for service_id={service_id} in tick_id={tick_id}"
+                score = _ledger_points(float(score))
+                team_score[ScoreType.KING_OF_THE_HILL.name] += score
+                team_score["koh_points_by_service"][service_id] = score
+
+    return to_return
+
+
 class ScoreList(Resource):
     """
     Get all the scores for all the ticks.
     """
 
+    @conditional_response(table_versions_of(*GENERATION_MODELS))
+    @cached_response
     def get(self):
-        return jsonify([calculate_scores(db, tick.id) for tick in db.session.query(Tick).all()])
+        return jsonify(calculate_all_scores(db))
 
 
 class ScoreCTFtimeFormat(Resource):
@@ -2200,7 +3427,7 @@ class ScoreCTFtimeFormat(Resource):
     """
 
     def get(self):
-        scores_all_ticks = [calculate_scores(db, tick.id) for tick in db.session.query(Tick).all()]
+        scores_all_ticks = calculate_all_scores(db)
 
         # smoosh the scores together
 
@@ -2247,32 +3474,75 @@ class ScoreInfo(Resource):
     Get the scores for a specific tick.
     """
 
+    @conditional_response(table_versions_of(*GENERATION_MODELS))
     def get(self, tick_id):
         return jsonify(calculate_scores(db, tick_id))
 
 
+MAX_EVENTS_PER_PAGE = 1000
+EVENT_STREAM_BATCH_SIZE = 500
+
+
+def respond_with_events(tick_id=None):
+    """
+    The events (of tick_id, if given) in id order, each with its subclass columns from a single query.
+
+    ?event_type=NAME keeps only one type of event, ?after_id=N&limit=M pages through them (next_after_id is the
+    after_id of the next page, None on the last one) and ?stream=1 sends them as NDJSON, one event per line, from a
+    server-side cursor.
+    """
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', type=int)
+    stream = request.args.get('stream', default=0, type=int)
+
+    if limit is not None and not 0 < limit <= MAX_EVENTS_PER_PAGE:
+        abort(400, message=f"limit must be between 1 and {MAX_EVENTS_PER_PAGE}")
+
+    events = with_polymorphic(Event, "*")
+    query = db.session.query(events).options(selectinload(events.KohRankingEvent.koh_rank_results))
+    if tick_id is not None:
+        query = query.filter(events.tick_id == tick_id)
+    if 'event_type' in request.args:
+        try:
+            event_type = EventType[request.args['event_type']]
+        except KeyError:
+            abort(400, message="invalid event type, must be one of {}".format(" ".join(t.name for t in EventType)))
+        query = query.filter(events.event_type == event_type.value)
+    if after_id is not None:
+        query = query.filter(events.id > after_id)
+    query = query.order_by(events.id)
+    if limit is not None:
+        query = query.limit(limit)
+
+    if stream:
+        def generate():
+            for event in query.execution_options(stream_results=True).yield_per(EVENT_STREAM_BATCH_SIZE):
+                yield json.dumps(event.to_json()) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    the_events = query.all()
+    result = dict(events=[event.to_json() for event in the_events])
+    if limit is not None:
+        result['next_after_id'] = the_events[-1].id if len(the_events) == limit else None
+    return jsonify(result)
+
+
 class EventList(Resource):
     """
-    Get all the events.
+    Get all the events (see respond_with_events for the paging and streaming options).
     """
 
     def get(self):
-        events = db.session.query(Event).all()
-        return jsonify(dict(
-            events=[event.to_json() for event in events]
-        ))
+        return respond_with_events()
 
 
 class TickEvent(Resource):
     """
-    Get a single tick's events.
+    Get a single tick's events (see respond_with_events for the paging and streaming options).
     """
 
     def get(self, tick_id):
-        events = db.session.query(Event).filter_by(tick_id=tick_id).all()
-        return jsonify(dict(
-            events=[event.to_json() for event in events]
-        ))
+        return respond_with_events(tick_id=tick_id)
 
 
 def create_an_event(event_type: EventType, event_args):
@@ -2359,6 +3629,89 @@ class NewTimestampedEvent(Resource):
         db.session.commit()
 
 
+MAX_EVENTS_PER_BULK = 1000
+
+
+class BulkEvents(Resource):
+    """
+    Create many events at once from newline-delimited JSON (one event per line, same fields as /api/v1/event),
+    with a result for each line in order
+
+    The gain is one request and one transaction for all of them, not batched statements: the events are added to
+    the session one by one and go out with a single flush (one INSERT per event), and a refused batch is retried
+    one commit per event to find the bad line.
+    """
+
+    def post(self):
+        lines = request.get_data(as_text=True).splitlines()
+        if len(lines) > MAX_EVENTS_PER_BULK:
+            abort(400, message=f"cannot create more than {MAX_EVENTS_PER_BULK} events at once")
+
+        tick = Tick.get_current_tick()
+        results = []
+        entries = []
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                event_args = json.loads(line)
+                event_type = EventType[event_args['event_type']]
+            except Exception as e:
+                results.append(dict(line=line_number, result="ERROR",
+                                    message="invalid event, must be a JSON object with an event_type of {} -- exception: {}".format(
+                                        " ".join(t.name for t in EventType), e)))
+                continue
+
+            event_args['event_type'] = event_type.value
+            if not event_args.get('tick_id'):
+                if not tick:
+                    results.append(dict(line=line_number, result="ERROR", message="there is no tick"))
+                    continue
+                # the column default would look up the current tick once per row
+                event_args['tick_id'] = tick.id
+            results.append(dict(line=line_number, result="CREATED"))
+            entries.append((results[-1], event_type, event_args))
+
+        # one flush and one commit for all of them, in line order
+        for (result, event_type, event_args) in entries:
+            event = self._create_event(result, event_type, dict(event_args))
+            if event:
+                db.session.add(event)
+        try:
+            db.session.commit()
+        except sqlalchemy.exc.SQLAlchemyError:
+            db.session.rollback()
+            # one of them is bad, go the slow way to find out which
+            for (result, event_type, event_args) in entries:
+                if result['result'] != "CREATED":
+                    continue
+                event = self._create_event(result, event_type, dict(event_args))
+                try:
+                    db.session.add(event)
+                    db.session.commit()
+                except sqlalchemy.exc.SQLAlchemyError as e:
+                    db.session.rollback()
+                    result.update(result="ERROR", message=f"could not store the event -- exception: {e}")
+
+        return jsonify(dict(results=results))
+
+    @staticmethod
+    def _create_event(result, event_type, event_args):
+        pending = set(db.session.new)
+        try:
+            event = create_an_event(event_type, event_args)
+        except Exception as e:
+            event = None
+            result.update(result="ERROR", message=f"invalid event arguments -- exception: {e}")
+            # KOH_RANKING adds its parts to the session as it goes, don't leave half of one behind
+            for obj in set(db.session.new) - pending:
+                db.session.expunge(obj)
+        else:
+            if not event:
+                result.update(result="ERROR", message="Error, type {} not supported".format(event_type.name))
+        return event
+
+
 class Visualization(Resource):
     """
     All the data that the viz system needs.
@@ -2372,14 +3725,24 @@ class Visualization(Resource):
     - KoH scores
     - who exploited who
     - ticks: list of all ticks and when they were created
+
+    With ?since_tick=N only the scores, exploitation events, stealth events, KoH
+    rankings and ticks after tick N are returned (services, teams and the current
+    tick are always complete), so clients can merge it into the copy they have.
+
+    With ?tick=N the document prepared by precompute_tick when tick N started may be
+    returned, without the writes since then.
     """
 
+    @conditional_response(table_versions_of(*GENERATION_MODELS), weak=True)
+    @cached_response
     def get(self):
         started_dumping_at = datetime.datetime.now()
+        since_tick = request.args.get('since_tick', type=int)
 
         all_tick_ids = [tick.id for tick in db.session.query(Tick).all()]
 
-        scores = [calculate_scores(db, tick_id) for tick_id in all_tick_ids]
+        scores = calculate_all_scores(db, since_tick=since_tick)
 
         cleaned_services = [dict(id=s.id,
                                  name=s.name,
@@ -2389,22 +3752,21 @@ class Visualization(Resource):
                                  are_pcaps_released=s.release_pcaps,
                                  max_bytes=s.max_bytes,
                                  service_indicator=s.service_indicator.name,
-                                 active_ticks=[tick_id for tick_id in all_tick_ids if s.was_active(tick_id)])
+                                 active_ticks=service_activity.active_ticks(s.id, all_tick_ids))
                             for s in db.session.query(Service).all() if s.is_visible]
 
+        patch_counts = Service.get_patch_counts()
         for cs in cleaned_services:
             cs_id = cs['id']
 
-            num_submitted_patches = Service.get_num_submitted_patches_for_id(cs_id)
+            num_submitted_patches, num_accepted_patches = patch_counts.get(cs_id, (0, 0))
             cs['num_submitted_patches'] = num_submitted_patches
-
-            num_accepted_patches = Service.get_num_accepted_patches_for_id(cs_id)
             cs['num_accepted_patches'] = num_accepted_patches
 
-            cs_active = db.session.query(IsActive).filter_by(service_id=cs_id).order_by(IsActive.id.desc()).first()
-            if cs_active:
-                cs['tick_id'] = cs_active.tick_id
-                cs['created_on'] = cs_active.created_on
+            cs_state = db.session.query(ServiceState).get(cs_id)
+            if cs_state.is_active_tick_id is not None:
+                cs['tick_id'] = cs_state.is_active_tick_id
+                cs['created_on'] = cs_state.is_active_created_on
 
         cleaned_teams = [dict(id=t.id,
                               name=t.name)
@@ -2428,6 +3790,8 @@ class Visualization(Resource):
         exploitation_events = []
 
         flag_stolen_events = db.session.query(FlagStolenEvent).order_by(FlagStolenEvent.id)
+        if since_tick is not None:
+            flag_stolen_events = flag_stolen_events.filter(FlagStolenEvent.tick_id > since_tick)
         for event in flag_stolen_events:
             exploitation_events.append(dict(id=event.id,
                                             victim_team_id=event.victim_team_id,
@@ -2439,6 +3803,8 @@ class Visualization(Resource):
         stealth_exploitation_events = {}
 
         stealth_events = db.session.query(StealthEvent).order_by(StealthEvent.id)
+        if since_tick is not None:
+            stealth_events = stealth_events.filter(StealthEvent.tick_id > since_tick)
 
         for event in stealth_events:
 
@@ -2456,9 +3822,11 @@ class Visualization(Resource):
         koh_rankings = []
         # KoH Scoring (including ranking, points, and metadata)
         koh_events = db.session.query(KohRankingEvent)
+        if since_tick is not None:
+            koh_events = koh_events.filter(KohRankingEvent.tick_id > since_tick)
         koh_real_active = {}
         for koh_event in koh_events:
-            if koh_event.service.was_active(koh_event.tick_id):
+            if service_activity.was_active(koh_event.service_id, koh_event.tick_id):
                 koh_rankings.append(dict(service_id=koh_event.service_id,
                                          tick=koh_event.tick_id,
                                          results=[dict(rank=r.rank,
@@ -2480,7 +3848,10 @@ class Visualization(Resource):
         #         cs['active_ticks'] = [tick for tick, service_id in active_koh.items() if service_id == cs['id']]
         #         print(f"{cs['id']} {cs['active_ticks']}")
 
-        ticks = [t.to_json() for t in db.session.query(Tick)]
+        ticks = db.session.query(Tick)
+        if since_tick is not None:
+            ticks = ticks.filter(Tick.id > since_tick)
+        ticks = [t.to_json() for t in ticks]
         visualization_json = {'scores': scores,
                               'services': cleaned_services,
                               'teams': cleaned_teams,
@@ -2494,6 +3865,8 @@ class Visualization(Resource):
                               'koh_rankings': koh_rankings,
                               'ticks': ticks,
                               }
+        if since_tick is not None:
+            visualization_json['since_tick'] = since_tick
 
         return jsonify(visualization_json)
 
@@ -2504,6 +3877,7 @@ def init_test_data(reset_game=False):
         for table in reversed(meta.sorted_tables):
             db.session.execute(table.delete())
         db.session.commit()
+        clear_in_process_caches()
 
     real_team_data = \
     yaml.safe_load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'team_info.yml'), 'r'))['teams']
@@ -2587,11 +3961,133 @@ def init_test_data(reset_game=False):
     db.session.commit()
 
 
+METRICS_KEY = "metrics"
+METRICS_PREFIX = "ooogame_"
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SQL_QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class RequestMetrics:
+    """
+    Requests, handler latency and SQL queries by endpoint, added up for all the worker processes in the RQ Redis
+    (one pipeline per request) and rendered in the Prometheus text format by /metrics.
+
+    A field of the METRICS_KEY hash is the JSON of [metric, labels], histograms keep a field per bucket
+    (not cumulative, that is done when rendering).
+    """
+
+    HISTOGRAMS = {"request_duration_seconds": REQUEST_DURATION_BUCKETS,
+                  "sql_queries_per_request": SQL_QUERIES_BUCKETS}
+    HELP = {"requests_total": ("counter", "Requests handled."),
+            "request_duration_seconds": ("histogram", "Time spent in the handler."),
+            "sql_queries_per_request": ("histogram", "SQL queries run by a request."),
+            "sql_duration_seconds_total": ("counter", "Time spent in SQL queries.")}
+
+    @staticmethod
+    def _field(metric, labels):
+        return json.dumps([metric, labels], sort_keys=True)
+
+    def record(self, endpoint, method, status, seconds, sql_queries, sql_seconds):
+        labels = dict(endpoint=endpoint, method=method)
+        increments = [("requests_total", dict(labels, status=str(status)), 1),
+                      ("sql_duration_seconds_total", labels, sql_seconds)]
+        for (metric, value) in (("request_duration_seconds", seconds), ("sql_queries_per_request", sql_queries)):
+            le = next((str(bucket) for bucket in self.HISTOGRAMS[metric] if value <= bucket), "+Inf")
+            increments.append((f"{metric}_bucket", dict(labels, le=le), 1))
+            increments.append((f"{metric}_sum", labels, value))
+        try:
+            pipeline = rq.connection.pipeline(transaction=False)
+            for (metric, metric_labels, value) in increments:
+                pipeline.hincrbyfloat(METRICS_KEY, self._field(metric, metric_labels), value)
+            pipeline.execute()
+        except redis.exceptions.RedisError as e:
+            # not worth more than a debug message on every request
+            l.debug(f"could not record the metrics of endpoint={endpoint} exception={e}")
+
+    def render(self):
+        values = collections.defaultdict(dict)
+        for (field, value) in rq.connection.hgetall(METRICS_KEY).items():
+            metric, labels = json.loads(field)
+            values[metric][tuple(sorted(labels.items()))] = float(value)
+
+        def sample(metric, labels, value):
+            label_text = ",".join('{}="{}"'.format(name, str(label).replace("\\", "\\\\").replace('"', '\\"')
+                                                   .replace("\n", "\\n"))
+                                  for (name, label) in labels)
+            return f"{METRICS_PREFIX}{metric}{{{label_text}}} {value:g}"
+
+        lines = []
+        for (metric, (metric_type, help_text)) in self.HELP.items():
+            lines.append(f"# HELP {METRICS_PREFIX}{metric} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}{metric} {metric_type}")
+            if metric_type == "counter":
+                lines.extend(sample(metric, labels, value) for (labels, value) in sorted(values[metric].items()))
+                continue
+
+            buckets = collections.defaultdict(dict)
+            for (labels, count) in values[f"{metric}_bucket"].items():
+                labels = dict(labels)
+                buckets[tuple(sorted(labels.items() - {("le", labels["le"])}))][labels["le"]] = count
+            for (labels, counts) in sorted(buckets.items()):
+                total = 0
+                for le in [str(bucket) for bucket in self.HISTOGRAMS[metric]] + ["+Inf"]:
+                    total += counts.get(le, 0)
+                    lines.append(sample(f"{metric}_bucket", labels + (("le", le),), total))
+                lines.append(sample(f"{metric}_sum", labels, values[f"{metric}_sum"].get(labels, 0)))
+                lines.append(sample(f"{metric}_count", labels, total))
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'before_cursor_execute')
+def receive_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_started = time.perf_counter()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'after_cursor_execute')
+def receive_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += time.perf_counter() - context.query_started
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        request_metrics.record(endpoint, request.method, response.status_code,
+                               time.perf_counter() - g.request_started, g.sql_queries, g.sql_seconds)
+    return response
+
+
+class Metrics(Resource):
+    """
+    The request metrics of all the workers, for Prometheus.
+    """
+
+    def get(self):
+        try:
+            text = request_metrics.render()
+        except redis.exceptions.RedisError as e:
+            abort(503, message=f"could not get the metrics -- exception: {e}")
+        return Response(text, mimetype="text/plain; version=0.0.4")
+
+
 # Team endpoints
 api.add_resource(TeamList, "/api/v1/teams")
 api.add_resource(TeamInfo, "/api/v1/team/<int:team_id>")
 api.add_resource(TeamPcapList, "/api/v1/team/<int:team_id>/pcaps")
 api.add_resource(TeamFromIP, "/api/v1/team-from-ip/<ip>")
+api.add_resource(TeamFromIPBatch, "/api/v1/team-from-ip")
 
 # Service endpoints
 api.add_resource(ServiceList, "/api/v1/services")
@@ -2625,6 +4121,7 @@ api.add_resource(EventList, "/api/v1/events")
 api.add_resource(TickEvent, "/api/v1/events/<int:tick_id>")
 api.add_resource(NewEvent, "/api/v1/event")
 api.add_resource(NewTimestampedEvent, "/api/v1/timestamped_event")
+api.add_resource(BulkEvents, "/api/v1/events/bulk")
 
 # Score endpoints
 api.add_resource(ScoreList, "/api/v1/scores")
@@ -2635,11 +4132,15 @@ api.add_resource(ScoreInfo, "/api/v1/score/<int:tick_id>")
 api.add_resource(GenerateFlag, "/api/v1/flag/generate/<int:service_id>/<int:team_id>")
 api.add_resource(GetLatestFlag, "/api/v1/flag/latest/<int:service_id>/<int:team_id>")
 api.add_resource(SubmitFlag, "/api/v1/flag/submit/<int:team_id>")
+api.add_resource(SubmitFlagBatch, "/api/v1/flag/submit_batch/<int:team_id>")
 api.add_resource(FlagsForTick, "/api/v1/flags/<int:tick_id>")
+api.add_resource(GenerateTickFlags, "/api/v1/flags/generate_tick")
 
 # Game state endpoints
 api.add_resource(StateOfTheGame, "/api/v1/game/state")
 api.add_resource(StartGame, "/api/v1/game/start")
+api.add_resource(WaitTick, "/api/v1/game/wait_tick")
+api.add_resource(GameEvents, "/api/v1/game/events")
 
 # Tick Control
 api.add_resource(NewTick, "/api/v1/tick/next")
@@ -2649,6 +4150,9 @@ api.add_resource(ChangeTickTime, "/api/v1/tick/time")
 api.add_resource(ChangeIsGameStatePublic, "/api/v1/game/is_game_state_public/<int:value>")
 api.add_resource(ChangeGameStateDelay, "/api/v1/game/game_state_delay/<int:value>")
 
+# Metrics
+api.add_resource(Metrics, "/metrics")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="game_store")
     parser.add_argument("--debug", action="store_true", help="Enable debugging")
@@ -1,2 +1,3 @@
 from .db import Db
-from .perf_measure import print_runtime_stats, for_all_methods
+from .async_db import AsyncDb
+from .perf_measure import client_metrics, for_all_methods, measure_runtime, print_runtime_stats
@@ -0,0 +1,410 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import copy
+import io
+import json
+import logging
+import time
+import urllib
+from typing import Optional
+
+import aiohttp
+
+from .db import (Db, EVENT_BATCH_MAX_SECONDS, EVENT_BATCH_MAX_SIZE, GET_RETRIES, GET_RETRY_BACKOFF_SECONDS,
+                 GET_RETRY_STATUSES, MAX_VALIDATORS, POLL_TIME_SECONDS, REFERENCE_DATA_TTL_SECONDS,
+                 REQUEST_TIMEOUT_SECONDS, WAIT_TICK_TIMEOUT_SECONDS, ReferenceCache, ValidatorCache,
+                 reference_paths_changed_by)
+from .perf_measure import client_metrics, for_all_methods, measure_runtime, start_metrics_exporters
+
+# concurrent connections to the API
+CONNECTION_LIMIT = 100
+
+l = logging.getLogger("client.async_db")
+
+
+@for_all_methods(measure_runtime)
+class AsyncDb:
+    """
+    The Db client for asyncio, every method is a coroutine. Use it as an async context manager (or await close())
+    so that the connections are closed.
+
+    With use_test_app the requests go to the test app's client, one at a time from a worker thread.
+    """
+
+    def __init__(self, database_api="http://master.admin.31337.ooo:30000/", use_test_app=False,
+                 limit=CONNECTION_LIMIT, timeout=REQUEST_TIMEOUT_SECONDS, retries=GET_RETRIES,
+                 reference_ttl=None):
+        self.use_test_app = use_test_app
+        self.limit = limit
+        self.timeout = timeout
+        self.retries = retries
+        self._session = None
+        self._validators = ValidatorCache(MAX_VALIDATORS)
+        if reference_ttl is None:
+            # the test app is also written to behind the client's back (through test_client)
+            reference_ttl = 0 if use_test_app else REFERENCE_DATA_TTL_SECONDS
+        self._reference_cache = ReferenceCache(reference_ttl)
+        l.info(f"Initializing async database client for API {database_api}, are we using the test app: {use_test_app}")
+        start_metrics_exporters()
+        if use_test_app:
+            from ..api import app, db, init_test_data
+            db.create_all()
+            init_test_data(reset_game=True)
+            self.test_client = app.test_client()
+            self._test_app_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        else:
+            self.database_api = database_api
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self.use_test_app:
+            self._test_app_executor.shutdown()
+
+    def _client_timeout(self, extra_read_seconds=0):
+        connect, read = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+        return aiohttp.ClientTimeout(connect=connect, sock_read=read + extra_read_seconds)
+
+    @property
+    def session(self):
+        """
+        The session to the API, created in the running event loop on first use.
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit),
+                                                  timeout=self._client_timeout())
+        return self._session
+
+    async def _test_app_request(self, method, game_path, **kwargs):
+        def send():
+            response = self.test_client.open(game_path, method=method, **kwargs)
+            return response.status_code, response.headers, response.get_data()
+
+        status, headers, data = await asyncio.get_running_loop().run_in_executor(self._test_app_executor, send)
+        self._count_response(status, len(data))
+        return status, headers, data
+
+    @staticmethod
+    def _count_response(status, num_bytes):
+        """
+        Add the response's body size, and whether it is an error, to the client metrics of the running call.
+        """
+        client_metrics.transferred(num_bytes)
+        if status >= 400:
+            client_metrics.failed()
+
+    async def _get(self, game_path, extra_read_seconds=0):
+        return (await self._get_with_age(game_path, extra_read_seconds))[0]
+
+    async def _get_with_age(self, game_path, extra_read_seconds=0):
+        """
+        GET, conditional if there is a validator for the path, retried on connection errors and GET_RETRY_STATUSES.
+        :param extra_read_seconds: how much longer than the timeout the API may hold the request.
+        :return: (body, seconds since the body was received), the age is 0 unless the body was reused on a 304.
+        """
+        validator = self._validators.get(game_path)
+        headers = {'If-None-Match': validator[0]} if validator else None
+        if self.use_test_app:
+            status, response_headers, data = await self._test_app_request("GET", game_path, headers=headers)
+        else:
+            attempt = 0
+            while True:
+                try:
+                    async with self.session.get(self.database_api + game_path, headers=headers,
+                                                timeout=self._client_timeout(extra_read_seconds)) as response:
+                        status, response_headers = response.status, response.headers
+                        if status not in GET_RETRY_STATUSES or attempt >= self.retries:
+                            data = await response.read()
+                            self._count_response(status, len(data))
+                            break
+                except aiohttp.ClientConnectionError:
+                    if attempt >= self.retries:
+                        raise
+                if attempt:
+                    await asyncio.sleep(GET_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+                attempt += 1
+
+        if status == 304 and validator:
+            # decoded again, every caller gets its own body
+            return json.loads(validator[1]), time.monotonic() - validator[2]
+
+        if status != 200:
+            l.warning(f"received a non-200 status code {status} for {game_path}")
+            return None, 0
+
+        self._validators.put(game_path, response_headers.get('ETag'), data)
+        return json.loads(data), 0
+
+    async def _get_aged(self, game_path, key):
+        """
+        GET, with the time since a reused body was received counted off its key seconds.
+        """
+        body, age = await self._get_with_age(game_path)
+        if age and body and body.get(key) is not None:
+            body = dict(body, **{key: max(0, body[key] - age)})
+        return body
+
+    async def _get_reference(self, game_path):
+        """
+        GET of reference data (teams, services), from the reference cache while it is fresh. The caller gets its own
+        copy of the body.
+        """
+        is_fresh, body = self._reference_cache.get(game_path)
+        if is_fresh:
+            return body
+        body, age = await self._get_with_age(game_path)
+        self._reference_cache.put(game_path, body, revalidated=age > 0)
+        return copy.deepcopy(body)
+
+    def invalidate_reference_cache(self, game_path=None):
+        """
+        Have the next teams/services/team/service call (only the one of game_path, if given) ask the API again.
+        """
+        self._reference_cache.invalidate(game_path)
+
+    def reference_cache_stats(self):
+        return self._reference_cache.stats()
+
+    async def _post(self, game_path, data=None, files=None, content_type=None):
+        if self.use_test_app:
+            if files:
+                for file_name, file_value in files.items():
+                    data[file_name] = (io.BytesIO(file_value), file_name)
+            body = json.loads((await self._test_app_request("POST", game_path, data=data, content_type=content_type))[2])
+        else:
+            headers = {'Content-Type': content_type} if content_type else None
+            if isinstance(data, dict) or files:
+                # like requests: the fields that are None are left out, lists are repeated fields
+                form = aiohttp.FormData()
+                for key, value in (data or {}).items():
+                    for item in (value if isinstance(value, list) else [value]):
+                        if item is not None:
+                            form.add_field(key, str(item))
+                for file_name, file_value in (files or {}).items():
+                    form.add_field(file_name, file_value, filename=file_name)
+                data = form
+            async with self.session.post(self.database_api + game_path, data=data, headers=headers) as response:
+                self._count_response(response.status, len(await response.read()))
+                body = await response.json(content_type=None)
+        for changed_path in reference_paths_changed_by(game_path):
+            self.invalidate_reference_cache(changed_path)
+        return body
+
+    async def game_state(self):
+        return await self._get_aged(Db.GAME_STATE_PATH, 'estimated_tick_time_remaining')
+
+    async def services(self):
+        return (await self._get_reference(Db.SERVICE_LIST))['services']
+
+    async def service(self, service_id):
+        return await self._get_reference(Db.SERVICE_INFO.format(urllib.parse.quote(str(service_id))))
+
+    async def teams(self):
+        return (await self._get_reference(Db.TEAM_LIST))['teams']
+
+    async def update_event(self, **kwargs):
+        return await self._post(Db.NEW_EVENT, data=kwargs)
+
+    async def new_timestamped_event(self, **kwargs):
+        return await self._post(Db.TIMESTAMPED_EVENT, data=kwargs)
+
+    async def bulk_events(self, events):
+        """
+        Create all the events (dicts with the update_event arguments) in one request.
+        :return: dict with the result of each event, in order
+        """
+        lines = (json.dumps({key: str(value) for key, value in event.items() if value is not None}) for event in events)
+        return await self._post(Db.BULK_EVENTS,
+                                data="\n".join(lines),
+                                content_type="application/x-ndjson")
+
+    @contextlib.asynccontextmanager
+    async def event_batch(self, max_size=EVENT_BATCH_MAX_SIZE, max_seconds=EVENT_BATCH_MAX_SECONDS):
+        """
+        Buffer the update_event calls made on the batch and send them with bulk_events, whatever is left is sent on exit.
+        """
+        batch = AsyncEventBatch(self, max_size, max_seconds)
+        try:
+            yield batch
+        finally:
+            await batch.flush()
+
+    async def events(self, event_type=None, after_id=None, limit=None):
+        query = {key: value for key, value in dict(event_type=event_type, after_id=after_id, limit=limit).items()
+                 if value is not None}
+        if not query:
+            return (await self._get(Db.EVENT_LIST))['events']
+        return (await self._get(Db.EVENT_LIST + "?" + urllib.parse.urlencode(query)))['events']
+
+    async def generate_flag(self, service_id, team_id):
+        return await self._post(Db.GENERATE_FLAG + f"{service_id}/{team_id}")
+
+    async def generate_tick_flags(self):
+        return await self._post(Db.GENERATE_TICK_FLAGS)
+
+    async def get_flag(self, service_id, team_id):
+        return await self._get(Db.GET_LATEST_FLAG.format(service_id, team_id))
+
+    async def new_tick(self):
+        return await self._post(Db.UPDATE_TICK_PATH)
+
+    async def start_game(self):
+        return await self._post(Db.START_GAME)
+
+    async def change_tick_time(self, new_tick_time_seconds):
+        return await self._post(Db.CHANGE_TICK_TIME, data=dict(tick_time_seconds=new_tick_time_seconds))
+
+    async def team(self, team_id):
+        return await self._get_reference(Db.TEAM_ENDPOINT.format(urllib.parse.quote(str(team_id))))
+
+    async def submit_flag(self, team_id, flag):
+        return await self._post(Db.FLAG_SUBMISSION.format(urllib.parse.quote(str(team_id))),
+                                data=dict(flag=flag))
+
+    async def submit_flags(self, team_id, flags):
+        return await self._post(Db.FLAG_BATCH_SUBMISSION.format(urllib.parse.quote(str(team_id))),
+                                data=dict(flag=list(flags)))
+
+    async def upload_patch(self, team_id, service_id, file):
+        return await self._post(Db.UPLOAD_PATCH,
+                                data={'service_id': service_id, 'team_id': team_id},
+                                files={'uploaded_file': file})
+
+    async def patch(self, patch_id):
+        return await self._get(Db.PATCH_INFO.format(urllib.parse.quote(str(patch_id))))
+
+    async def set_patch_status(self, patch_id, status, public_metadata=None, private_metadata=None):
+        return await self._post(Db.SET_PATCH_STATUS.format(patch_id),
+                                data=dict(status=status,
+                                          public_metadata=public_metadata,
+                                          private_metadata=private_metadata))
+
+    async def tickets(self, team_id):
+        return await self._get(Db.TEAM_TICKET_LIST.format(team_id))
+
+    async def new_ticket(self, team_id, subject, description):
+        return await self._post(Db.NEW_TICKET.format(team_id),
+                                data={'subject': subject, 'description': description})
+
+    async def new_ticket_message(self, team_id, ticket_id, message_text):
+        jdata = await self._get(Db.TEAM_ALLOWED_MESSAGE.format(ticket_id, team_id))
+        assert jdata["message"] == "permitted"
+
+        return await self._post(Db.NEW_TICKET_MESSAGE.format(ticket_id),
+                                data={'message_text': message_text, 'is_team_message': True})
+
+    async def team_pcaps(self, team_id):
+        return await self._get(Db.TEAM_PCAP.format(urllib.parse.quote(str(team_id))))
+
+    async def team_patches(self, team_id):
+        return await self._get(Db.TEAM_PATCHES.format(urllib.parse.quote(str(team_id))))
+
+    async def team_from_ip(self, ip):
+        return await self._get(Db.TEAM_FROM_IP.format(str(urllib.parse.quote(ip))))
+
+    async def teams_from_ips(self, ips):
+        return await self._post(Db.TEAM_FROM_IP_BATCH, data=dict(ip=list(ips)))
+
+    async def set_is_game_state_public(self, is_public):
+        return await self._post(Db.IS_GAME_STATE_PUBLIC.format(1 if is_public else 0))
+
+    async def set_game_state_delay(self, delay):
+        return await self._post(Db.SET_GAME_STATE_DELAY.format(delay))
+
+    async def public_game_state(self, since_tick=None, tick=None):
+        """
+        :param tick: the tick that just started, the game state prepared when it started may be returned.
+        """
+        game_path = Db.VISUALIZATION
+        query = {key: value for key, value in dict(since_tick=since_tick, tick=tick).items() if value is not None}
+        if query:
+            game_path += "?" + urllib.parse.urlencode(query)
+        return await self._get_aged(game_path, 'est_time_remaining')
+
+    async def flags_for_tick(self, tick_id):
+        return await self._get(Db.FLAGS_FOR_TICK.format(str(urllib.parse.quote(tick_id))))
+
+    async def wait_until_new_tick(self, poll_time_seconds=POLL_TIME_SECONDS) -> Optional[int]:
+        """
+        Wait for a new tick with the wait_tick long poll, polling every `poll_time_seconds` seconds if it fails.
+        :return: the previous tick  (None for tick 1)
+        """
+        game_state = await self.game_state()
+        prev_tick = game_state['tick']
+
+        l.info(f"Previous tick is {prev_tick}")
+
+        while True:
+            try:
+                game_state = await self._get(Db.WAIT_TICK + "?" + urllib.parse.urlencode(
+                    dict(after=prev_tick or 0, timeout=WAIT_TICK_TIMEOUT_SECONDS)),
+                    extra_read_seconds=WAIT_TICK_TIMEOUT_SECONDS)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                l.warning(f"could not wait for the new tick, polling instead exception={e}")
+                game_state = None
+            if game_state is None:
+                await asyncio.sleep(poll_time_seconds)
+                game_state = await self.game_state()
+            new_tick = game_state['tick']
+
+            if prev_tick != new_tick:
+                break
+        l.info(f"New tick is {new_tick}")
+        # whatever changed during the last tick is picked up right away (by a 304 if nothing did)
+        self.invalidate_reference_cache()
+        return prev_tick
+
+    async def wait_until_running(self, poll_time_seconds=POLL_TIME_SECONDS):
+        game_state = await self.game_state()
+        while game_state['state'] != 'RUNNING':
+            l.info(f"Game is in {game_state['state']} state, waiting until in RUNNING state.")
+            l.info(f"Going to sleep for {poll_time_seconds}.")
+            await asyncio.sleep(poll_time_seconds)
+            game_state = await self.game_state()
+
+
+class AsyncEventBatch:
+    """
+    EventBatch for the AsyncDb: flushed with bulk_events once it holds max_size events or its oldest event is
+    max_seconds old (checked when an event is added, there is no timer). The events that were not created are kept
+    in failed, with their result.
+    """
+
+    def __init__(self, the_db, max_size, max_seconds):
+        self.the_db = the_db
+        self.max_size = max_size
+        self.max_seconds = max_seconds
+        self._events = []
+        self._oldest = None
+        self.failed = []
+
+    async def update_event(self, **kwargs):
+        if not self._events:
+            self._oldest = time.monotonic()
+        self._events.append(kwargs)
+        if len(self._events) >= self.max_size or time.monotonic() - self._oldest >= self.max_seconds:
+            await self.flush()
+
+    async def flush(self):
+        # swapped before awaiting, so the events added meanwhile go to the next flush
+        events, self._events = self._events, []
+        if not events:
+            return []
+        response = await self.the_db.bulk_events(events)
+        results = response.get('results') if isinstance(response, dict) else None
+        if results is None or len(results) != len(events):
+            l.error(f"could not create the num_events={len(events)} events, the response has no result for each: {response}")
+            results = [dict(result="ERROR", message=f"no result in the response {response}")] * len(events)
+        failed = [(event, result) for (event, result) in zip(events, results) if result['result'] != "CREATED"]
+        if failed:
+            l.error(f"could not create num_events={len(failed)} of {len(events)} events: {[result for (_, result) in failed]}")
+        self.failed.extend(failed)
+        return results
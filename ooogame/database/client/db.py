@@ -1,28 +1,58 @@
+import collections
+import contextlib
+import copy
 import io
+import json
 import logging
+import os
+import re
+import threading
 import time
 import urllib
 from typing import Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 POLL_TIME_SECONDS = 5
+# connections kept to the API, flagbot sends from a thread or process per team
+POOL_SIZE = 32
+# (connect, read) seconds
+REQUEST_TIMEOUT_SECONDS = (5, 60)
+# GETs are retried on connection errors and these statuses, waiting 0.5, 1, 2, ... seconds in between
+GET_RETRIES = 3
+GET_RETRY_BACKOFF_SECONDS = 0.5
+GET_RETRY_STATUSES = (502, 503, 504)
+WAIT_TICK_TIMEOUT_SECONDS = 30
+# how long teams and services are used without asking the API again (then with a conditional GET)
+REFERENCE_DATA_TTL_SECONDS = 60
+# the POSTs that change a service, the API has none changing the teams
+SERVICE_CHANGE_PATH = re.compile(r"^/api/v1/service/(\d+)/"
+                                 r"(release_pcaps|is_visible|is_active|service_indicator|profile)\b")
+# game paths with a remembered ETag, gamestatebot asks for a new ?since_tick= path every tick
+MAX_VALIDATORS = 64
+EVENT_BATCH_MAX_SIZE = 100
+EVENT_BATCH_MAX_SECONDS = 5
 
 l = logging.getLogger("client.db")
 
 
-from .perf_measure import print_runtime_stats, for_all_methods
+from .perf_measure import client_metrics, for_all_methods, measure_runtime, start_metrics_exporters
 
 
-@for_all_methods(print_runtime_stats)
+@for_all_methods(measure_runtime)
 class Db:
 
+    BULK_EVENTS = "/api/v1/events/bulk"
     CHANGE_TICK_TIME = "/api/v1/tick/time"
     EVENT_LIST = "/api/v1/events"
     FLAGS_FOR_TICK = "/api/v1/flags/{}"
     FLAG_SUBMISSION = "/api/v1/flag/submit/{}"
+    FLAG_BATCH_SUBMISSION = "/api/v1/flag/submit_batch/{}"
     GAME_STATE_PATH = "/api/v1/game/state"
     GENERATE_FLAG = "/api/v1/flag/generate/"
+    GENERATE_TICK_FLAGS = "/api/v1/flags/generate_tick"
     GET_LATEST_FLAG = "/api/v1/flag/latest/{}/{}"    
     IS_GAME_STATE_PUBLIC = "/api/v1/game/is_game_state_public/{}"
     NEW_EVENT = "/api/v1/event"
@@ -38,17 +68,32 @@ class Db:
     TEAM_ALLOWED_MESSAGE = "/api/v1/ticket/{}/message/{}/team"
     TEAM_ENDPOINT = "/api/v1/team/{}"
     TEAM_FROM_IP = "/api/v1/team-from-ip/{}"
+    TEAM_FROM_IP_BATCH = "/api/v1/team-from-ip"
     TEAM_LIST = "/api/v1/teams"
     TEAM_PATCHES = "/api/v1/team/{}/uploaded_patches"
     TEAM_PCAP = "/api/v1/team/{}/pcaps"
     TEAM_TICKET_LIST = "/api/v1/tickets/{}"
     UPDATE_TICK_PATH = "/api/v1/tick/next"
     UPLOAD_PATCH = "/api/v1/service/upload_patch"
+    WAIT_TICK = "/api/v1/game/wait_tick"
     VISUALIZATION = "/api/v1/visualization"
 
-    def __init__(self, database_api="http://master.admin.31337.ooo:30000/", use_test_app=False):
+    def __init__(self, database_api="http://master.admin.31337.ooo:30000/", use_test_app=False, pool_size=POOL_SIZE,
+                 timeout=REQUEST_TIMEOUT_SECONDS, retries=GET_RETRIES, reference_ttl=None):
         self.use_test_app = use_test_app
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+        self._validators = ValidatorCache(MAX_VALIDATORS)
+        if reference_ttl is None:
+            # the test app is also written to behind the client's back (through test_client)
+            reference_ttl = 0 if use_test_app else REFERENCE_DATA_TTL_SECONDS
+        self._reference_cache = ReferenceCache(reference_ttl)
         l.info(f"Initializing database client for API {database_api}, are we using the test app: {use_test_app}")
+        start_metrics_exporters()
         if use_test_app:
             from ..api import app, db, init_test_data
             db.create_all()
@@ -57,29 +102,115 @@ class Db:
         else:
             self.database_api = database_api
 
-    def _get(self, game_path):
+    @property
+    def session(self):
+        """
+        The keep-alive session to the API, shared by the threads of a process. A forked process (flagbot's
+        multiprocessing) gets its own rather than using the parent's sockets.
+        """
+        with self._session_lock:
+            if self._session is None or self._session_pid != os.getpid():
+                session = requests.Session()
+                # requests decodes gzip, this makes sure it is asked for
+                session.headers['Accept-Encoding'] = "gzip, deflate"
+                # only the GETs are safe to send again, POST isn't in the allowed methods
+                retry = Retry(total=self.retries, backoff_factor=GET_RETRY_BACKOFF_SECONDS,
+                              status_forcelist=GET_RETRY_STATUSES, allowed_methods=frozenset(["GET"]),
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+                self._session_pid = os.getpid()
+            return self._session
+
+    def _get(self, game_path, timeout=None):
+        return self._get_with_age(game_path, timeout)[0]
+
+    def _get_with_age(self, game_path, timeout=None):
+        """
+        GET, conditional if there is a validator for the path.
+        :param timeout: the requests timeout, if not the client's.
+        :return: (body, seconds since the body was received), the age is 0 unless the body was reused on a 304.
+        """
+        validator = self._validators.get(game_path)
+        headers = {'If-None-Match': validator[0]} if validator else None
         if self.use_test_app:
-            response = self.test_client.get(game_path)
+            response = self.test_client.get(game_path, headers=headers)
         else:
-            response = requests.get(self.database_api + game_path)
+            response = self.session.get(self.database_api + game_path, headers=headers, timeout=timeout or self.timeout)
+        self._count_response(response)
+
+        if response.status_code == 304 and validator:
+            # decoded again, every caller gets its own body
+            return json.loads(validator[1]), time.monotonic() - validator[2]
 
         if response.status_code != 200:
             l.warning(f"received a non-200 status code {response.status_code} for {game_path} {response}")
-            return None
+            return None, 0
 
-        if self.use_test_app:
-            return response.json
-        else:
-            return response.json()
+        data = response.get_data() if self.use_test_app else response.content
+        self._validators.put(game_path, response.headers.get('ETag'), data)
+        return json.loads(data), 0
+
+    def _count_response(self, response):
+        """
+        Add the response's body size, and whether it is an error, to the client metrics of the running call.
+        """
+        client_metrics.transferred(len(response.get_data() if self.use_test_app else response.content))
+        if response.status_code >= 400:
+            client_metrics.failed()
+
+    def _long_poll_timeout(self, seconds):
+        """
+        The client's timeout with seconds more to read, for a request that the API holds up to seconds.
+        """
+        connect, read = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+        return connect, read + seconds
 
-    def _post(self, game_path, data=None, files=None):
+    def _get_reference(self, game_path):
+        """
+        GET of reference data (teams, services), from the reference cache while it is fresh. The caller gets its own
+        copy of the body.
+        """
+        is_fresh, body = self._reference_cache.get(game_path)
+        if is_fresh:
+            return body
+        body, age = self._get_with_age(game_path)
+        self._reference_cache.put(game_path, body, revalidated=age > 0)
+        return copy.deepcopy(body)
+
+    def invalidate_reference_cache(self, game_path=None):
+        """
+        Have the next teams/services/team/service call (only the one of game_path, if given) ask the API again.
+        """
+        self._reference_cache.invalidate(game_path)
+
+    def reference_cache_stats(self):
+        return self._reference_cache.stats()
+
+    def _get_aged(self, game_path, key):
+        """
+        GET, with the time since a reused body was received counted off its key seconds.
+        """
+        body, age = self._get_with_age(game_path)
+        if age and body and body.get(key) is not None:
+            body = dict(body, **{key: max(0, body[key] - age)})
+        return body
+
+    def _post(self, game_path, data=None, files=None, content_type=None):
         if self.use_test_app:
             if files:
                 for file_name, file_value in files.items():
                     data[file_name] = (io.BytesIO(file_value), file_name)
-            response = self.test_client.post(game_path, data=data)
+            response = self.test_client.post(game_path, data=data, content_type=content_type)
         else:
-            response = requests.post(self.database_api + game_path, data=data, files=files)
+            headers = {'Content-Type': content_type} if content_type else None
+            response = self.session.post(self.database_api + game_path, data=data, files=files, headers=headers,
+                                         timeout=self.timeout)
+        self._count_response(response)
+        for changed_path in reference_paths_changed_by(game_path):
+            self.invalidate_reference_cache(changed_path)
 
         if self.use_test_app:
             return response.json
@@ -87,16 +218,16 @@ class Db:
             return response.json()
             
     def game_state(self):
-        return self._get(Db.GAME_STATE_PATH)
+        return self._get_aged(Db.GAME_STATE_PATH, 'estimated_tick_time_remaining')
 
     def services(self):
-        return self._get(Db.SERVICE_LIST)['services']
+        return self._get_reference(Db.SERVICE_LIST)['services']
 
     def service(self, service_id):
-        return self._get(Db.SERVICE_INFO.format(urllib.parse.quote(str(service_id))))
+        return self._get_reference(Db.SERVICE_INFO.format(urllib.parse.quote(str(service_id))))
     
     def teams(self):
-        return self._get(Db.TEAM_LIST)['teams']
+        return self._get_reference(Db.TEAM_LIST)['teams']
 
     def update_event(self, **kwargs):
         return self._post(Db.NEW_EVENT, data=kwargs)
@@ -104,12 +235,41 @@ class Db:
     def new_timestamped_event(self, **kwargs):
         return self._post(Db.TIMESTAMPED_EVENT, data=kwargs)
 
-    def events(self):
-        return self._get(Db.EVENT_LIST)['events']
+    def bulk_events(self, events):
+        """
+        Create all the events (dicts with the update_event arguments) in one request.
+        :return: dict with the result of each event, in order
+        """
+        # values go as strings and None is left out, exactly like the form fields of update_event
+        lines = (json.dumps({key: str(value) for key, value in event.items() if value is not None}) for event in events)
+        return self._post(Db.BULK_EVENTS,
+                          data="\n".join(lines),
+                          content_type="application/x-ndjson")
+
+    @contextlib.contextmanager
+    def event_batch(self, max_size=EVENT_BATCH_MAX_SIZE, max_seconds=EVENT_BATCH_MAX_SECONDS):
+        """
+        Buffer the update_event calls made on the batch and send them with bulk_events, whatever is left is sent on exit.
+        """
+        batch = EventBatch(self, max_size, max_seconds)
+        try:
+            yield batch
+        finally:
+            batch.flush()
+
+    def events(self, event_type=None, after_id=None, limit=None):
+        query = {key: value for key, value in dict(event_type=event_type, after_id=after_id, limit=limit).items()
+                 if value is not None}
+        if not query:
+            return self._get(Db.EVENT_LIST)['events']
+        return self._get(Db.EVENT_LIST + "?" + urllib.parse.urlencode(query))['events']
 
     def generate_flag(self, service_id, team_id):
         return self._post(Db.GENERATE_FLAG + f"{service_id}/{team_id}")
 
+    def generate_tick_flags(self):
+        return self._post(Db.GENERATE_TICK_FLAGS)
+
     def get_flag(self, service_id, team_id):
         return self._get(Db.GET_LATEST_FLAG.format(service_id, team_id))
 
@@ -123,7 +283,7 @@ class Db:
         return self._post(Db.CHANGE_TICK_TIME, data=dict(tick_time_seconds=new_tick_time_seconds))
 
     def team(self, team_id):
-        return self._get(Db.TEAM_ENDPOINT.format(urllib.parse.quote(str(team_id))))
+        return self._get_reference(Db.TEAM_ENDPOINT.format(urllib.parse.quote(str(team_id))))
 
     def submit_flag(self, team_id, flag):
         return self._post(Db.FLAG_SUBMISSION.format(urllib.parse.quote(str(team_id))),
@@ -131,6 +291,12 @@ class Db:
                               flag=flag
                           ))
 
+    def submit_flags(self, team_id, flags):
+        return self._post(Db.FLAG_BATCH_SUBMISSION.format(urllib.parse.quote(str(team_id))),
+                          data=dict(
+                              flag=list(flags)
+                          ))
+
     def upload_patch(self, team_id, service_id, file):
         return self._post(Db.UPLOAD_PATCH,
                           data={'service_id': service_id, 'team_id': team_id},
@@ -168,14 +334,24 @@ class Db:
     def team_from_ip(self, ip):
         return self._get(Db.TEAM_FROM_IP.format(str(urllib.parse.quote(ip))))
 
+    def teams_from_ips(self, ips):
+        return self._post(Db.TEAM_FROM_IP_BATCH, data=dict(ip=list(ips)))
+
     def set_is_game_state_public(self, is_public):
         return self._post(Db.IS_GAME_STATE_PUBLIC.format(1 if is_public else 0))
 
     def set_game_state_delay(self, delay):
         return self._post(Db.SET_GAME_STATE_DELAY.format(delay))
 
-    def public_game_state(self):
-        return self._get(Db.VISUALIZATION)
+    def public_game_state(self, since_tick=None, tick=None):
+        """
+        :param tick: the tick that just started, the game state prepared when it started may be returned.
+        """
+        game_path = Db.VISUALIZATION
+        query = {key: value for key, value in dict(since_tick=since_tick, tick=tick).items() if value is not None}
+        if query:
+            game_path += "?" + urllib.parse.urlencode(query)
+        return self._get_aged(game_path, 'est_time_remaining')
 
     def flags_for_tick(self, tick_id):
         return self._get(Db.FLAGS_FOR_TICK.format(str(urllib.parse.quote(tick_id))))
@@ -192,14 +368,24 @@ class Db:
     
         done = False
         while not done:
-            game_state = self.game_state()
+            # the API answers as soon as there is a new tick, polling is for when it can't
+            try:
+                game_state = self._get(Db.WAIT_TICK + "?" + urllib.parse.urlencode(
+                    dict(after=prev_tick or 0, timeout=WAIT_TICK_TIMEOUT_SECONDS)),
+                    timeout=self._long_poll_timeout(WAIT_TICK_TIMEOUT_SECONDS))
+            except requests.RequestException as e:
+                l.warning(f"could not wait for the new tick, polling instead exception={e}")
+                game_state = None
+            if game_state is None:
+                time.sleep(poll_time_seconds)
+                game_state = self.game_state()
             new_tick = game_state['tick']
 
-            if prev_tick == new_tick:
-                time.sleep(poll_time_seconds)
-            else:
+            if prev_tick != new_tick:
                 done = True
         l.info(f"New tick is {new_tick}")
+        # whatever changed during the last tick is picked up right away (by a 304 if nothing did)
+        self.invalidate_reference_cache()
         return prev_tick
 
     def wait_until_running(self, poll_time_seconds=POLL_TIME_SECONDS):
@@ -210,3 +396,147 @@ class Db:
             time.sleep(poll_time_seconds)
             game_state = self.game_state()
         return
+
+
+class ValidatorCache:
+    """
+    The ETag and (undecoded) body of the latest 200 by game path, for the conditional GETs. Only the max_size most
+    recently used paths are kept.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # game_path -> (ETag, body, time.monotonic() when it was received), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, game_path):
+        """
+        :return: (ETag, body, time.monotonic() when it was received), or None.
+        """
+        with self._lock:
+            entry = self._entries.get(game_path)
+            if entry is not None:
+                self._entries.move_to_end(game_path)
+            return entry
+
+    def put(self, game_path, etag, body):
+        """
+        Remember the body, or forget the path if there is no etag.
+        """
+        with self._lock:
+            if not etag:
+                self._entries.pop(game_path, None)
+                return
+            self._entries[game_path] = (etag, body, time.monotonic())
+            self._entries.move_to_end(game_path)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class ReferenceCache:
+    """
+    The reference data bodies by game path, used without asking the API for ttl seconds after they were received or
+    revalidated. A ttl of 0 turns it off.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # game_path -> (body, time.monotonic() when it was received or revalidated)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._revalidations = 0
+        self._misses = 0
+
+    def get(self, game_path):
+        """
+        :return: (is_fresh, a copy of the body)
+        """
+        with self._lock:
+            entry = self._entries.get(game_path)
+            if entry and time.monotonic() - entry[1] < self.ttl:
+                self._hits += 1
+                return True, copy.deepcopy(entry[0])
+            return False, None
+
+    def put(self, game_path, body, revalidated):
+        with self._lock:
+            if revalidated:
+                self._revalidations += 1
+            else:
+                self._misses += 1
+            if body is not None and self.ttl > 0:
+                self._entries[game_path] = (body, time.monotonic())
+
+    def invalidate(self, game_path=None):
+        with self._lock:
+            if game_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(game_path, None)
+
+    def stats(self):
+        """
+        :return: dict with the calls answered from the cache (hits), with a 304 (revalidations) and with a new body
+                 (misses).
+        """
+        with self._lock:
+            return dict(hits=self._hits, revalidations=self._revalidations, misses=self._misses)
+
+
+def reference_paths_changed_by(game_path):
+    """
+    :return: the reference data game paths that a POST to game_path changes.
+    """
+    match = SERVICE_CHANGE_PATH.match(game_path)
+    if match is None:
+        return []
+    return [Db.SERVICE_LIST, Db.SERVICE_INFO.format(match.group(1))]
+
+
+class EventBatch:
+    """
+    Buffer of events for Db.bulk_events, flushed once it holds max_size events or its oldest event is max_seconds old
+    (checked when an event is added, there is no timer). The events that were not created are kept in failed, with
+    their result.
+    """
+
+    def __init__(self, the_db, max_size, max_seconds):
+        self.the_db = the_db
+        self.max_size = max_size
+        self.max_seconds = max_seconds
+        self._events = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self.failed = []
+
+    def update_event(self, **kwargs):
+        with self._lock:
+            if not self._events:
+                self._oldest = time.monotonic()
+            self._events.append(kwargs)
+            full = len(self._events) >= self.max_size or time.monotonic() - self._oldest >= self.max_seconds
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return []
+        response = self.the_db.bulk_events(events)
+        results = response.get('results') if isinstance(response, dict) else None
+        if results is None or len(results) != len(events):
+            l.error(f"could not create the num_events={len(events)} events, the response has no result for each: {response}")
+            results = [dict(result="ERROR", message=f"no result in the response {response}")] * len(events)
+        failed = [(event, result) for (event, result) in zip(events, results) if result['result'] != "CREATED"]
+        if failed:
+            l.error(f"could not create num_events={len(failed)} of {len(events)} events: {[result for (_, result) in failed]}")
+        with self._lock:
+            self.failed.extend(failed)
+        return results
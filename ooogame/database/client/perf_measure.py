@@ -1,4 +1,12 @@
+import asyncio
+import contextvars
+import http.server
+import json
 import logging
+import math
+import os
+import sys
+import threading
 import time
 from functools import wraps
 
@@ -8,26 +16,277 @@ l = logging.getLogger("client.db")
 
 LOG_IF_TAKES_MORE_THAN = 0.5 # fractional perf_counter() seconds
 
+# HDR-style latency buckets: SUB_BUCKETS_PER_DOUBLING log-spaced buckets for every doubling from MIN_SECONDS up,
+# so any latency is known within 2 ** (1 / SUB_BUCKETS_PER_DOUBLING) (19%)
+HISTOGRAM_MIN_SECONDS = 0.0001
+SUB_BUCKETS_PER_DOUBLING = 4
+PERCENTILES = (50, 90, 99, 99.9)
 
-def print_runtime_stats(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        start = time.perf_counter()
-        ret = f(*args, **kwargs)
-        took = time.perf_counter() - start
+# exporting the client metrics of a bot, see start_metrics_exporters
+METRICS_PORT_ENV = "DB_CLIENT_METRICS_PORT"
+METRICS_JSON_ENV = "DB_CLIENT_METRICS_JSON"
+METRICS_JSON_SECONDS_ENV = "DB_CLIENT_METRICS_JSON_SECONDS"
+METRICS_JSON_SECONDS = 60
+METRICS_PREFIX = "ooogame_client_"
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of call latencies (not thread safe, ClientMetrics locks).
+    """
+
+    def __init__(self):
+        # bucket index -> count, bucket i holds the latencies up to upper_bound(i)
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def upper_bound(index):
+        return HISTOGRAM_MIN_SECONDS * 2 ** (index / SUB_BUCKETS_PER_DOUBLING)
+
+    def record(self, seconds):
+        index = 0
+        if seconds > HISTOGRAM_MIN_SECONDS:
+            index = math.ceil(math.log2(seconds / HISTOGRAM_MIN_SECONDS) * SUB_BUCKETS_PER_DOUBLING)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = percent / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+
+# the counters of the measured call running in this thread or task, for the bytes and errors seen below it
+_current_call = contextvars.ContextVar("current_call", default=None)
+
+
+class ClientMetrics:
+    """
+    Calls, errors, bytes received and latency histogram of every measured client method, for the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # method name -> dict(calls, errors, bytes, latency)
+            self._methods = {}
+
+    def record(self, method, seconds, error, num_bytes):
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = dict(calls=0, errors=0, bytes=0, latency=LatencyHistogram())
+            stats['calls'] += 1
+            stats['errors'] += error
+            stats['bytes'] += num_bytes
+            stats['latency'].record(seconds)
+
+    @staticmethod
+    def transferred(num_bytes):
+        """
+        Count num_bytes of response body for the measured call that is running.
+        """
+        call = _current_call.get()
+        if call is not None:
+            call['bytes'] += num_bytes
+
+    @staticmethod
+    def failed():
+        """
+        Count the measured call that is running as an error (an exception raised by it is counted anyway).
+        """
+        call = _current_call.get()
+        if call is not None:
+            call['error'] = True
+
+    def to_json(self):
+        with self._lock:
+            return {method: dict(calls=stats['calls'],
+                                 errors=stats['errors'],
+                                 bytes=stats['bytes'],
+                                 mean_seconds=stats['latency'].sum / stats['latency'].count,
+                                 max_seconds=stats['latency'].max,
+                                 **{f"p{percent:g}_seconds": stats['latency'].percentile(percent)
+                                    for percent in PERCENTILES})
+                    for method, stats in sorted(self._methods.items())}
+
+    def to_prometheus(self):
+        """
+        The metrics in the Prometheus text format, with only the latency buckets that have calls (and +Inf).
+        """
+        lines = [f"# TYPE {METRICS_PREFIX}calls_total counter",
+                 f"# TYPE {METRICS_PREFIX}errors_total counter",
+                 f"# TYPE {METRICS_PREFIX}response_bytes_total counter",
+                 f"# TYPE {METRICS_PREFIX}call_duration_seconds histogram"]
+        with self._lock:
+            for method, stats in sorted(self._methods.items()):
+                label = f'method="{method}"'
+                lines.append(f"{METRICS_PREFIX}calls_total{{{label}}} {stats['calls']}")
+                lines.append(f"{METRICS_PREFIX}errors_total{{{label}}} {stats['errors']}")
+                lines.append(f"{METRICS_PREFIX}response_bytes_total{{{label}}} {stats['bytes']}")
+                latency = stats['latency']
+                seen = 0
+                for index in sorted(latency.buckets):
+                    seen += latency.buckets[index]
+                    lines.append(f'{METRICS_PREFIX}call_duration_seconds_bucket{{{label},'
+                                 f'le="{latency.upper_bound(index):.6g}"}} {seen}')
+                lines.append(f'{METRICS_PREFIX}call_duration_seconds_bucket{{{label},le="+Inf"}} {latency.count}')
+                lines.append(f"{METRICS_PREFIX}call_duration_seconds_sum{{{label}}} {latency.sum:.6g}")
+                lines.append(f"{METRICS_PREFIX}call_duration_seconds_count{{{label}}} {latency.count}")
+        return "\n".join(lines) + "\n"
+
+
+client_metrics = ClientMetrics()
+
+
+def measure_runtime(f):
+    """
+    Record the latency, errors and bytes of every call in client_metrics (coroutines too), and log a TIMED_<METHOD>
+    warning when it takes more than LOG_IF_TAKES_MORE_THAN.
+    """
+    def start():
+        call = dict(error=False, bytes=0)
+        return call, _current_call.set(call), time.perf_counter()
+
+    def finish(call, token, started):
+        took = time.perf_counter() - started
+        _current_call.reset(token)
+        client_metrics.record(f.__name__, took, call['error'], call['bytes'])
         if took > LOG_IF_TAKES_MORE_THAN:
             l.warning("TIMED_{}={:.3}".format(f.__name__.upper(), took))
-        return ret
+
+    if asyncio.iscoroutinefunction(f):
+        @wraps(f)
+        async def async_wrapper(*args, **kwargs):
+            call, token, started = start()
+            try:
+                return await f(*args, **kwargs)
+            except Exception:
+                call['error'] = True
+                raise
+            finally:
+                finish(call, token, started)
+        return async_wrapper
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        call, token, started = start()
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            call['error'] = True
+            raise
+        finally:
+            finish(call, token, started)
     return wrapper
 
 
+# the old name of measure_runtime, which only logged the slow calls
+print_runtime_stats = measure_runtime
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = client_metrics.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port, host=""):
+    """
+    Serve the client metrics at http://host:port/metrics, from a daemon thread.
+    :return: the server.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="client-metrics", daemon=True).start()
+    l.info(f"Serving the client metrics on port={server.server_port}")
+    return server
+
+
+def dump_metrics(path):
+    """
+    Write the client metrics as JSON to path (atomically).
+    """
+    report = dict(process=os.path.basename(sys.argv[0]), pid=os.getpid(), time=time.time(),
+                  methods=client_metrics.to_json())
+    with open(path + ".tmp", 'w') as fp:
+        json.dump(report, fp, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def dump_metrics_periodically(path, interval_seconds=METRICS_JSON_SECONDS):
+    """
+    dump_metrics every interval_seconds, from a daemon thread.
+    """
+    def dump():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                dump_metrics(path)
+            except OSError as e:
+                l.warning(f"could not dump the client metrics to path={path} exception={e}")
+
+    threading.Thread(target=dump, name="client-metrics-dump", daemon=True).start()
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def start_metrics_exporters():
+    """
+    Export the client metrics of this process as configured by the environment (once): on the Prometheus endpoint
+    of port DB_CLIENT_METRICS_PORT and/or as JSON dumped to DB_CLIENT_METRICS_JSON every
+    DB_CLIENT_METRICS_JSON_SECONDS.
+    """
+    global _exporters_started
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+    if os.environ.get(METRICS_PORT_ENV):
+        try:
+            serve_metrics(int(os.environ[METRICS_PORT_ENV]))
+        except (OSError, ValueError) as e:
+            l.error(f"could not serve the client metrics on port={os.environ[METRICS_PORT_ENV]} exception={e}")
+    if os.environ.get(METRICS_JSON_ENV):
+        dump_metrics_periodically(os.environ[METRICS_JSON_ENV],
+                                  float(os.environ.get(METRICS_JSON_SECONDS_ENV, METRICS_JSON_SECONDS)))
+
+
 # https://stackoverflow.com/questions/6307761/how-to-decorate-all-functions-of-a-class-without-typing-it-over-and-over-for-eac
 def for_all_methods(decorator):
     def decorate(cls):
         for name in cls.__dict__:
+            # waiting for the game, batching events (the context manager returns right away), closing the
+            # client and its reference cache are not API calls
             if callable(getattr(cls, name)) \
                     and not name.startswith('_') \
-                    and not name.startswith('wait_'):
+                    and not name.startswith('wait_') \
+                    and name not in ('event_batch', 'close', 'invalidate_reference_cache', 'reference_cache_stats'):
                 setattr(cls, name, decorator(getattr(cls, name)))
         return cls
     return decorate
@@ -41,7 +300,7 @@ if __name__ == "__main__":
     l.setLevel(logging.DEBUG)
 
 
-    @for_all_methods(print_runtime_stats)
+    @for_all_methods(measure_runtime)
     class TestDb:
         def __init__(self):
             pass
@@ -0,0 +1,103 @@
+"""
+Vectorized scoring engine.
+
+The rules of calculate_live_scores applied to any number of ticks at once over NumPy arrays.
+Ticks, teams and services are referred to by their position in the arrays that the caller
+loaded (see calculate_live_scores_for_ticks in api.py), test teams are never given a position.
+"""
+import numpy as np
+
+NORMAL_ATTACK_POINTS = 1
+STEALTH_ATTACK_POINTS = 0.5
+
+# KoH points by rank, index 0 is "no points"
+KOH_RANK_POINTS = np.array([0, 10, 6, 3, 2, 1])
+KOH_MIN_NUM_SCORED = len(KOH_RANK_POINTS) - 1
+
+
+def service_activity(intervals, tick_ids):
+    """
+    :param intervals: for each service, the (starts, ends) lists of the [start_tick, end_tick) in which it was active.
+    :param tick_ids: sorted tick ids.
+    :return: bool array (tick, service) of the services active in each tick.
+    """
+    tick_ids = np.asarray(tick_ids)
+    active = np.zeros((len(tick_ids), len(intervals)), dtype=bool)
+    for s, (starts, ends) in enumerate(intervals):
+        if not starts:
+            continue
+        i = np.searchsorted(starts, tick_ids, side='right') - 1
+        active[:, s] = (i >= 0) & (tick_ids < np.asarray(ends)[np.maximum(i, 0)])
+    return active
+
+
+def attack_and_defense(active_normal, num_teams, steals, stealths, stealth_attack_points=STEALTH_ATTACK_POINTS):
+    """
+    :param active_normal: bool array (tick, service) of the NORMAL services active in each tick.
+    :param num_teams: number of (non test) teams.
+    :param steals: (tick, exploit_team, victim_team, service) int arrays of the flag stolen events, in event order.
+    :param stealths: (tick, src_team, dst_team, service) int arrays of the stealth events.
+    :param stealth_attack_points: the points of a steal that came with a stealth event.
+    :return: (counted, points, defended): which steals score, the attack points of each steal,
+             and bool array (tick, team, service) of the services each team defended.
+    """
+    num_ticks, num_services = active_normal.shape
+    steal_tick, steal_exploit, steal_victim, steal_service = steals
+
+    def key(tick, src, dst, service):
+        return ((tick.astype(np.int64) * num_teams + src) * num_teams + dst) * num_services + service
+
+    counted = active_normal[steal_tick, steal_service]
+    stealthy = np.isin(key(*steals), key(*stealths))
+    points = np.where(stealthy, stealth_attack_points, NORMAL_ATTACK_POINTS)
+
+    exploited = np.zeros((num_ticks, num_teams, num_services), dtype=bool)
+    exploited[steal_tick[counted], steal_victim[counted], steal_service[counted]] = True
+    # Only if the service was exploited by someone do the others score defense points
+    was_service_exploited = exploited.any(axis=1)
+    defended = (active_normal & was_service_exploited)[:, np.newaxis, :] & ~exploited
+
+    return counted, points, defended
+
+
+def koh_points(ranking, rank_score, is_test_team, rank_points=KOH_RANK_POINTS):
+    """
+    Points of every KoH rank result: the top len(rank_points) - 1 scores get rank_points, teams
+    tied on a score share the rank of the first of them, and nobody from the first score of 0 or
+    less on scores. Test teams are skipped.
+
+    :param ranking: the ranking event of each result, the results of an event contiguous and sorted by rank.
+    :param rank_score: the score of each result.
+    :param is_test_team: bool array, whether each result is a test team's.
+    :param rank_points: the points by rank, index 0 is "no points" (KOH_RANK_POINTS).
+    :return: array of the points of each result.
+    """
+    rank_points = np.asarray(rank_points)
+    min_num_scored = len(rank_points) - 1
+    n = len(ranking)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    position = np.arange(n)
+    first_of_ranking = np.r_[True, ranking[1:] != ranking[:-1]]
+    ranking_start = np.maximum.accumulate(np.where(first_of_ranking, position, 0))
+
+    def cumsum_in_ranking(values):
+        values = values.astype(int)
+        total = np.cumsum(values)
+        return total - (total[ranking_start] - values[ranking_start])
+
+    kept = (cumsum_in_ranking(rank_score <= 0) == 0) & ~is_test_team
+    num_scored_before = cumsum_in_ranking(kept) - kept
+
+    last_kept = np.maximum.accumulate(np.where(kept, position, -1))
+    previous_kept = np.r_[-1, last_kept[:-1]]
+    has_previous = previous_kept >= ranking_start
+    new_level = ~(has_previous & (rank_score[np.maximum(previous_kept, 0)] == rank_score))
+
+    # have we scored enough people?
+    enough = kept & new_level & (num_scored_before >= min_num_scored)
+    awarded = kept & (cumsum_in_ranking(enough) == 0)
+
+    level_start = np.maximum.accumulate(np.where(kept & new_level, position, -1))
+    rank = np.where(awarded, num_scored_before[np.maximum(level_start, 0)] + 1, 0)
+    return rank_points[rank]
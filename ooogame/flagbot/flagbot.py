@@ -85,9 +85,15 @@ def set_flag_deployment(new_flag, flag_location, deployment_name, team, service,
         l.error(f"set some flags for team_id={team['id']} num_pods={len(ret.items)} num_fail={num_fail}")
         return FlagResult.FAIL
 
-def create_flags_for_team(the_db, k8s_api, team, teams, ad_services):
+def create_flags_for_team(the_db, k8s_api, team, teams, ad_services, flags=None):
+    """
+    Set the flags of the team for the services. flags maps service_id -> flag, anything missing is generated.
+    """
+    flags = flags or {}
     for service in ad_services:
-        flag = the_db.generate_flag(service['id'], team['id'])
+        flag = flags.get(service['id'])
+        if not flag:
+            flag = the_db.generate_flag(service['id'], team['id'])
         if service['central_server']:
             deployment_name = service['central_server']
             flag_location = f"{service['flag_location']}/team-{team['id']}"
@@ -139,6 +145,11 @@ def main(the_db, k8s_api, max_ticks=None, wait=True, concurrency=True, concurren
         services = the_db.services()
         ad_services = [ s for s in services if s['type'] == 'NORMAL' ]
 
+        # all the flags of this tick in one go (for the active services, the others are generated one by one)
+        flags = {}
+        for flag in the_db.generate_tick_flags().get('flags', []):
+            flags.setdefault(flag['team_id'], {})[flag['service_id']] = flag
+
         # For every team, for every service, generate a flag and set it
         before = datetime.datetime.now()
         jobs = []
@@ -149,7 +160,7 @@ def main(the_db, k8s_api, max_ticks=None, wait=True, concurrency=True, concurren
         else:
             assert False
         for team in teams:
-            j = lib(target=create_flags_for_team, args=(the_db, k8s_api, team, teams, ad_services))
+            j = lib(target=create_flags_for_team, args=(the_db, k8s_api, team, teams, ad_services, flags.get(team['id'])))
             j.start()
             jobs.append(j)
             if not concurrency:
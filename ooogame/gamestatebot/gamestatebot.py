@@ -53,6 +53,43 @@ def start_upload_game_state(game_state_json_path, tick: int, previous_upload_to_
 
 
 
+# Scores of the last few ticks can still change (flags stay valid for a few ticks,
+# KoH rankings and stealth events come in late), so every delta re-fetches them.
+REFETCH_TICKS = 5
+
+
+def merge_game_state(game_state, delta):
+    """
+    Merge a public_game_state(since_tick=...) delta into the full game state we already have.
+    Everything after the delta's since_tick is replaced by the delta.
+    """
+    since_tick = delta['since_tick']
+    merged = {k: v for k, v in delta.items() if k != 'since_tick'}
+
+    merged['scores'] = [s for s in game_state['scores'] if s['tick_id'] <= since_tick] + delta['scores']
+    merged['ticks'] = [t for t in game_state['ticks'] if t['id'] <= since_tick] + delta['ticks']
+    merged['exploitation_events'] = [e for e in game_state['exploitation_events'] if e['tick'] <= since_tick] \
+                                    + delta['exploitation_events']
+    merged['koh_rankings'] = [k for k in game_state['koh_rankings'] if k['tick'] <= since_tick] \
+                             + delta['koh_rankings']
+    merged['stealth_exploitation_events'] = {tick: events
+                                             for tick, events in game_state['stealth_exploitation_events'].items()
+                                             if int(tick) <= since_tick}
+    merged['stealth_exploitation_events'].update(delta['stealth_exploitation_events'])
+    return merged
+
+
+def fetch_game_state(the_db, game_state, tick=None):
+    """
+    Get the full public game state, only asking the db for the last few ticks if we already have one.
+    :param tick: the tick that just started, the db may answer with the game state it prepared when it started.
+    """
+    if game_state is None:
+        return the_db.public_game_state(tick=tick)
+    since_tick = max(0, game_state['current_tick'] - REFETCH_TICKS)
+    return merge_game_state(game_state, the_db.public_game_state(since_tick=since_tick, tick=tick))
+
+
 def create_game_state_dir_structure(game_state_dir):
     l.info(f"creating the game state directory based on {game_state_dir}")
     root = pathlib.Path(game_state_dir)
@@ -70,13 +107,14 @@ def main(the_db, game_state_dir, max_ticks=None):
     assert os.path.isdir(game_state_dir)
     i = 0
     scoreboard_upload_p: Optional[subprocess.Popen] = None
+    new_game_state = None
     while True:
         tick_id : Optional[int] = the_db.wait_until_new_tick()
         if tick_id is None:
             l.info("I think we're on the very first tick (previous_tick is None), no previous tick status to save")
             continue
         l.info(f"got a new tick, let's save the game state of the old tick {tick_id}")
-        new_game_state = the_db.public_game_state()  # XXX: This is not in sync! We're already in tick_id+1 (seen in current_tick + some fast events will be there)
+        new_game_state = fetch_game_state(the_db, new_game_state, tick_id + 1)  # XXX: This is not in sync! We're already in tick_id+1 (seen in current_tick + some fast events will be there)
 
         new_pcap_location = pathlib.Path(f"{game_state_dir}/game_states/game_state_{tick_id}")
         l.info(f"saving public game state to {new_pcap_location}")
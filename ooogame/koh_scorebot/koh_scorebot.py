@@ -156,37 +156,45 @@ def main(the_db, k8s_api, max_ticks=None):
         services = the_db.services()
         koh_services = [ s for s in services if s['type'] == 'KING_OF_THE_HILL' ]
 
-        for service in koh_services:
-            team_results = []
-            for team in teams:
-                score_location = service['score_location']
-
-                # extract the score from the score location
-                score, metadata = get_score(team, service, score_location, k8s_api, the_db)
-                team_results.append(dict(score=score,
-                                         data=metadata,
-                                         team_id=team['id']))
-            l.info(f"Fetched all the scores for service {service['id']}")
-
-            # Now that we have the scores for everyone, compute the list and create the KoH scoring event.
-            team_results.sort(key=lambda result: (result['score'], result['team_id']), reverse=True)
-
-            rank = 1
-            for result in team_results:
-                result['rank'] = rank
-                rank += 1
-
-            l.info(f"Ranked all the teams for service {service['id']}: {team_results}")
-
-            json_rankings = json.dumps(team_results)
-            l.debug(f"json rankings {json_rankings}")
-            # We are scoring the last tick, so we use the old tick id for the event
-            response = the_db.update_event(event_type="KOH_RANKING",
-                                           reason=f"Ranking of teams for service {service['id']} tick {old_tick}.",
-                                           tick_id=old_tick,
-                                           ranking=json_rankings,
-                                           service_id=service['id'])
-            l.info(f"Updated the DB with service {service['id']} team rankings: response code: {response}")
+        # all the events of this tick go to the DB in bulk
+        with the_db.event_batch() as events:
+            for service in koh_services:
+                team_results = []
+                for team in teams:
+                    score_location = service['score_location']
+
+                    # extract the score from the score location
+                    score, metadata = get_score(team, service, score_location, k8s_api, events)
+                    team_results.append(dict(score=score,
+                                             data=metadata,
+                                             team_id=team['id']))
+                l.info(f"Fetched all the scores for service {service['id']}")
+
+                # Now that we have the scores for everyone, compute the list and create the KoH scoring event.
+                team_results.sort(key=lambda result: (result['score'], result['team_id']), reverse=True)
+
+                rank = 1
+                for result in team_results:
+                    result['rank'] = rank
+                    rank += 1
+
+                l.info(f"Ranked all the teams for service {service['id']}: {team_results}")
+
+                json_rankings = json.dumps(team_results)
+                l.debug(f"json rankings {json_rankings}")
+                # We are scoring the last tick, so we use the old tick id for the event
+                events.update_event(event_type="KOH_RANKING",
+                                    reason=f"Ranking of teams for service {service['id']} tick {old_tick}.",
+                                    tick_id=old_tick,
+                                    ranking=json_rankings,
+                                    service_id=service['id'])
+                l.info(f"Queued the service {service['id']} team rankings for the DB")
+
+        failed = [result for (event, result) in events.failed if event['event_type'] == "KOH_RANKING"]
+        if failed:
+            l.error(f"could not update the DB with num_services={len(failed)} team rankings of tick {old_tick}: {failed}")
+        else:
+            l.info(f"Updated the DB with the team rankings of num_services={len(koh_services)} services")
 
         l.info(f"koh-scorebot completed processing of num_services={len(koh_services)} services for tick old_tick={old_tick}")
 
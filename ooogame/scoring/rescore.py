@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+l = logging.getLogger("rescore")
+
+TICKS_PER_CHUNK = 50
+
+# the --what-if rules, and the calculate_live_scores_for_ticks argument each one sets
+WHAT_IF_RULES = {
+    'rank_to_score': 'koh_rank_points',
+    'stealth_points': 'stealth_attack_points',
+    'flag_valid_for': 'flag_valid_for',
+}
+
+SCORE_TYPES = ("ATTACK", "DEFENSE", "KING_OF_THE_HILL")
+
+_rules = {}
+
+
+def parse_what_if(what_ifs):
+    """
+    Parse the rule=value overrides into calculate_live_scores_for_ticks arguments.
+    rank_to_score is the points of rank 1, 2, ... as a comma separated list.
+    """
+    rules = {}
+    for what_if in what_ifs:
+        name, _, value = what_if.partition("=")
+        if name not in WHAT_IF_RULES or not value:
+            raise ValueError(f"invalid what-if {what_if}, expected one of {', '.join(WHAT_IF_RULES)} as rule=value")
+        if name == 'rank_to_score':
+            rules[WHAT_IF_RULES[name]] = [0] + [float(points) for points in value.split(",")]
+        elif name == 'stealth_points':
+            rules[WHAT_IF_RULES[name]] = float(value)
+        else:
+            rules[WHAT_IF_RULES[name]] = int(value)
+    return rules
+
+
+def database_uri(database):
+    """
+    The SQLAlchemy URI for a database URI, or the path of an SQLite snapshot.
+    """
+    if "://" in database:
+        return database
+    if not os.path.isfile(database):
+        raise ValueError(f"no such SQLite snapshot {database}")
+    return "sqlite:///" + os.path.abspath(database)
+
+
+def _init_worker(rules):
+    from ..database import api
+    global _rules
+    _rules = rules
+    # don't share the parent's connections
+    api.db.engine.dispose()
+
+
+def _score_ticks(tick_ids):
+    from ..database import api
+    with api.app.app_context():
+        try:
+            return api.calculate_live_scores_for_ticks(api.db, tick_ids, **_rules)
+        finally:
+            api.db.session.remove()
+
+
+def _totals(team_score):
+    totals = {score_type: team_score[score_type] for score_type in SCORE_TYPES}
+    totals['total'] = sum(totals.values())
+    return totals
+
+
+def rescore_game(processes=1, ticks_per_chunk=TICKS_PER_CHUNK, **rules):
+    """
+    Score every tick of the game from the raw events, the ticks split into chunks over a pool of processes.
+    Nothing is written to the database.
+    :param rules: calculate_live_scores_for_ticks rules to change (see parse_what_if).
+    :return: dict with the per-tick and cumulative totals of every team, and where they differ from the ledger.
+    """
+    global _rules
+    from ..database import api
+
+    tick_ids = [tick_id for (tick_id,) in api.db.session.query(api.Tick.id).order_by(api.Tick.id)]
+    finalized = sorted(tick_id for (tick_id,) in api.db.session.query(api.FinalizedTick.tick_id))
+    ledger = api.scores_from_ledger(api.db, finalized)
+    api.db.session.remove()
+
+    chunks = [tick_ids[i:i + ticks_per_chunk] for i in range(0, len(tick_ids), ticks_per_chunk)]
+    l.info(f"Rescoring num_ticks={len(tick_ids)} in num_chunks={len(chunks)} with processes={processes} rules={rules}")
+    scores = {}
+    if processes == 1:
+        _rules = rules
+        for chunk in chunks:
+            scores.update(_score_ticks(chunk))
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(rules,)) as pool:
+            for result in pool.imap(_score_ticks, chunks):
+                scores.update(result)
+
+    ticks = []
+    cumulative = {}
+    diff = []
+    for tick_id in tick_ids:
+        teams = {team_id: _totals(team_score) for team_id, team_score in scores[tick_id]['teams'].items()}
+        for team_id, totals in teams.items():
+            running = cumulative.setdefault(team_id, dict.fromkeys(totals, 0))
+            for key, points in totals.items():
+                running[key] += points
+        ticks.append(dict(tick_id=tick_id, teams=teams,
+                          cumulative={team_id: dict(totals) for team_id, totals in cumulative.items()}))
+
+        if tick_id in ledger:
+            for team_id, team_score in ledger[tick_id]['teams'].items():
+                for score_type in SCORE_TYPES:
+                    stored = team_score[score_type]
+                    rescored = teams.get(team_id, {}).get(score_type, 0)
+                    if stored != rescored:
+                        diff.append(dict(tick_id=tick_id, team_id=team_id, score_type=score_type,
+                                         ledger=stored, rescored=rescored))
+
+    return dict(rules=rules, ticks=ticks, totals=cumulative, finalized_ticks=len(finalized), diff=diff)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="rescore")
+    parser.add_argument("database", help="The database URI, or the path of an SQLite snapshot")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of worker processes [default: all cpus]")
+    parser.add_argument("--ticks-per-chunk", type=int, default=TICKS_PER_CHUNK,
+                        help=f"Ticks scored by a worker at a time [default: {TICKS_PER_CHUNK}]")
+    parser.add_argument("--what-if", action="append", default=[], metavar="RULE=VALUE",
+                        help="Override a scoring rule: rank_to_score=10,6,3,2,1 stealth_points=0.5 flag_valid_for=3")
+    parser.add_argument("--output", help="Write the JSON report here rather than to stdout")
+    parser.add_argument("--version", action="version", version="%(prog)s v0.1.0")
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    try:
+        rules = parse_what_if(args.what_if)
+        os.environ["SQLALCHEMY_DATABASE_URI"] = database_uri(args.database)
+    except ValueError as e:
+        l.error(f"Error, {e}")
+        parser.print_help()
+        sys.exit(1)
+
+    report = rescore_game(processes=args.processes, ticks_per_chunk=args.ticks_per_chunk, **rules)
+    l.info(f"Rescored num_ticks={len(report['ticks'])}, num_differences={len(report['diff'])} against the ledger")
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
@@ -23,6 +23,8 @@ api = Api(app)
 db = None
 
 SERVICES_ENDPOINT = "/api/v1/services"
+# the teams see the admins' service changes right away, revalidating every time is a 304 when nothing changed
+REFERENCE_TTL_SECONDS = 0
 
 def require_team_id_from_ip(view_function):
     """
@@ -135,6 +137,22 @@ class FlagSubmission(Resource):
             abort(400, message=result['message'])
         return jsonify(message=result['result'])
 
+class FlagBatchSubmission(Resource):
+    """
+    Submit many flags (repeated flag form fields) at once.
+    """
+
+    method_decorators = [require_team_id_from_ip]
+
+    def post(self, team_id):
+        flags = request.form.getlist('flag')
+        if not flags:
+            abort(400, message='bad request')
+        result = db.submit_flags(team_id, flags)
+        if not 'results' in result:
+            abort(400, message=result['message'])
+        return jsonify(results=[dict(flag=r['flag'], message=r['result']) for r in result['results']])
+
 class UploadPatch(Resource):
     """
     Upload a patch.
@@ -194,6 +212,7 @@ api.add_resource(PcapInfo, "/api/pcap_info")
 api.add_resource(PatchesInfo, "/api/patches_info")
 api.add_resource(ServicesInfo, "/api/services_info")
 api.add_resource(FlagSubmission, "/api/submit_flag/<flag>")
+api.add_resource(FlagBatchSubmission, "/api/submit_flags")
 api.add_resource(UploadPatch, "/api/submit_patch/")
 
 api.add_resource(TicketList, "/api/tickets")
@@ -221,13 +240,13 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(1)
 
-    db = Db(database_api)
+    db = Db(database_api, reference_ttl=REFERENCE_TTL_SECONDS)
     app.run(host=args.host, port=args.port, debug=args.debug)
 
 if 'DATABASE_API' in os.environ:    
     database_api = os.environ['DATABASE_API']
     l.info(f"Setting DB API to {database_api}")
-    db = Db(database_api)
+    db = Db(database_api, reference_ttl=REFERENCE_TTL_SECONDS)
 
 if "FLASK_WSGI_DEBUG" in os.environ:
     from werkzeug.debug import DebuggedApplication
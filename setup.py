@@ -31,6 +31,8 @@ setup(
           'Flask-RQ2',
           'kubernetes',
           'coloredlogs',
+          'numpy',
+          'aiohttp',
       ],
       extras_require={
           "mysql": ["mysqlclient"]
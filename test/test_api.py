@@ -4,6 +4,9 @@ API server tests.
 """
 import io
 import os
+import asyncio
+import gzip
+import http.server
 import json
 import uuid
 import yaml
@@ -12,9 +15,12 @@ import base64
 import hashlib
 import random
 import datetime
+import threading
 import dateutil.parser
 import unittest.mock
 
+import pytest
+
 import ooogame.database.api as app
 
 DEFAULT_TICKET_STATUS = "OPEN"
@@ -192,6 +198,70 @@ def test_add_team_message():
 
 # ---------------~~~~~~~~~~~<[ utililty functions for ticket testing ]>~~~~~~~~~~~~~~~~~------------------
 
+def test_ticket_paging():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+
+    for i in range(5):
+        client.post(f"/api/v1/ticket/{(i % 2) + 1}", data=dict(subject=f"subject {i}", description=f"desc {i}"))
+    all_tickets = client.get("/api/v1/tickets").json['tickets']
+    assert [t['subject'] for t in all_tickets] == [f"subject {i}" for i in reversed(range(5))]
+    assert [t['team_name'] for t in all_tickets] == [app.Team.get_team_name(t['team_id']) for t in all_tickets]
+
+    paged = []
+    before_id = None
+    while True:
+        url = "/api/v1/tickets?limit=2" + (f"&before_id={before_id}" if before_id else "")
+        response = client.get(url)
+        assert response.status_code == 200
+        paged.extend(response.json['tickets'])
+        before_id = response.json['next_before_id']
+        if before_id is None:
+            break
+    assert paged == all_tickets
+
+    # newest created_on first, a ticket whose created_on is out of id order is neither skipped nor repeated
+    ticket = app.db.session.query(app.Ticket).get(all_tickets[1]['id'])
+    ticket.created_on = ticket.created_on - datetime.timedelta(days=1)
+    # and the ties go by id
+    tied = app.db.session.query(app.Ticket).get(all_tickets[3]['id'])
+    tied.created_on = app.db.session.query(app.Ticket).get(all_tickets[2]['id']).created_on
+    app.db.session.commit()
+    all_tickets = client.get("/api/v1/tickets").json['tickets']
+    assert [t['id'] for t in all_tickets[-1:]] == [ticket.id]
+    assert [t['created_on'] for t in all_tickets] == sorted((t['created_on'] for t in all_tickets), reverse=True)
+    paged = []
+    before_id = None
+    while True:
+        response = client.get("/api/v1/tickets?limit=2" + (f"&before_id={before_id}" if before_id else ""))
+        paged.extend(t['id'] for t in response.json['tickets'])
+        before_id = response.json['next_before_id']
+        if before_id is None:
+            break
+    assert paged == [t['id'] for t in all_tickets]
+    assert client.get("/api/v1/tickets?limit=2&before_id=12345").json['tickets'] == []
+
+    # (subject 3 went back a day)
+    response = client.get("/api/v1/tickets/2?limit=1")
+    assert [t['subject'] for t in response.json['tickets']] == ["subject 1"]
+
+    # only what changed since then: a new status, a new message
+    since = datetime.datetime.now().isoformat("T") + "Z"
+    assert client.get(f"/api/v1/tickets?updated_since={since}").json['tickets'] == []
+    first, second = all_tickets[-1]['id'], all_tickets[-2]['id']
+    client.post(f"/api/v1/ticket/status/{first}", data=dict(status="CLOSED"))
+    client.post(f"/api/v1/ticket/{second}/message", data=dict(message_text="hello", is_team_message="True"))
+    updated = client.get(f"/api/v1/tickets?updated_since={since}").json['tickets']
+    assert [t['id'] for t in updated] == [second, first]
+    assert updated[1]['status'] == "CLOSED"
+    assert [m['message_text'] for m in updated[0]['messages']] == ["hello"]
+
+    assert client.get("/api/v1/tickets?updated_since=yesterday").status_code == 400
+    assert client.get("/api/v1/tickets?limit=0").status_code == 400
+
+
 def verify_message(response, test_message):
     assert response.status_code == 200, f"status code ==> {response.status_code}"
 
@@ -586,6 +656,44 @@ def test_toggle_service_functions():
         assert response.json[prop] == False
 
 
+def test_service_state_projection():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    service_id = _get_normal_service(client)['id']
+    client.post("/api/v1/game/start")
+
+    client.post(f"/api/v1/service/{service_id}/is_visible/1")
+    client.post(f"/api/v1/service/{service_id}/service_indicator/LOW")
+    client.post(f"/api/v1/service/{service_id}/release_pcaps/1")
+    client.post(f"/api/v1/service/{service_id}/release_pcaps/0")
+
+    state = app.db.session.query(app.ServiceState).get(service_id)
+    assert state.is_visible == True
+    assert state.release_pcaps == False
+    assert state.service_indicator == app.ServiceStatus.LOW
+
+    # the projection is rebuilt from the history tables
+    app.db.session.add(app.IsVisible(service_id=service_id, is_visible=False))
+    app.db.session.commit()
+    assert app.ServiceState.update(service_id).is_visible == False
+
+    queries = []
+    def count_query(*args, **kwargs):
+        queries.append(args)
+
+    app.sqlalchemy.event.listen(app.db.engine, "before_cursor_execute", count_query)
+    try:
+        response = client.get("/api/v1/services")
+    finally:
+        app.sqlalchemy.event.remove(app.db.engine, "before_cursor_execute", count_query)
+    assert response.status_code == 200
+    assert len(response.json['services']) > 1
+    # one query for the services and their state, one per script relationship
+    assert len(queries) <= 5, len(queries)
+
+
 def test_tick_length():
     app.db.create_all()
     app.init_test_data()
@@ -679,6 +787,267 @@ def test_ip_to_team():
     response = client.get("/api/v1/team-from-ip/192.168.10.12")
     assert response.json['team_id'] == None
 
+    # the vm address counts too
+    response = client.get("/api/v1/team-from-ip/10.13.37.2")
+    assert response.json['team_id'] == 2
+
+    response = client.post("/api/v1/team-from-ip",
+                           data=dict(ip=["10.1.0.20", "192.168.10.12", "not an ip", "10.3.0.255", "10.13.37.3"]))
+    assert response.status_code == 200
+    assert [t['team_id'] for t in response.json['teams']] == [1, None, None, 3, 3]
+    assert response.json['teams'][2]['ip'] == "not an ip"
+
+    # teams that change are picked up, and the most specific network wins
+    team = app.db.session.query(app.Team).get(1)
+    team.team_network = "10.0.0.0/8"
+    app.db.session.commit()
+    response = client.post("/api/v1/team-from-ip", data=dict(ip=["10.1.0.20", "10.2.0.20", "10.99.0.1"]))
+    assert [t['team_id'] for t in response.json['teams']] == [1, 2, 1]
+
+    # so are the in-place changes of another worker, which only bump the version of the table
+    app.db.session.execute(app.Team.__table__.update().where(app.Team.id == 1).values(team_network="10.99.0.0/16"))
+    app.db.session.commit()
+    response = client.get("/api/v1/team-from-ip/10.50.0.1")
+    assert response.json['team_id'] == 1
+    app.response_cache.bump_generation([app.Team.__tablename__])
+    response = client.get("/api/v1/team-from-ip/10.50.0.1")
+    assert response.json['team_id'] == None
+
+    app.init_test_data(reset_game=True)
+    response = client.get("/api/v1/team-from-ip/10.99.0.1")
+    assert response.json['team_id'] == None
+
+
+def test_service_activity_index():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    service_id = _get_normal_service(client)['id']
+
+    client.post("/api/v1/game/start")
+
+    # tick -> values posted during that tick, in order
+    toggles = {1: [], 2: [1], 3: [], 4: [0, 1], 5: [1, 0], 6: [], 7: [0], 8: [1], 9: []}
+    for tick_id, values in toggles.items():
+        if tick_id != 1:
+            client.post("/api/v1/tick/next")
+        for value in values:
+            response = client.post(f"/api/v1/service/{service_id}/is_active/{value}")
+            assert response.status_code == 200
+
+    def was_active_from_history(tick_id):
+        in_tick = [v for v in toggles[tick_id]]
+        if in_tick:
+            return all(in_tick)
+        before = [v for t in toggles if t < tick_id for v in toggles[t]]
+        return bool(before and before[-1])
+
+    with app.app.test_request_context():
+        service = app.db.session.query(app.Service).get(service_id)
+        for tick_id in toggles:
+            assert service.was_active(tick_id) == was_active_from_history(tick_id), tick_id
+        assert app.service_activity.active_ticks(service_id, list(toggles)) == [2, 3, 8, 9]
+        assert not service.was_active(0)
+        assert service.was_active(100)
+
+    # a reset game must not answer from the old history
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    assert not app.service_activity.was_active(service_id, 3)
+
+
+def test_tick_clock():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    client.post("/api/v1/game/start")
+
+    with app.app.test_request_context():
+        tick_id = app.Tick.get_current_tick_id()
+        assert app.Tick.get_current_tick().id == tick_id
+
+        # another worker starting a tick is only seen by the next request
+        app.db.session.execute(app.Tick.__table__.insert().values(created_on=datetime.datetime.now()))
+        app.db.session.commit()
+        assert app.Tick.get_current_tick_id() == tick_id
+
+    with app.app.test_request_context():
+        assert app.Tick.get_current_tick_id() == tick_id + 1
+
+        # a tick started by this request is seen right away, also by the column defaults
+        tick = app.Tick()
+        app.db.session.add(tick)
+        app.db.session.commit()
+        assert app.Tick.get_current_tick_id() == tick.id == tick_id + 2
+        event = app.PcapCreatedEvent(event_type=app.EventType.PCAP_CREATED.value, reason="tick clock", service_id=1,
+                                     team_id=1, pcap_name="tick.pcap")
+        app.db.session.add(event)
+        app.db.session.commit()
+        assert event.tick_id == tick_id + 2
+
+    assert client.get("/api/v1/game/state").json['tick'] == tick_id + 2
+
+
+def test_flag_index():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    service_id = _get_normal_service(client)['id']
+
+    client.post("/api/v1/game/start")
+    client.post(f"/api/v1/service/{service_id}/is_active/1")
+
+    the_flag = client.post(f"/api/v1/flag/generate/{service_id}/1").json['flag']
+    assert app.is_well_formed_flag(the_flag)
+    assert not app.is_well_formed_flag(the_flag[:-1])
+    assert not app.is_well_formed_flag(the_flag.lower())
+
+    response = client.post("/api/v1/flag/submit/2", data=dict(flag=the_flag[:-1]))
+    assert response.json['result'] == 'INCORRECT'
+    response = client.post("/api/v1/flag/submit/2", data=dict(flag=app.GenerateFlag()._generate_new_flag()))
+    assert response.json['result'] == 'INCORRECT'
+    response = client.post("/api/v1/flag/submit/1", data=dict(flag=the_flag))
+    assert response.json['result'] == 'OWN_FLAG'
+
+    # a flag created behind this worker's back is still found
+    with app.app.app_context():
+        tick_id = app.Tick.get_current_tick_id()
+        other_flag = app.Flag(team_id=2, service_id=service_id, tick_id=tick_id,
+                              flag=app.GenerateFlag()._generate_new_flag())
+        app.db.session.add(other_flag)
+        app.db.session.commit()
+        other_flag = other_flag.flag
+
+    response = client.post("/api/v1/flag/submit/1", data=dict(flag=other_flag))
+    assert response.json['result'] == 'CORRECT'
+    response = client.post("/api/v1/flag/submit/2", data=dict(flag=the_flag))
+    assert response.json['result'] == 'CORRECT'
+
+    # flags that fell out of the index still get told apart from wrong ones
+    for i in range(app.NUM_TICKS_FLAG_VALID_FOR + 1):
+        client.post("/api/v1/tick/next")
+    response = client.post("/api/v1/flag/submit/3", data=dict(flag=the_flag))
+    assert response.json['result'] == 'TOO_OLD'
+
+    # without a second look at the flags: an old flag is in the index, a wrong one costs the id range
+    flag_queries = []
+
+    def count_flag_query(conn, cursor, statement, *args):
+        if "FROM flags" in statement:
+            flag_queries.append(statement)
+
+    app.sqlalchemy.event.listen(app.db.engine, "before_cursor_execute", count_flag_query)
+    try:
+        response = client.post("/api/v1/flag/submit/4", data=dict(flag=the_flag))
+        assert response.json['result'] == 'TOO_OLD'
+        assert len(flag_queries) == 0
+        response = client.post("/api/v1/flag/submit/4", data=dict(flag=app.GenerateFlag()._generate_new_flag()))
+        assert response.json['result'] == 'INCORRECT'
+        assert len(flag_queries) == 1
+    finally:
+        app.sqlalchemy.event.remove(app.db.engine, "before_cursor_execute", count_flag_query)
+
+    assert len(client.get("/api/v1/events").json['events']) == 2
+
+
+def test_flag_batch_submission():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    services = [s['id'] for s in client.get("/api/v1/services").json['services'] if s['type'] == "NORMAL"]
+    active_service, inactive_service = services[0], services[1]
+
+    response = client.post("/api/v1/flag/submit_batch/2", data=dict(flag=["nope"]))
+    assert response.status_code == 400
+
+    client.post("/api/v1/game/start")
+    client.post(f"/api/v1/service/{active_service}/is_active/1")
+
+    flag_1 = client.post(f"/api/v1/flag/generate/{active_service}/1").json['flag']
+    flag_3 = client.post(f"/api/v1/flag/generate/{active_service}/3").json['flag']
+    own_flag = client.post(f"/api/v1/flag/generate/{active_service}/2").json['flag']
+    inactive_flag = client.post(f"/api/v1/flag/generate/{inactive_service}/1").json['flag']
+
+    response = client.post("/api/v1/flag/submit/2", data=dict(flag=flag_3))
+    assert response.json['result'] == 'CORRECT'
+
+    queries = []
+
+    def count_query(*args, **kwargs):
+        queries.append(args)
+
+    app.sqlalchemy.event.listen(app.db.engine, "before_cursor_execute", count_query)
+    try:
+        response = client.post("/api/v1/flag/submit_batch/2",
+                               data=dict(flag=[flag_1, "wrong", flag_3, own_flag, inactive_flag, flag_1]))
+    finally:
+        app.sqlalchemy.event.remove(app.db.engine, "before_cursor_execute", count_query)
+    assert response.status_code == 200
+    assert [(r['flag'], r['result']) for r in response.json['results']] == [
+        (flag_1, 'CORRECT'),
+        ("wrong", 'INCORRECT'),
+        (flag_3, 'ALREADY_SUBMITTED'),
+        (own_flag, 'OWN_FLAG'),
+        (inactive_flag, 'SERVICE_INACTIVE'),
+        (flag_1, 'ALREADY_SUBMITTED'),
+    ]
+    # the lookups do not grow with the number of flags
+    assert len(queries) < 20, len(queries)
+
+    events = client.get("/api/v1/events").json['events']
+    assert sorted(e['victim_team_id'] for e in events) == [1, 3]
+
+    # what was stored answers later submissions, the inactive flag was not stored
+    response = client.post("/api/v1/flag/submit/2", data=dict(flag="wrong"))
+    assert response.json['result'] == 'ALREADY_SUBMITTED'
+    response = client.post("/api/v1/flag/submit/2", data=dict(flag=inactive_flag))
+    assert response.json['result'] == 'SERVICE_INACTIVE'
+
+
+def test_generate_tick_flags():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+
+    response = client.post("/api/v1/flags/generate_tick")
+    assert response.status_code == 400
+
+    client.post("/api/v1/game/start")
+    normal_services = [s['id'] for s in client.get("/api/v1/services").json['services'] if s['type'] == "NORMAL"]
+    team_ids = [t['id'] for t in client.get("/api/v1/teams").json['teams']]
+
+    response = client.post("/api/v1/flags/generate_tick")
+    assert response.status_code == 200
+    assert response.json['flags'] == []
+
+    for service_id in normal_services[:2]:
+        client.post(f"/api/v1/service/{service_id}/is_active/1")
+    already_flag = client.post(f"/api/v1/flag/generate/{normal_services[0]}/1").json
+
+    response = client.post("/api/v1/flags/generate_tick")
+    assert response.status_code == 200
+    tick_id = response.json['tick']
+    flags = response.json['flags']
+    assert [(f['team_id'], f['service_id']) for f in flags] == \
+           [(team_id, service_id) for team_id in team_ids for service_id in sorted(normal_services[:2])]
+    assert all(f['tick_id'] == tick_id for f in flags)
+    assert already_flag in flags
+    assert len({f['flag'] for f in flags}) == len(flags)
+
+    # asking again (or one by one) gives the same flags
+    assert client.post("/api/v1/flags/generate_tick").json['flags'] == flags
+    assert client.post(f"/api/v1/flag/generate/{normal_services[1]}/2").json in flags
+    assert len(client.get(f"/api/v1/flags/{tick_id}").json) == len(flags)
+
+    response = client.post("/api/v1/flag/submit/2", data=dict(flag=already_flag['flag']))
+    assert response.json['result'] == 'CORRECT'
+
 
 def test_events():
     app.db.drop_all()
@@ -926,6 +1295,124 @@ def test_events():
     assert event['team_id'] == 2
 
 
+def test_bulk_events():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+
+    client.post("/api/v1/game/start")
+
+    ranking = [dict(rank=1, score=10, data="first", team_id=1),
+               dict(rank=2, score=5, data="second", team_id=2)]
+    lines = [
+        json.dumps(dict(event_type="PCAP_RELEASED", reason="bulk release", team_id=1, service_id=1, pcap_name="a.pcap")),
+        "this is not json",
+        json.dumps(dict(event_type="NOT_AN_EVENT", reason="nope")),
+        json.dumps(dict(event_type="KOH_SCORE_FETCH", reason="bulk fetch", team_id=2, service_id=1, score="10",
+                        result="SUCCESS")),
+        json.dumps(dict(event_type="KOH_RANKING", reason="bad ranking", service_id=1,
+                        ranking=json.dumps([dict(not_a_field=1)]))),
+        json.dumps(dict(event_type="KOH_RANKING", reason="bulk ranking", service_id=1, ranking=json.dumps(ranking))),
+        json.dumps(dict(event_type="PCAP_CREATED", reason="bulk pcap", service_id=1, team_id=2,
+                        pcap_name="team_2_service_1_1000.pcap")),
+    ]
+    response = client.post("/api/v1/events/bulk", data="\n".join(lines), content_type="application/x-ndjson")
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [r['line'] for r in results] == list(range(1, len(lines) + 1))
+    assert [r['result'] for r in results] == ["CREATED", "ERROR", "ERROR", "CREATED", "ERROR", "CREATED", "CREATED"]
+
+    events = client.get("/api/v1/events").json['events']
+    assert [e['event_type'] for e in events] == ["PCAP_RELEASED", "KOH_SCORE_FETCH", "KOH_RANKING", "PCAP_CREATED"]
+    assert len(events[2]['ranking']) == len(ranking)
+    assert all(e['tick_id'] == events[0]['tick_id'] for e in events)
+
+    # one event the DB refuses (no reason) only fails its own line
+    lines = [
+        json.dumps(dict(event_type="PCAP_RELEASED", reason="bulk release", team_id=1, service_id=1, pcap_name="a.pcap")),
+        json.dumps(dict(event_type="PCAP_RELEASED", team_id=1, service_id=1, pcap_name="b.pcap")),
+        json.dumps(dict(event_type="PCAP_RELEASED", reason="another bulk release", team_id=2, service_id=1,
+                        pcap_name="c.pcap")),
+    ]
+    response = client.post("/api/v1/events/bulk", data="\n".join(lines), content_type="application/x-ndjson")
+    assert response.status_code == 200
+    assert [r['result'] for r in response.json['results']] == ["CREATED", "ERROR", "CREATED"]
+    assert len(client.get("/api/v1/events").json['events']) == 6
+
+    response = client.post("/api/v1/events/bulk", data="\n".join(lines[:1] * (app.MAX_EVENTS_PER_BULK + 1)),
+                           content_type="application/x-ndjson")
+    assert response.status_code == 400
+
+    # the client batch keeps what was not created, an error body included
+    from ooogame.database.client import Db
+    the_db = Db("", True)
+    the_db.start_game()
+    with the_db.event_batch() as batch:
+        batch.update_event(event_type="PCAP_RELEASED", reason="batch release", team_id=1, service_id=1,
+                           pcap_name="d.pcap")
+        batch.update_event(event_type="KOH_RANKING", reason="bad ranking", service_id=1,
+                           ranking=json.dumps([dict(not_a_field=1)]))
+    assert [(event['reason'], result['result']) for (event, result) in batch.failed] == [("bad ranking", "ERROR")]
+
+    with the_db.event_batch(max_size=app.MAX_EVENTS_PER_BULK + 1) as batch:
+        for _ in range(app.MAX_EVENTS_PER_BULK + 1):
+            batch.update_event(event_type="PCAP_RELEASED", reason="too many", team_id=1, service_id=1,
+                               pcap_name="e.pcap")
+    assert len(batch.failed) == app.MAX_EVENTS_PER_BULK + 1
+
+
+def test_events_paging():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+
+    client.post("/api/v1/game/start")
+
+    ranking = [dict(rank=1, score=10, data="first", team_id=1)]
+    lines = []
+    for i in range(5):
+        lines.append(json.dumps(dict(event_type="PCAP_CREATED", reason=f"pcap {i}", service_id=1, team_id=2,
+                                     pcap_name=f"{i}.pcap")))
+        lines.append(json.dumps(dict(event_type="KOH_RANKING", reason=f"ranking {i}", service_id=1,
+                                     ranking=json.dumps(ranking))))
+    client.post("/api/v1/events/bulk", data="\n".join(lines), content_type="application/x-ndjson")
+
+    all_events = client.get("/api/v1/events").json['events']
+    assert len(all_events) == 10
+    assert [e['id'] for e in all_events] == sorted(e['id'] for e in all_events)
+
+    # walk through them a page at a time
+    paged = []
+    after_id = 0
+    while after_id is not None:
+        response = client.get(f"/api/v1/events?after_id={after_id}&limit=3")
+        assert response.status_code == 200
+        paged.extend(response.json['events'])
+        after_id = response.json['next_after_id']
+    assert paged == all_events
+
+    response = client.get("/api/v1/events?event_type=KOH_RANKING")
+    assert [e['reason'] for e in response.json['events']] == [f"ranking {i}" for i in range(5)]
+    assert all(len(e['ranking']) == 1 for e in response.json['events'])
+
+    tick_id = all_events[0]['tick_id']
+    response = client.get(f"/api/v1/events/{tick_id}?event_type=PCAP_CREATED&limit=2")
+    assert [e['reason'] for e in response.json['events']] == ["pcap 0", "pcap 1"]
+    assert response.json['next_after_id'] == response.json['events'][-1]['id']
+
+    response = client.get("/api/v1/events?stream=1")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    streamed = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [e['id'] for e in streamed] == [e['id'] for e in all_events]
+
+    assert client.get("/api/v1/events?event_type=NOT_AN_EVENT").status_code == 400
+    assert client.get("/api/v1/events?limit=0").status_code == 400
+    assert client.get(f"/api/v1/events?limit={app.MAX_EVENTS_PER_PAGE + 1}").status_code == 400
+
+
 def test_defense():
     app.db.drop_all()
     app.db.create_all()
@@ -1613,6 +2100,142 @@ def test_scores():
         elif t['id'] == 3: assert team_score['ATTACK'] == 1
         else: assert team_score['ATTACK'] == 0
 
+def test_vectorized_scores():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    rand = random.Random(1337)
+
+    client.post("/api/v1/game/start")
+    services = client.get("/api/v1/services").json['services']
+    team_ids = [t.id for t in app.db.session.query(app.Team)]
+    normal_ids = [s['id'] for s in services if s['type'] == "NORMAL"]
+    koh_ids = [s['id'] for s in services if s['type'] == "KING_OF_THE_HILL"]
+
+    tick_ids = []
+    flag_ids = iter(range(1, 1000))
+    for tick in range(8):
+        if tick:
+            client.post("/api/v1/tick/next")
+        tick_id = app.db.session.query(app.func.max(app.Tick.id)).scalar()
+        tick_ids.append(tick_id)
+        for service in services:
+            if rand.random() < 0.4:
+                client.post(f"/api/v1/service/{service['id']}/is_active/{rand.randint(0, 1)}")
+
+        stealthy = set()
+        for _ in range(30):
+            attacker, victim = rand.sample(team_ids, 2)
+            service_id = rand.choice(normal_ids)
+            app.db.session.add(app.FlagStolenEvent(reason="steal", tick_id=tick_id, exploit_team_id=attacker,
+                                                   victim_team_id=victim, service_id=service_id,
+                                                   flag_id=next(flag_ids)))
+            if rand.random() < 0.3 and (attacker, victim, service_id) not in stealthy:
+                stealthy.add((attacker, victim, service_id))
+                app.db.session.add(app.StealthEvent(reason="stealth", tick_id=tick_id, src_team_id=attacker,
+                                                    dst_team_id=victim, service_id=service_id))
+
+        for service_id in koh_ids:
+            event = app.KohRankingEvent(reason="ranking", tick_id=tick_id, service_id=service_id)
+            app.db.session.add(event)
+            # ties, test teams and scores of zero all show up
+            scores = sorted((rand.choice([0, 5, 10, 10, 20, 30, 40]) for _ in team_ids), reverse=True)
+            for rank, (team_id, score) in enumerate(zip(rand.sample(team_ids, len(team_ids)), scores), start=1):
+                app.db.session.add(app.KohRankResult(koh_ranking_event=event, rank=rank, score=score,
+                                                     team_id=team_id))
+        app.db.session.commit()
+
+    with app.app.test_request_context():
+        vectorized = app.calculate_live_scores_for_ticks(app.db, tick_ids)
+        assert sorted(vectorized) == tick_ids
+        for tick_id in tick_ids:
+            assert vectorized[tick_id] == app.calculate_live_scores(app.db, tick_id), tick_id
+        assert any(team['ATTACK'] for result in vectorized.values() for team in result['teams'].values())
+        assert any(team['DEFENSE'] for result in vectorized.values() for team in result['teams'].values())
+        assert any(team['KING_OF_THE_HILL'] for result in vectorized.values() for team in result['teams'].values())
+        assert app.calculate_live_scores_for_ticks(app.db, []) == {}
+
+    assert client.get("/api/v1/scores").json == json.loads(json.dumps(
+        [vectorized[tick_id] for tick_id in tick_ids], default=str))
+
+    # two rankings of an active KoH service in one tick are refused by both
+    client.post("/api/v1/tick/next")
+    tick_id = app.db.session.query(app.func.max(app.Tick.id)).scalar()
+    service_id = rand.choice(koh_ids)
+    client.post(f"/api/v1/service/{service_id}/is_active/1")
+    for _ in range(2):
+        event = app.KohRankingEvent(reason="ranking", tick_id=tick_id, service_id=service_id)
+        app.db.session.add(event)
+        for rank, team_id in enumerate(rand.sample(team_ids, len(team_ids)), start=1):
+            app.db.session.add(app.KohRankResult(koh_ranking_event=event, rank=rank, score=100 - rank,
+                                                 team_id=team_id))
+    app.db.session.commit()
+    with app.app.test_request_context():
+        with pytest.raises(AssertionError):
+            app.calculate_live_scores(app.db, tick_id)
+        with pytest.raises(AssertionError):
+            app.calculate_live_scores_for_ticks(app.db, [tick_id])
+
+
+def test_score_ledger():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+
+    response = client.post("/api/v1/game/start")
+    first_tick = response.json['tick']
+
+    service = _get_normal_service(client)
+    service_id = service['id']
+    response = client.post(f"/api/v1/service/{service_id}/is_active/1")
+    assert response.status_code == 200
+
+    for attacker, defender in [(1, 2), (1, 3), (3, 2)]:
+        response = client.post(f"/api/v1/flag/generate/{service_id}/{defender}")
+        the_flag = response.json['flag']
+        response = client.post(f"/api/v1/flag/submit/{attacker}", data=dict(flag=the_flag))
+        assert response.json['result'] == 'CORRECT'
+
+    response = client.post("/api/v1/event", data=dict(
+        event_type="STEALTH",
+        reason="Testing stealth from team 1 to team 3",
+        tick_id=first_tick,
+        src_team_id=1,
+        dst_team_id=3,
+        service_id=service_id
+    ))
+    assert response.status_code == 200
+
+    live_scores = client.get(f"/api/v1/score/{first_tick}").json
+    assert live_scores['teams']['1']['ATTACK'] == 1.5
+    assert app.db.session.query(app.FinalizedTick).count() == 0
+
+    # the first tick is still live while its flags are valid
+    for _ in range(app.NUM_TICKS_FLAG_VALID_FOR):
+        client.post("/api/v1/tick/next")
+    client.get("/api/v1/scores")
+    assert app.db.session.query(app.FinalizedTick).count() == 0
+
+    client.post("/api/v1/tick/next")
+    response = client.get("/api/v1/scores")
+    assert response.status_code == 200
+    assert len(response.json) == app.NUM_TICKS_FLAG_VALID_FOR + 2
+    assert response.json[0] == live_scores
+
+    assert app.db.session.query(app.FinalizedTick).get(first_tick)
+    attack_rows = app.db.session.query(app.TickScore).filter_by(tick_id=first_tick,
+                                                                score_type=app.ScoreType.ATTACK).all()
+    assert len(attack_rows) == 3
+
+    # reading it again comes from the ledger, and finalizing twice does not duplicate rows
+    assert client.get(f"/api/v1/score/{first_tick}").json == live_scores
+    num_rows = app.db.session.query(app.TickScore).filter_by(tick_id=first_tick).count()
+    app.finalize_tick(app.db, first_tick, app.calculate_live_scores(app.db, first_tick)['teams'])
+    assert app.db.session.query(app.TickScore).filter_by(tick_id=first_tick).count() == num_rows
+
+
 def test_ctftime():
     #set up services
 
@@ -2179,6 +2802,18 @@ def test_visualization():
     assert service_2['num_submitted_patches'] == 2
     assert service_2['tick_id'] == 2
 
+    # only the latest result of a patch counts
+    response = client.post("/api/v1/patch/1/status",
+                           data=dict(
+                               status="SLA_FAIL"
+                           ))
+    assert response.status_code == 200
+    counts = app.Service.get_patch_counts()
+    assert counts[normal_services[0]] == (3, 0)
+    assert counts[normal_services[1]] == (2, 1)
+    assert app.Service.get_num_accepted_patches_for_id(normal_services[0]) == 0
+    assert app.Service.get_num_submitted_patches_for_id(normal_services[1]) == 2
+
 
 
 
@@ -2259,3 +2894,495 @@ def test_stealth_events():
         assert response.json['events'][0]['dst_team_id'] == 3
         assert response.json['events'][1]['src_team_id'] == 3
         assert response.json['events'][1]['dst_team_id'] == 4
+
+
+def test_response_cache():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    client.post("/api/v1/game/start")
+
+    # (the first one fills in the service states)
+    client.get("/api/v1/visualization")
+
+    # the same response until something it is made of is written
+    first = client.get("/api/v1/visualization").json
+    assert client.get("/api/v1/visualization").json['started_dumping_at'] == first['started_dumping_at']
+    assert client.get("/api/v1/visualization?since_tick=1").json['started_dumping_at'] != first['started_dumping_at']
+
+    client.post("/api/v1/tick/next")
+    second = client.get("/api/v1/visualization").json
+    assert second['current_tick'] == first['current_tick'] + 1
+
+    service_id = _get_normal_service(client)['id']
+    client.post(f"/api/v1/service/{service_id}/is_active/1")
+    services = client.get("/api/v1/services").json['services']
+    assert next(s for s in services if s['id'] == service_id)['is_active']
+
+    # another worker is computing it: the older response is served meanwhile
+    connection = app.rq.connection
+    lock_key = app.response_cache._key("lock", "/api/v1/visualization?")
+    connection.set(lock_key, 0)
+    try:
+        client.post("/api/v1/tick/next")
+        assert client.get("/api/v1/visualization").json['current_tick'] == second['current_tick']
+    finally:
+        connection.delete(lock_key)
+    assert client.get("/api/v1/visualization").json['current_tick'] == second['current_tick'] + 1
+
+    # the older response has no ETag, revalidating after the lock is released gets the new one
+    def is_active(response):
+        return next(s for s in response.json['services'] if s['id'] == service_id)['is_active']
+
+    etag = client.get("/api/v1/services").headers['ETag']
+    lock_key = app.response_cache._key("lock", "/api/v1/services?")
+    connection.set(lock_key, 0)
+    try:
+        client.post(f"/api/v1/service/{service_id}/is_active/0")
+        response = client.get("/api/v1/services", headers={'If-None-Match': etag})
+        assert response.status_code == 200 and is_active(response)
+        assert 'ETag' not in response.headers and response.cache_control.no_cache
+    finally:
+        connection.delete(lock_key)
+    response = client.get("/api/v1/services", headers={'If-None-Match': etag})
+    assert response.status_code == 200 and not is_active(response)
+    response = client.get("/api/v1/services", headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+    # without redis every request computes its response
+    with unittest.mock.patch.object(connection, 'get', side_effect=app.redis.exceptions.ConnectionError("down")):
+        assert client.get("/api/v1/scores").status_code == 200
+
+
+def test_precompute_tick():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    first_tick = client.post("/api/v1/game/start").json['tick']
+
+    for _ in range(app.NUM_TICKS_FLAG_VALID_FOR + 1):
+        response = client.post("/api/v1/tick/next")
+    assert response.status_code == 200
+
+    # the tick that left the validity window is in the ledger without anyone asking for scores
+    assert app.db.session.query(app.FinalizedTick).get(first_tick)
+    assert not app.db.session.query(app.FinalizedTick).get(first_tick + 1)
+
+    # and the public game state is ready, also since the tick gamestatebot asks for
+    tick_id = response.json['tick']
+    connection = app.rq.connection
+    since_tick = max(0, tick_id - 1 - app.REFETCH_TICKS)
+    for name in ["/api/v1/scores?", "/api/v1/visualization?", f"/api/v1/visualization?since_tick={since_tick}"]:
+        assert connection.get(app.response_cache._key("tick", tick_id, name)), name
+    prepared = json.loads(connection.get(app.response_cache._key("tick", tick_id, "/api/v1/visualization?")))
+    assert prepared['current_tick'] == tick_id
+
+    # after the writes of the new tick, asking for the tick gets it as no-cache, the others a fresh one
+    service_id = _get_normal_service(client)['id']
+    client.post(f"/api/v1/service/{service_id}/is_active/1")
+    response = client.get(f"/api/v1/visualization?tick={tick_id}")
+    assert response.json == prepared
+    assert response.cache_control.no_cache and 'ETag' not in response.headers
+    response = client.get(f"/api/v1/visualization?since_tick={since_tick}&tick={tick_id}")
+    assert response.json['since_tick'] == since_tick and response.cache_control.no_cache
+    response = client.get("/api/v1/visualization")
+    assert response.json['started_dumping_at'] != prepared['started_dumping_at'] and 'ETag' in response.headers
+
+    # the prepared one of another tick is not there
+    response = client.get(f"/api/v1/visualization?tick={tick_id - 1}")
+    assert response.json['started_dumping_at'] != prepared['started_dumping_at']
+
+
+def test_conditional_get():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    client.post("/api/v1/game/start")
+    # (the first one fills in the service states)
+    client.get("/api/v1/services")
+
+    for path in ["/api/v1/game/state", "/api/v1/services", "/api/v1/teams", "/api/v1/team/2/uploaded_patches",
+                 "/api/v1/scores", "/api/v1/score/1", "/api/v1/visualization"]:
+        response = client.get(path)
+        etag = response.headers['ETag']
+        response = client.get(path, headers={'If-None-Match': etag})
+        assert response.status_code == 304, path
+        assert response.headers['ETag'] == etag
+        assert not response.data
+
+    # a new tick changes the game state, not the teams
+    state_etag = client.get("/api/v1/game/state").headers['ETag']
+    teams_etag = client.get("/api/v1/teams").headers['ETag']
+    client.post("/api/v1/tick/next")
+    response = client.get("/api/v1/game/state", headers={'If-None-Match': state_etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != state_etag
+    assert client.get("/api/v1/teams", headers={'If-None-Match': teams_etag}).status_code == 304
+
+    # ETags are per query string
+    etag = client.get("/api/v1/visualization").headers['ETag']
+    assert client.get("/api/v1/visualization?since_tick=1", headers={'If-None-Match': etag}).status_code == 200
+
+    # the bodies with a time remaining only have weak ETags
+    assert client.get("/api/v1/game/state").headers['ETag'].startswith('W/"')
+    assert etag.startswith('W/"')
+    assert client.get("/api/v1/teams").headers['ETag'].startswith('"')
+
+    # the table versions start over when Redis is flushed, the ETags don't repeat
+    teams_etag = client.get("/api/v1/teams").headers['ETag']
+    app.rq.connection.flushall()
+    assert client.get("/api/v1/teams", headers={'If-None-Match': teams_etag}).status_code == 200
+
+    # the client reuses its bodies
+    from ooogame.database.client import Db
+    the_db = Db("", True, reference_ttl=60)
+    the_db.start_game()
+    teams = the_db.teams()
+    assert the_db.teams() == teams
+    game_state = the_db.game_state()
+    with unittest.mock.patch('time.monotonic', return_value=time.monotonic() + 5):
+        reused = the_db.game_state()
+    assert reused['tick'] == game_state['tick']
+    assert abs(reused['estimated_tick_time_remaining'] - (game_state['estimated_tick_time_remaining'] - 5)) < 1
+    the_db.new_tick()
+    assert the_db.game_state()['tick'] == game_state['tick'] + 1
+
+    # a reused body is the caller's own
+    from ooogame.database.client import AsyncDb
+    public_game_state = the_db.public_game_state()
+    public_game_state['teams'][0]['name'] = "changed"
+    assert the_db.public_game_state()['teams'][0]['name'] != "changed"
+    assert the_db._validators.get(Db.VISUALIZATION) is not None
+
+    async def change_async():
+        async with AsyncDb("", True) as async_db:
+            (await async_db.public_game_state())['teams'][0]['name'] = "changed"
+            return await async_db.public_game_state()
+
+    assert asyncio.run(change_async())['teams'][0]['name'] != "changed"
+
+    # only the most recently used paths are remembered
+    the_db._validators.max_size = 2
+    for since_tick in range(4):
+        the_db.public_game_state(since_tick=since_tick)
+    assert len(the_db._validators) == 2
+    assert the_db._validators.get(Db.VISUALIZATION + "?since_tick=0") is None
+    assert the_db._validators.get(Db.VISUALIZATION + "?since_tick=3") is not None
+
+
+def test_wait_tick():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+    first_tick = client.post("/api/v1/game/start").json['tick']
+
+    response = client.get(f"/api/v1/game/wait_tick?after={first_tick - 1}")
+    assert response.json == dict(tick=first_tick, state="RUNNING")
+
+    # nothing new before the timeout
+    before = time.monotonic()
+    response = client.get(f"/api/v1/game/wait_tick?after={first_tick}&timeout=0.3")
+    assert response.json['tick'] == first_tick
+    assert time.monotonic() - before >= 0.3
+
+    assert client.get("/api/v1/game/wait_tick").status_code == 400
+
+    # the game state changes, as server-sent events
+    response = client.get("/api/v1/game/events?timeout=0")
+    assert response.mimetype == "text/event-stream"
+    event, data, end = response.get_data(as_text=True).split("\n", 2)
+    assert event == "event: game_state"
+    assert json.loads(data[len("data: "):]) == dict(tick=first_tick, state="RUNNING")
+    assert end == "\n"
+
+    # the client waits with it rather than polling
+    from ooogame.database.client import Db
+    the_db = Db("", True)
+    the_db.start_game()
+    the_db.new_tick()
+    with unittest.mock.patch.object(the_db, 'game_state', return_value=dict(tick=first_tick)), \
+            unittest.mock.patch('time.sleep') as sleep:
+        assert the_db.wait_until_new_tick() == first_tick
+    assert not sleep.called
+
+
+def test_game_change_listener():
+    listener = app.GameChangeListener()
+    try:
+        # a new tick in another worker
+        threading.Timer(0.1, app.publish_game_change).start()
+        before = time.monotonic()
+        listener.wait(10)
+        assert time.monotonic() - before < 5
+
+        before = time.monotonic()
+        listener.wait(0.2)
+        assert time.monotonic() - before >= 0.2
+    finally:
+        listener.close()
+
+def test_metrics():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    app.rq.connection.delete(app.METRICS_KEY)
+    client = app.app.test_client()
+    client.post("/api/v1/game/start")
+    for _ in range(3):
+        client.get("/api/v1/team/1")
+    client.get("/api/v1/nothing_here")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    lines = response.get_data(as_text=True).splitlines()
+    samples = dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+
+    assert "# TYPE ooogame_request_duration_seconds histogram" in lines
+    assert samples['ooogame_requests_total{endpoint="/api/v1/team/<int:team_id>",method="GET",status="200"}'] == "3"
+    assert samples['ooogame_requests_total{endpoint="unmatched",method="GET",status="404"}'] == "1"
+    assert samples['ooogame_request_duration_seconds_count{endpoint="/api/v1/team/<int:team_id>",method="GET"}'] == "3"
+    assert samples['ooogame_request_duration_seconds_bucket{endpoint="/api/v1/team/<int:team_id>",method="GET",le="+Inf"}'] == "3"
+    assert float(samples['ooogame_sql_queries_per_request_sum{endpoint="/api/v1/team/<int:team_id>",method="GET"}']) >= 3
+    assert samples['ooogame_sql_queries_per_request_bucket{endpoint="/api/v1/team/<int:team_id>",method="GET",le="0"}'] == "0"
+    assert float(samples['ooogame_sql_duration_seconds_total{endpoint="/api/v1/game/start",method="POST"}']) > 0
+
+
+def test_client_session():
+    from ooogame.database.client import Db
+
+    hits = []
+    connections = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def reply(self, status, body):
+            data = gzip.compress(json.dumps(body).encode())
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            hits.append(("GET", self.path, self.headers['Accept-Encoding']))
+            # overloaded for the first two
+            if len(hits) <= 2:
+                self.reply(503, dict(message="busy"))
+            else:
+                self.reply(200, dict(teams=[dict(id=1)]))
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length'] or 0))
+            hits.append(("POST", self.path, self.headers['Accept-Encoding']))
+            self.reply(503, dict(message="busy"))
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        the_db = Db(f"http://127.0.0.1:{server.server_port}", timeout=5)
+
+        # the GET is retried, on the same connection, and the gzip body decoded
+        assert the_db.teams() == [dict(id=1)]
+        assert hits == [("GET", "/api/v1/teams", "gzip, deflate")] * 3
+        assert len(connections) == 1
+
+        # a POST is never sent twice
+        assert the_db.new_tick() == dict(message="busy")
+        assert [hit[0] for hit in hits].count("POST") == 1
+        assert len(connections) == 1
+
+        # one session for the threads of a process, a new one in a forked process
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(the_db.session))
+        thread.start()
+        thread.join()
+        assert sessions == [the_db.session]
+        the_db._session_pid = -1
+        assert the_db.session is not sessions[0]
+
+        # and the same for the async client
+        from ooogame.database.client import AsyncDb
+        hits.clear()
+
+        async def fetch():
+            async with AsyncDb(f"http://127.0.0.1:{server.server_port}", timeout=5) as async_db:
+                return await async_db.teams(), await async_db.submit_flags(1, ["a", "b"])
+
+        assert asyncio.run(fetch()) == ([dict(id=1)], dict(message="busy"))
+        assert [hit[:2] for hit in hits] == [("GET", "/api/v1/teams")] * 3 + [("POST", "/api/v1/flag/submit_batch/1")]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_async_client():
+    from ooogame.database.client import AsyncDb
+
+    async def play():
+        async with AsyncDb("", True) as the_db:
+            tick = (await the_db.start_game())['tick']
+            teams = await the_db.teams()
+            services = await the_db.services()
+            normal_id = next(s['id'] for s in services if s['type'] == "NORMAL")
+            await the_db._post(f"/api/v1/service/{normal_id}/is_active/1")
+
+            # fan out
+            flags = await asyncio.gather(*(the_db.generate_flag(normal_id, team['id']) for team in teams))
+            assert [flag['team_id'] for flag in flags] == [team['id'] for team in teams]
+            results = await asyncio.gather(the_db.submit_flag(teams[1]['id'], flags[0]['flag']),
+                                           the_db.submit_flag(teams[1]['id'], "nope"))
+            assert [result['result'] for result in results] == ["CORRECT", "INCORRECT"]
+            results = await the_db.submit_flags(teams[2]['id'], [flags[0]['flag'], flags[2]['flag']])
+            assert [result['result'] for result in results['results']] == ["CORRECT", "OWN_FLAG"]
+
+            async with the_db.event_batch(max_size=2) as batch:
+                for team in teams[:3]:
+                    await batch.update_event(event_type="SLA_SCRIPT", reason="sla", team_id=team['id'],
+                                             service_id=normal_id, ip="10.0.0.1", port=1, result="SUCCESS",
+                                             service_interaction_docker="docker", the_script="/check.sh")
+                await batch.update_event(event_type="KOH_RANKING", reason="bad ranking", service_id=normal_id,
+                                         ranking=json.dumps([dict(not_a_field=1)]))
+            events = await the_db.events(event_type="SLA_SCRIPT")
+            assert len(events) == 3
+            assert [event['reason'] for (event, result) in batch.failed] == ["bad ranking"]
+
+            # the conditional GET reuses the body
+            game_state = await the_db.game_state()
+            assert game_state['tick'] == tick
+            assert await the_db.teams() == teams
+
+            await the_db.new_tick()
+            # prepared when the tick started
+            assert (await the_db.public_game_state(tick=tick + 1))['current_tick'] == tick + 1
+            with unittest.mock.patch.object(the_db, 'game_state', return_value=dict(tick=tick)), \
+                    unittest.mock.patch('asyncio.sleep') as sleep:
+                assert await the_db.wait_until_new_tick() == tick
+            assert not sleep.called
+            return await the_db.game_state()
+
+    assert asyncio.run(play())['tick'] == app.db.session.query(app.func.max(app.Tick.id)).scalar()
+
+
+def test_reference_cache():
+    from ooogame.database.client import Db
+    the_db = Db("", True, reference_ttl=60)
+    the_db.start_game()
+    service_id = the_db.services()[0]['id']
+
+    teams = the_db.teams()
+    team = the_db.team(2)
+    service = the_db.service(service_id)
+    assert the_db.teams() == teams and the_db.team(2) == team and the_db.service(service_id) == service
+    assert the_db.reference_cache_stats() == dict(hits=3, revalidations=0, misses=4)
+
+    # every caller gets its own copy
+    the_db.teams()[0]['name'] = "changed"
+    the_db.service(service_id)['is_visible'] = "changed"
+    assert the_db.teams() == teams and the_db.service(service_id) == service
+    assert the_db.reference_cache_stats() == dict(hits=7, revalidations=0, misses=4)
+
+    # revalidated with a 304 once the TTL is over
+    now = time.monotonic()
+    with unittest.mock.patch('time.monotonic', return_value=now + 61):
+        assert the_db.teams() == teams
+        assert the_db.team(2) == team
+        assert the_db.service(service_id) == service
+    assert the_db.reference_cache_stats() == dict(hits=7, revalidations=3, misses=4)
+
+    # a change made behind the client's back shows up once invalidated
+    the_db.test_client.post(f"/api/v1/service/{service_id}/is_visible/1")
+    assert the_db.service(service_id) == service
+    the_db.invalidate_reference_cache(Db.SERVICE_INFO.format(service_id))
+    assert the_db.service(service_id)['is_visible'] and not service['is_visible']
+    assert the_db.reference_cache_stats() == dict(hits=8, revalidations=3, misses=5)
+
+    # a change through the client only invalidates what it changes
+    the_db._post(f"/api/v1/service/{service_id}/is_active/1")
+    assert the_db.service(service_id)['is_active'] and not service['is_active']
+    assert [s['is_active'] for s in the_db.services() if s['id'] == service_id] == [True]
+    the_db.new_tick()
+    assert the_db.teams() == teams and the_db.service(service_id)['is_active']
+    assert the_db.reference_cache_stats() == dict(hits=10, revalidations=3, misses=7)
+
+    the_db.invalidate_reference_cache()
+    assert the_db.teams() == teams
+    assert the_db.reference_cache_stats()['revalidations'] == 4
+
+    uncached = Db("", True, reference_ttl=0)
+    uncached.teams()
+    uncached.teams()
+    assert uncached.reference_cache_stats() == dict(hits=0, revalidations=1, misses=1)
+
+    # the test app is written to behind the client's back, by default nothing is cached there
+    assert Db("", True)._reference_cache.ttl == 0
+
+
+def test_client_metrics(tmp_path):
+    import urllib.request
+    from ooogame.database.client import AsyncDb, Db, client_metrics
+    from ooogame.database.client import perf_measure
+
+    client_metrics.clear()
+    the_db = Db("", True)
+    the_db.start_game()
+    for _ in range(3):
+        the_db.teams()
+    # an unknown team is a 400
+    the_db.submit_flag(12345, "nope")
+    the_db.invalidate_reference_cache()
+    the_db.reference_cache_stats()
+    # the batch only shows up as the bulk_events it sends
+    with the_db.event_batch() as batch:
+        batch.update_event(event_type="SLA_SCRIPT", reason="ok", team_id=1, service_id=1, result="OK")
+
+    async def fan_out():
+        async with AsyncDb("", True) as async_db:
+            await asyncio.gather(*(async_db.team(team_id) for team_id in (1, 2, 3)))
+
+    asyncio.run(fan_out())
+
+    metrics = client_metrics.to_json()
+    assert metrics['teams']['calls'] == 3
+    assert metrics['teams']['errors'] == 0
+    assert metrics['teams']['bytes'] > 0
+    assert 0 < metrics['teams']['p50_seconds'] <= metrics['teams']['p99_seconds'] <= metrics['teams']['max_seconds']
+    assert metrics['submit_flag']['errors'] == 1
+    assert metrics['team']['calls'] == 3 and metrics['team']['bytes'] > 0
+    assert metrics['bulk_events']['calls'] == 1 and 'event_batch' not in metrics and 'close' not in metrics
+    assert 'invalidate_reference_cache' not in metrics and 'reference_cache_stats' not in metrics
+
+    histogram = perf_measure.LatencyHistogram()
+    for seconds in (0.00005, 0.001, 0.002, 0.5):
+        histogram.record(seconds)
+    assert histogram.percentile(25) == perf_measure.HISTOGRAM_MIN_SECONDS
+    assert 0.002 <= histogram.percentile(75) < 0.002 * 2 ** (1 / perf_measure.SUB_BUCKETS_PER_DOUBLING)
+    assert histogram.percentile(100) == 0.5
+
+    server = perf_measure.serve_metrics(0, host="127.0.0.1")
+    try:
+        text = urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics").read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'ooogame_client_calls_total{method="teams"} 3' in text
+    assert 'ooogame_client_errors_total{method="submit_flag"} 1' in text
+    assert 'ooogame_client_call_duration_seconds_bucket{method="teams",le="+Inf"} 3' in text
+
+    path = str(tmp_path / "metrics.json")
+    perf_measure.dump_metrics(path)
+    with open(path) as fp:
+        assert json.load(fp)['methods']['submit_flag']['calls'] == 1
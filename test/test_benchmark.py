@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Benchmark tests.
+"""
+import pytest
+
+import ooogame.database.api as app
+from ooogame.benchmark.bench import ENDPOINTS, FlaskClientTransport, run_benchmark
+from ooogame.benchmark.synthesize import synthesize_game
+
+
+def test_synthesize_and_benchmark():
+    app.db.drop_all()
+    app.db.create_all()
+    app.rq.connection.flushall()
+
+    counts = synthesize_game(teams=4, normal_services=2, koh_services=1, ticks=5, hit_rate=0.5, stealth_rate=1,
+                             incorrect_per_tick=1)
+    assert counts['flags'] == 4 * 2 * 5
+    assert counts['koh_rankings'] == 5
+    assert counts['stealths'] == counts['steals'] > 0
+    assert counts['submissions'] == counts['steals'] + 4 * 5
+    assert app.db.session.query(app.FlagStolenEvent).count() == counts['steals']
+    assert app.db.session.query(app.ServiceState).filter_by(is_active=True, is_visible=True).count() == 2 + 1
+
+    client = app.app.test_client()
+    state = client.get("/api/v1/game/state").json
+    assert state['state'] == "RUNNING"
+    assert state['tick'] == app.db.session.query(app.func.max(app.Tick.id)).scalar()
+    assert len(client.get("/api/v1/scores").json) == 5
+
+    report = run_benchmark(FlaskClientTransport(), requests=3, hit_rate=1)
+    assert set(report) == set(ENDPOINTS)
+    for name, result in report.items():
+        assert result['statuses'] == {"200": 3}
+        assert 0 < result['p50_ms'] <= result['p99_ms'] <= result['max_ms']
+    assert report['events']['queries_per_request'] > 0
+    # every submission was a new steal
+    assert app.db.session.query(app.FlagStolenEvent).count() == counts['steals'] + 3
+
+    with pytest.raises(ValueError):
+        synthesize_game(miss_rate=1)
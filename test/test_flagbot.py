@@ -45,18 +45,22 @@ def test_flagbot():
     db = Db("", True)
     db.change_tick_time(1)
     start_game = db.start_game()
+    service_id = [s for s in db.services() if s['type'] == 'NORMAL'][0]['id']
+    db.test_client.post(f"/api/v1/service/{service_id}/is_active/1")
 
     # mock out the wait_until_new_tick so that we don't hang
     db.wait_until_new_tick = unittest.mock.Mock(return_value=True)
+    db.generate_flag = unittest.mock.Mock(wraps=db.generate_flag)
 
     assert len(db.events()) == 0
 
     k8s_api = get_mock_k8s_service()
     flagbot.main(db, k8s_api, max_ticks=1, concurrency=False, concurrency_lib='threading')
 
-    # check that the events were created
+    # check that the events were created, the active service using the flags of the tick
     events = db.events()
-    assert len(events) != 0
+    assert len([event for event in events if event['service_id'] == service_id]) == len(db.teams())
+    assert all(call.args[0] != service_id for call in db.generate_flag.call_args_list)
 
     for event in events:
         assert event['event_type'] == 'SET_FLAG'
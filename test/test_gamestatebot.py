@@ -68,3 +68,44 @@ def test_gamestatebot():
         db.wait_until_new_tick = unittest.mock.Mock(return_value=100)
         gamestatebot.main(db, "/game_state", max_ticks=1)
         assert os.path.exists('/game_state/game_states/game_state_100')
+
+def test_merge_game_state():
+    db = Db("", True)
+    db.start_game()
+
+    service = [s for s in db.services() if s['type'] == 'NORMAL'][0]
+    db.test_client.post(f"/api/v1/service/{service['id']}/is_visible/1")
+    db.test_client.post(f"/api/v1/service/{service['id']}/is_active/1")
+
+    def steal(attacker, victim):
+        flag = db.generate_flag(service['id'], victim)
+        assert db.submit_flag(attacker, flag['flag'])['result'] == 'CORRECT'
+
+    steal(1, 2)
+    for _ in range(gamestatebot.REFETCH_TICKS):
+        db.new_tick()
+        steal(2, 3)
+    old_game_state = db.public_game_state()
+
+    steal(3, 1)
+    db.new_tick()
+    steal(1, 3)
+    db.update_event(event_type="STEALTH", reason="testing", src_team_id=1, dst_team_id=3,
+                    service_id=service['id'])
+
+    delta = db.public_game_state(since_tick=old_game_state['current_tick'] - gamestatebot.REFETCH_TICKS)
+    assert all(s['tick_id'] > delta['since_tick'] for s in delta['scores'])
+    assert all(e['tick'] > delta['since_tick'] for e in delta['exploitation_events'])
+    assert all(t['id'] > delta['since_tick'] for t in delta['ticks'])
+
+    merged = gamestatebot.fetch_game_state(db, old_game_state)
+    full = db.public_game_state()
+    for key in ['est_time_remaining', 'started_dumping_at']:
+        del merged[key]
+        del full[key]
+    assert merged == full
+
+    # asking for the tick that just started gets the same delta, prepared when it started
+    prepared = gamestatebot.fetch_game_state(db, old_game_state, full['current_tick'])
+    assert prepared['current_tick'] == full['current_tick']
+    assert [t['id'] for t in prepared['ticks']] == [t['id'] for t in full['ticks']]
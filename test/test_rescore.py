@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Offline rescoring tests.
+"""
+import pytest
+
+import ooogame.database.api as app
+import ooogame.scoring.rescore as rescore
+
+
+def _play_game():
+    app.db.drop_all()
+    app.db.create_all()
+    app.init_test_data()
+    client = app.app.test_client()
+
+    first_tick = client.post("/api/v1/game/start").json['tick']
+    services = client.get("/api/v1/services").json['services']
+    normal_id = next(s['id'] for s in services if s['type'] == "NORMAL")
+    koh_id = next(s['id'] for s in services if s['type'] == "KING_OF_THE_HILL")
+    client.post(f"/api/v1/service/{normal_id}/is_active/1")
+    client.post(f"/api/v1/service/{koh_id}/is_active/1")
+
+    old_flag = client.post(f"/api/v1/flag/generate/{normal_id}/3").json['flag']
+    for attacker, defender in [(2, 3), (3, 2)]:
+        the_flag = client.post(f"/api/v1/flag/generate/{normal_id}/{defender}").json['flag']
+        assert client.post(f"/api/v1/flag/submit/{attacker}", data=dict(flag=the_flag)).json['result'] == 'CORRECT'
+    client.post("/api/v1/event", data=dict(event_type="STEALTH", reason="stealth", tick_id=first_tick,
+                                           src_team_id=2, dst_team_id=3, service_id=normal_id))
+    event = app.KohRankingEvent(reason="ranking", tick_id=first_tick, service_id=koh_id)
+    app.db.session.add(event)
+    for rank, (team_id, score) in enumerate([(2, 30), (3, 20), (4, 10)], start=1):
+        app.db.session.add(app.KohRankResult(koh_ranking_event=event, rank=rank, score=score, team_id=team_id))
+    app.db.session.commit()
+
+    for _ in range(app.NUM_TICKS_FLAG_VALID_FOR + 1):
+        client.post("/api/v1/tick/next")
+    # too old by one tick
+    assert client.post("/api/v1/flag/submit/4", data=dict(flag=old_flag)).json['result'] == 'TOO_OLD'
+    # finalizes the first tick
+    scores = client.get("/api/v1/scores").json
+    assert app.db.session.query(app.FinalizedTick).get(first_tick)
+    return first_tick, scores
+
+
+def test_rescore_game():
+    first_tick, scores = _play_game()
+
+    report = rescore.rescore_game(ticks_per_chunk=2)
+    assert [tick['tick_id'] for tick in report['ticks']] == [s['tick_id'] for s in scores]
+    assert report['finalized_ticks'] == 1
+    assert report['diff'] == []
+    for tick, score in zip(report['ticks'], scores):
+        for team_id, team_score in score['teams'].items():
+            totals = tick['teams'][int(team_id)]
+            assert totals['ATTACK'] == team_score['ATTACK']
+            assert totals['KING_OF_THE_HILL'] == team_score['KING_OF_THE_HILL']
+    assert report['totals'][2] == dict(ATTACK=0.5, DEFENSE=0, KING_OF_THE_HILL=10, total=10.5)
+    assert report['ticks'][-1]['cumulative'] == report['totals']
+
+
+def test_rescore_what_if():
+    first_tick, _ = _play_game()
+
+    rules = rescore.parse_what_if(["rank_to_score=4,2", "stealth_points=0.25",
+                                   f"flag_valid_for={app.NUM_TICKS_FLAG_VALID_FOR + 1}"])
+    report = rescore.rescore_game(**rules)
+    first = report['ticks'][0]['teams']
+    assert first[2]['ATTACK'] == 0.25
+    assert first[3]['ATTACK'] == 1
+    # the TOO_OLD submission counts with the longer window
+    assert first[4]['ATTACK'] == 1
+    assert (first[2]['KING_OF_THE_HILL'], first[3]['KING_OF_THE_HILL'], first[4]['KING_OF_THE_HILL']) == (4, 2, 0)
+    assert dict(tick_id=first_tick, team_id=2, score_type="ATTACK", ledger=0.5, rescored=0.25) in report['diff']
+
+    # replaying the submissions with the game's window gives back the ledger
+    assert rescore.rescore_game(flag_valid_for=app.NUM_TICKS_FLAG_VALID_FOR)['diff'] == []
+
+    # nothing counts with no window at all
+    report = rescore.rescore_game(flag_valid_for=-1)
+    assert not any(team['ATTACK'] for tick in report['ticks'] for team in tick['teams'].values())
+
+    with pytest.raises(ValueError):
+        rescore.parse_what_if(["rank_points=1"])
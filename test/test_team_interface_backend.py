@@ -167,6 +167,11 @@ def test_flag_submission():
     response = client.post(f"/api/submit_flag/{flag}", headers=TEAM_1_HEADERS)
     assert response.json['message'] == "CORRECT"
 
+    result = app.db.generate_flag(3, 5)
+    response = client.post("/api/submit_flags", data=dict(flag=[flag, "another_incorrect_flag", result['flag']]),
+                           headers=TEAM_1_HEADERS)
+    assert [r['message'] for r in response.json['results']] == ["ALREADY_SUBMITTED", "INCORRECT", "CORRECT"]
+
 
 def test_submit_patches():
     app.db = Db("", True)